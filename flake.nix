@@ -27,7 +27,7 @@
           value = lib.nixosSystem {
             inherit system;
             specialArgs = { inherit self inputs pkgs-unstable; };
-            modules = [{
+            modules = [({ config, pkgs, ... }: {
               imports = [ ./modules/settings.nix hostFile ] ++ targetModules;
               config = {
                 nix = {
@@ -36,8 +36,15 @@
                 };
                 nixpkgs.config.allowUnfree = true;
                 system.stateVersion = "24.11";
+                # The settings tree, read by the scripts instead of evaluating the flake.
+                system.extraSystemBuilderCmds = ''
+                  ln -s ${pkgs.writeText "settings.json" (builtins.toJSON {
+                    name = "${name}-${target}";
+                    settings = config.settings;
+                  })} $out/settings.json
+                '';
               };
-            }];
+            })];
           };
         };
     in {
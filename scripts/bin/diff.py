@@ -1,15 +1,16 @@
 #! /usr/bin/env nix-shell
 #! nix-shell -i python3 -p python3
-import fnmatch, os, sys
+import fnmatch, sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 from lib import Config, Shell, Snapshot, Utils
 
 sh = Shell(root_required=True)
 
+SETTINGS = ["config.settings.disk.immutability.persist.paths", *Snapshot.SETTINGS]
+
 def get_keep_paths():
-    raw = str(Config.eval("config.settings.disk.immutability.persist.paths"))
-    return raw.replace("[", "").replace("]", "").strip().split(" ")
+    return Config.eval("config.settings.disk.immutability.persist.paths")
 
 def get_changed_files():
     changed = set()
@@ -17,17 +18,15 @@ def get_changed_files():
         snapshots = Snapshot.get_snapshots_path()
         tmp = f"{snapshots}/{name}/tmp"
         clean = Snapshot.get_clean_snapshot_path(name)
-        if sh.exists(tmp): sh.run(f"btrfs subvolume delete -C {tmp}")
-        sh.run(f"btrfs subvolume snapshot -r {mount} {tmp}")
+        if sh.exists(tmp): sh.run(["btrfs", "subvolume", "delete", "-C", tmp])
+        sh.run(["btrfs", "subvolume", "snapshot", "-r", mount, tmp])
         transaction_id = Shell.stdout(sh.run(
-            f'echo "$(sudo btrfs subvolume find-new "{clean}" 9999999)" '
-            f"| cut -d' ' -f4"))
-        output = Shell.stdout(sh.run(
-            f'btrfs subvolume find-new "{tmp}" {transaction_id} '
-            f"| sed '$d' | cut -f17- -d' ' | sort | uniq"))
-        sh.run(f"btrfs subvolume delete -C {tmp}")
-        for path in output.split("\n"):
-            if path.strip(): changed.add(f"{mount}/{path}".replace("//", "/"))
+            ["btrfs", "subvolume", "find-new", clean, "9999999"])).split(" ")[3]
+        for line in sh.stream(["btrfs", "subvolume", "find-new", tmp, transaction_id]):
+            fields = line.split(" ", 16)
+            if len(fields) == 17 and fields[16].strip():
+                changed.add(f"{mount}/{fields[16]}".replace("//", "/"))
+        sh.run(["btrfs", "subvolume", "delete", "-C", tmp])
     return changed
 
 def top_ancestor(path, keep_paths, mount_points):
@@ -68,6 +67,7 @@ def main():
         "--recent", "--show-symlinks", "--show-persist-paths",
         ("--show-children", str), ("--depth", int),
         ("--pattern", str), ("--diffignore", str)])
+    Config.prefetch(*SETTINGS)
     cache_path = "/tmp/etc/nixos/scripts/bin/diff/cache.json"
     ignore_path = args.diffignore or "/etc/nixos/scripts/bin/.diffignore"
     diffignore = (sh.file_read(ignore_path).split("\n")
@@ -103,7 +103,7 @@ def main():
     if args.recent:
         output = [path for path in output if path not in previous]
     if not args.show_symlinks:
-        output = [path for path in output if not os.path.islink(path)]
+        output = [path for path in output if not sh.is_symlink(path)]
     if args.pattern:
         output = [path for path in output
                   if fnmatch.fnmatch(path.lower(), args.pattern.lower())]
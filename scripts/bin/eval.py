@@ -1,13 +1,16 @@
 #! /usr/bin/env nix-shell
 #! nix-shell -i python3 -p python3
-import sys
+import json, sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 from lib import Config, Utils
 
 def main():
-    args = Utils.parse_args(["expression"])
-    Utils.print(Config.eval(args.expression))
+    args = Utils.parse_args(["expression", "--server"])
+    if args.server and not Config.start_eval_server():
+        Utils.log_error("Could not start the evaluation server, using nix eval")
+    value = Config.eval(args.expression)
+    Utils.print(value if isinstance(value, str) else json.dumps(value))
 
 if __name__ == "__main__":
     main()
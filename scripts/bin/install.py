@@ -7,6 +7,14 @@ from lib import Config, Interactive, Shell, Snapshot, Utils
 
 class Installer:
     sh = Shell()
+    SETTINGS = [
+        "config.settings.user.admin.username",
+        "config.settings.disk.device",
+        "config.settings.disk.encryption.enable",
+        "config.settings.disk.encryption.plainTextPasswordFile",
+        *Config.SETTINGS,
+        *Snapshot.SETTINGS,
+    ]
     @classmethod
     def install_nixos(cls):
         mount = cls.get_mount_point()
@@ -23,7 +31,7 @@ class Installer:
         cls.permission_nixos()
     @classmethod
     def permission_nixos(cls):
-        with cls.sh.chroot(cls.get_mount_point()):
+        with cls.sh.chroot(cls.get_mount_point(), session=True):
             Config.secure(cls.get_username())
             Snapshot.create_initial_snapshots()
     @classmethod
@@ -80,6 +88,7 @@ def main():
         Config.reset_config(
             Interactive.ask_for_host_path(Config.get_hosts_path()),
             Config.get_standard_flake_target())
+    Config.prefetch(*Installer.SETTINGS)
     Config.create_secrets(
         plain_text_password_path=Installer.get_plain_text_password_path())
     if Interactive.confirm(f"Format {Installer.get_installation_disk()}?"):
@@ -1,4 +1,4 @@
-import json, subprocess, sys
+import json, sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
 from lib import Utils
@@ -6,6 +6,7 @@ sys.path.insert(0, str(Path(__file__).resolve().parent))
 from labels import AUDIO
 
 class Audio:
+    TIMEOUT = 5
     @classmethod
     def list(cls):
         current = cls.default()
@@ -60,11 +61,10 @@ class Audio:
         except json.JSONDecodeError: return []
     @classmethod
     def read(cls, *args):
-        result = subprocess.run(["pactl", *args], capture_output=True, text=True, check=False)
-        return result.stdout
+        return Utils.run_bounded(["pactl", *args], cls.TIMEOUT).stdout
     @classmethod
     def run(cls, *args):
-        subprocess.run(["pactl", *args], capture_output=False, check=False)
+        Utils.run_bounded(["pactl", *args], cls.TIMEOUT, capture_output=False)
 
 def main(argv=None):
     Utils.LOG_INFO = False
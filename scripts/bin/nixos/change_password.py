@@ -6,6 +6,11 @@ sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
 from lib import Config, Shell, Utils
 
 sh = Shell(root_required=True)
+SETTINGS = [
+    "config.settings.user.admin.username",
+    "config.settings.disk.by.partlabel.root",
+    *Config.SETTINGS,
+]
 
 def ask_for_old_password():
     return getpass.getpass("Enter current password (LUKS + account): ")
@@ -64,7 +69,7 @@ def change_account_password_via_pam(user, old_password, new_password):
 def sync_hashed_password_file(new_password):
     Utils.log("Mirroring new hash to the declarative password file...")
     hashed = Shell.stdout(sh.run(
-        f"mkpasswd -m sha-512 {shlex.quote(new_password)}",
+        ["mkpasswd", "-m", "sha-512", new_password],
         sensitive=new_password))
     sh.file_write(Config.get_hashed_password_path(), hashed, sensitive=hashed)
 
@@ -4,12 +4,12 @@ import importlib, os, sys
 from pathlib import Path
 HERE = Path(__file__).resolve().parent
 sys.path[:0] = [str(HERE), str(HERE.parent.parent)]
-from lib import Utils
+from lib import Config, Utils
 
-ROOT_COMMANDS    = {"update", "upgrade", "tpm2", "secure-boot", "change-password"}
-COMMANDS         = ["update", "upgrade", "tpm2", "secure-boot", "change-password",
+ROOT_COMMANDS    = {"update", "upgrade", "gc", "tpm2", "secure-boot", "change-password"}
+COMMANDS         = ["update", "upgrade", "gc", "tpm2", "secure-boot", "change-password",
                     "displays", "audio", "caffeine", "system"]
-MODULE_ALIASES   = {"upgrade": "update", "secure-boot": "secure_boot", "change-password": "change_password"}
+MODULE_ALIASES   = {"upgrade": "update", "gc": "garbage", "secure-boot": "secure_boot", "change-password": "change_password"}
 
 def usage():
     Utils.print(f"Usage: nixos {{{','.join(COMMANDS)}}} [args...]")
@@ -17,6 +17,8 @@ def usage():
 def dispatch(command, argv):
     if command == "upgrade": argv = ["--upgrade", *argv]
     module = importlib.import_module(MODULE_ALIASES.get(command, command))
+    # Commands list the settings they read in SETTINGS; one evaluation fetches them all.
+    Config.prefetch(*getattr(module, "SETTINGS", ()))
     module.main(argv)
 
 def main():
@@ -13,6 +13,7 @@ from PyQt6.QtCore import QObject, QTimer, QPoint, Qt
 
 PID_FILE = Path(os.environ.get("XDG_RUNTIME_DIR", "/tmp")) / "nixos-helper.pid"
 CLI_BINARY = os.environ.get("NIXOS_CLI", "nixos")
+CLI_TIMEOUT = 30
 PR_SET_PDEATHSIG = 1
 libc = ctypes.CDLL("libc.so.6", use_errno=True)
 
@@ -31,7 +32,7 @@ def die_with_parent(): libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM, 0, 0, 0)
 def cli(*args, capture=False):
     Utils.log(f"cli {' '.join(args)}")
     if capture:
-        result = subprocess.run([CLI_BINARY, *args], capture_output=True, text=True, check=False)
+        result = Utils.run_bounded([CLI_BINARY, *args], CLI_TIMEOUT)
         return result.stdout, result.returncode
     return subprocess.Popen([CLI_BINARY, *args])
 
@@ -1,4 +1,4 @@
-import json, re, subprocess, sys
+import json, re, sys
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
 from lib import Utils
@@ -9,6 +9,7 @@ ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*m")
 DRM_PATH = Path("/sys/class/drm")
 
 class Displays:
+    TIMEOUT = 10
     @classmethod
     def list(cls):
         connected = cls.connected_names()
@@ -118,11 +119,10 @@ class Displays:
         return status.exists() and status.read_text().strip() == "connected"
     @classmethod
     def read_kscreen(cls):
-        result = subprocess.run(["kscreen-doctor", "-o"], capture_output=True, text=True, check=False)
-        return ANSI_ESCAPE.sub("", result.stdout)
+        return ANSI_ESCAPE.sub("", Utils.run_bounded(["kscreen-doctor", "-o"], cls.TIMEOUT).stdout)
     @classmethod
     def run(cls, *args):
-        subprocess.run(["kscreen-doctor", *args], capture_output=False, check=False)
+        Utils.run_bounded(["kscreen-doctor", *args], cls.TIMEOUT, capture_output=False)
 
 def main(argv=None):
     Utils.LOG_INFO = False
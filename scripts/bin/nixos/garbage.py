@@ -0,0 +1,24 @@
+#! /usr/bin/env nix-shell
+#! nix-shell -i python3 -p python3
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+from lib import Config, Interactive, Shell, Utils
+from lib.gcplan import GcPlan
+
+sh = Shell(root_required=True)
+SETTINGS = ["config.settings.user.admin.username"]
+
+def main(argv=None):
+    args = Utils.parse_args([("--keep-last", int), ("--keep-days", float), ("--free-gb", float),
+                             "--dry-run", "--yes"], argv)
+    keep_last = args.keep_last
+    if keep_last is None and args.keep_days is None and args.free_gb is None: keep_last = GcPlan.KEEP_LAST
+    plan = GcPlan(sh, [Config.get_admin_username()], keep_last=keep_last, keep_days=args.keep_days,
+                  free_bytes=None if args.free_gb is None else int(args.free_gb * 2**30))
+    Utils.print("\n".join(plan.describe()))
+    if args.dry_run or not any(generation["delete"] for generation in plan.generations): return
+    if args.yes or Interactive.confirm("Delete these generations and collect garbage?"): plan.apply()
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,11 @@ from lib import Config, Shell, Utils
 sh = Shell(root_required=True)
 
 PCRS = "7+12"
+SETTINGS = [
+    "config.settings.disk.by.partlabel.root",
+    "config.settings.tpm.device",
+    "config.settings.tpm.versionPath",
+]
 
 def require_tpm2():
     if not (sh.exists(Config.get_tpm_device())
@@ -16,22 +21,22 @@ def require_tpm2():
 
 def require_luks():
     root = Config.get_disk_by_part_label_root()
-    if sh.run(f"cryptsetup isLuks {root}", check=False).returncode != 0:
+    if sh.run(["cryptsetup", "isLuks", root], check=False).returncode != 0:
         Utils.abort(f"{root} is not LUKS encrypted")
 
 def enroll():
     root = Config.get_disk_by_part_label_root()
     device = Config.get_tpm_device()
     result = sh.run(
-        f"systemd-cryptenroll {root} --wipe-slot=tpm2 "
-        f"--tpm2-device={device} --tpm2-pcrs={PCRS}",
+        ["systemd-cryptenroll", root, "--wipe-slot=tpm2",
+         f"--tpm2-device={device}", f"--tpm2-pcrs={PCRS}"],
         capture_output=False, check=False)
     if result.returncode != 0: Utils.abort("TPM2 enrollment failed")
     Utils.log("TPM2 enrolled successfully")
 
 def wipe():
     root = Config.get_disk_by_part_label_root()
-    result = sh.run(f"systemd-cryptenroll {root} --wipe-slot=tpm2",
+    result = sh.run(["systemd-cryptenroll", root, "--wipe-slot=tpm2"],
                     capture_output=False, check=False)
     if result.returncode != 0: Utils.abort("TPM2 wipe failed")
     Utils.log("TPM2 enrollment wiped")
@@ -41,9 +46,9 @@ def status():
     device = Config.get_tpm_device()
     Utils.print(f"TPM2 device: {device}")
     Utils.print(Shell.stdout(
-        sh.run(f"systemd-cryptenroll --tpm2-device=list {root}", check=False)))
+        sh.run(["systemd-cryptenroll", "--tpm2-device=list", root], check=False)))
     Utils.print(Shell.stdout(
-        sh.run(f"cryptsetup luksDump {root}", check=False)))
+        sh.run(["cryptsetup", "luksDump", root], check=False)))
 
 def enable():
     require_tpm2()
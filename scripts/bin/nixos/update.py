@@ -6,6 +6,7 @@ sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
 from lib import Config, Shell, Utils
 
 sh = Shell(root_required=True)
+SETTINGS = [*Config.SETTINGS, "config.settings.user.admin.username"]
 
 def main(argv=None):
     args = Utils.parse_args(["--rebuild-filesystem", "--reboot", "--clean", "--upgrade"], argv)
@@ -14,7 +15,8 @@ def main(argv=None):
         rebuild_file_system=args.rebuild_filesystem,
         reboot=args.reboot,
         delete_cache=delete_cache,
-        upgrade=args.upgrade)
+        upgrade=args.upgrade,
+        report=True)
 
 if __name__ == "__main__":
     main()
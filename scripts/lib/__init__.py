@@ -1,10 +1,12 @@
 from .shell import Shell, chrootable
+from .executor import Executor
+from .deadline import Deadline, DeadlineExceeded
 from .utils import Utils
 from .interactive import Interactive
 from .config import Config
 from .snapshot import Snapshot
 
 __all__ = [
-    'Shell', 'chrootable', 'Utils', 'Interactive',
-    'Config', 'Snapshot',
+    'Shell', 'chrootable', 'Executor', 'Deadline', 'DeadlineExceeded',
+    'Utils', 'Interactive', 'Config', 'Snapshot',
 ]
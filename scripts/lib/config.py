@@ -1,30 +1,97 @@
-import json, shlex
+import contextlib, json, os, subprocess
 from .shell import Shell, chrootable
+from .evalcache import EvalCache
+from .evalserver import EvalServer
+from .deadline import Deadline
+from .gcplan import GcPlan
+from .pipeline import Pipeline
+from .storeverify import StoreVerify
+from .replay import Recording
 from .utils import Utils
 from .interactive import Interactive
 
 @chrootable
 class Config:
     sh = Shell()
+    SETTINGS = [
+        "config.settings.secrets.path",
+        "config.settings.secrets.hashedPasswordFile",
+    ]
+    TOPLEVEL = ["config.system.build.toplevel.outPath", "config.system.build.toplevel.drvPath"]
+    # Seconds. eval_many bounds every evaluation, the evaluate stage included;
+    # the stages that prompt (config, secrets) and the activation, which must
+    # not be interrupted halfway, have no deadline of their own.
+    EVAL_TIMEOUT = 900
+    STAGE_TIMEOUTS = {"clean": 1800, "upgrade": 900, "permissions": 600, "verify": 3600, "build": 4 * 3600,
+                      "journal": 60}
+    models = {}
+    staged = None
     @classmethod
     def exists(cls):
         return cls.sh.exists(cls.get_config_path())
     @classmethod
     def read(cls):
-        return cls.sh.json_read(cls.get_config_path())
+        return cls.model()["data"]
+    @classmethod
+    def model(cls):
+        # config.json parsed once per change of its inode, size or mtime.
+        if cls.staged is not None: return cls.parse(cls.staged, None)
+        path = cls.get_config_path()
+        key, signature = cls.sh.chroot_path(path), cls.signature(path)
+        model = Config.models.get(key)
+        if model is None or model["signature"] != signature:
+            model = Config.models[key] = cls.parse(cls.sh.json_read(path), signature)
+        return model
+    @classmethod
+    def signature(cls, path):
+        # Recorded runs cannot stat the recorded tree; only writes made here reload it.
+        if Recording.active(): return "recorded"
+        try: info = os.stat(cls.sh.chroot_path(path))
+        except FileNotFoundError: return None
+        except OSError: return object()
+        return info.st_ino, info.st_size, info.st_mtime_ns
+    @classmethod
+    def parse(cls, data, signature):
+        host_path = data.get("host_path")
+        return {"signature": signature, "data": data, "host_path": host_path, "target": data.get("target"),
+                "host": cls.sh.basename(host_path).replace(".nix", "") if host_path else None,
+                "architecture": cls.sh.parent_name(cls.sh.dirname(host_path)) if host_path else None}
     @classmethod
     def get(cls, key):
         return cls.read().get(key, None)
     @classmethod
     def set(cls, key, value):
-        return cls.sh.json_write(cls.get_config_path(), key, value)
+        return cls.save({**cls.read(), key: value})
     @classmethod
     def reset_config(cls, host_path, target):
-        cls.sh.rm(cls.get_config_path())
-        cls.set_host_path(host_path)
-        cls.set_target(target)
+        cls.save({"host_path": host_path, "target": target})
+    @classmethod
+    def save(cls, data):
+        if cls.staged is not None:
+            cls.staged.clear()
+            cls.staged.update(data)
+            return
+        path = cls.get_config_path()
+        if cls.signature(path) is not None and data == cls.read(): return
+        cls.sh.json_overwrite(path, data)
+        Config.models[cls.sh.chroot_path(path)] = cls.parse(data, cls.signature(path))
+    @classmethod
+    @contextlib.contextmanager
+    def transaction(cls):
+        # set_* calls inside are written to config.json once, when the outermost transaction ends.
+        if cls.staged is not None:
+            yield
+            return
+        Config.staged = dict(cls.read())
+        try: yield
+        except BaseException:
+            Config.staged = None
+            raise
+        staged, Config.staged = Config.staged, None
+        cls.save(staged)
     @classmethod
     def create_secrets(cls, plain_text_password_path=None):
+        cls.eval_many(cls.SETTINGS)
         if not cls.sh.exists(cls.get_secrets_path()):
             cls.sh.mkdir(cls.get_secrets_path())
         needs_password = (
@@ -39,7 +106,7 @@ class Config:
                     plain_text_password_path, password, sensitive=password
                 )
             encrypted = Shell.stdout(cls.sh.run(
-                f"mkpasswd -m sha-512 {shlex.quote(password)}",
+                ["mkpasswd", "-m", "sha-512", password],
                 sensitive=password,
             ))
             cls.sh.file_write(
@@ -48,83 +115,231 @@ class Config:
     @classmethod
     def secure_secrets(cls):
         if not cls.sh.exists(cls.get_secrets_path()): return
-        directories = cls.sh.find_directories(cls.get_secrets_path(), pattern="*")
-        files = cls.sh.find_files(cls.get_secrets_path(), pattern="*")
-        cls.sh.chown("root", cls.get_secrets_path(), *directories, *files)
-        cls.sh.chmod(700, cls.get_secrets_path(), *directories)
-        cls.sh.chmod(600, *files)
+        entries = [entry for entry in cls.entries(cls.sh.realpath(cls.get_secrets_path()))
+                   if entry["type"] != "symlink"]
+        cls.apply_permissions(entries, "root", {
+            entry["path"]: 0o600 if entry["type"] == "file" else 0o700 for entry in entries})
     @classmethod
-    def secure(cls, username):
+    def secure(cls, username, safe_directory=True):
+        nixos_path = cls.sh.realpath(cls.get_nixos_path())
+        secrets_path = cls.sh.realpath(cls.get_secrets_path())
+        entries = [entry for entry in cls.entries(nixos_path)
+                   if not f"{entry['path']}/".startswith(f"{secrets_path}/")]
+        with cls.sh.plan():
+            cls.apply_permissions(entries, username, cls.permissions(nixos_path, entries))
+            cls.secure_secrets()
+        if safe_directory: cls.sh.git_add_safe_directory(cls.get_nixos_path())
+    @classmethod
+    def entries(cls, path):
+        return [entry for entry in cls.sh.stat_many(cls.sh.find(path)) if entry["exists"]]
+    @classmethod
+    def permissions(cls, nixos_path, entries):
+        # The modes `chmod -R 755` on the tree, 644 on regular files, 755 on
+        # scripts and 444 on git objects would leave behind, in one pass.
         ignore_pattern = "*/secrets* */.venv* */.direnv* */.git*"
-        cls.sh.chown(username, cls.get_nixos_path())
-        cls.sh.chmod(755, *cls.sh.find_directories(
-            cls.get_nixos_path(), ignore_pattern=ignore_pattern))
-        cls.sh.chmod(644, *cls.sh.find_files(
-            cls.get_nixos_path(), ignore_pattern=ignore_pattern))
-        cls.sh.chmod(755, *cls.sh.find(
-            cls.get_nixos_path(), pattern="*/scripts/* */bin/*",
-            ignore_pattern=ignore_pattern))
-        cls.sh.chmod(444, *cls.sh.find_files(
-            f"{cls.get_nixos_path()}/.git/objects"))
-        cls.sh.git_add_safe_directory(cls.get_nixos_path())
-        cls.secure_secrets()
+        ignored = {entry["path"] for entry in entries if cls.sh.matches(entry["path"], ignore_pattern)}
+        executable = {entry["path"] for entry in entries if entry["path"] not in ignored
+                      and cls.sh.matches(entry["path"], "*/scripts/* */bin/*")}
+        def is_executable(path):
+            while path.startswith(nixos_path):
+                if path in executable: return True
+                path = path.rpartition("/")[0]
+            return False
+        modes = {}
+        for entry in entries:
+            path, is_file = entry["path"], entry["type"] == "file"
+            if is_file and path.startswith(f"{nixos_path}/.git/objects/"): modes[path] = 0o444
+            elif is_executable(path): modes[path] = 0o755
+            elif is_file and path not in ignored: modes[path] = 0o644
+            else: modes[path] = 0o755
+        return modes
+    @classmethod
+    def apply_permissions(cls, entries, user, modes):
+        # Links are owned like everything else but keep their modes, as after `chown -R` and `chmod -R`.
+        uid = cls.sh.uid(user)
+        cls.sh.lchown(user, *[entry["path"] for entry in entries if entry["uid"] != uid])
+        for mode in sorted(set(modes.values())):
+            cls.sh.chmod(f"{mode:o}", *[entry["path"] for entry in entries if entry["type"] != "symlink"
+                                        and modes[entry["path"]] == mode and entry["mode"] != mode], recursive=False)
     @classmethod
     def update(cls, rebuild_file_system=False, reboot=False,
-               delete_cache=False, upgrade=False):
+               delete_cache=False, upgrade=False, report=False):
+        # Stages run as soon as what they need is done: the closure builds while
+        # secrets are created and /etc/nixos is permissioned, and only the
+        # activation holds the whole pipeline. The build and the cleanup run on
+        # their own Shell, everything else on cls.sh in dependency order. When
+        # the evaluated toplevel is already the running system, nothing is built
+        # or activated.
+        pipeline, options = Pipeline(timeouts=cls.STAGE_TIMEOUTS), {"rebuild_file_system": rebuild_file_system}
+        if delete_cache: pipeline.add("clean", lambda: cls.clean(cls.sh.fork(), cls.get_admin_username()),
+                                      needs=["config"])
+        # Collecting garbage while `nix flake update` fetches inputs races with it; clean already clears /root/.cache.
+        if upgrade: pipeline.add("upgrade", lambda: cls.upgrade(clear_cache=not delete_cache),
+                                 needs=["config", "clean"])
+        pipeline.add("config", lambda: options.update(cls.ensure_config(rebuild_file_system)))
+        pipeline.add("evaluate", lambda: cls.eval_many([*cls.SETTINGS, *cls.TOPLEVEL]),
+                     needs=["config", "clean", "upgrade"])
+        pipeline.add("secrets", cls.create_secrets, needs=["evaluate"])
+        pipeline.add("permissions", lambda: cls.secure(cls.sh.whoami(), safe_directory=False), needs=["secrets"])
         if delete_cache:
-            cls.sh.run("nix-collect-garbage -d", capture_output=False)
-            cls.sh.rm("/root/.cache")
-            cls.sh.run("nix-store --verify --repair", capture_output=False)
-        if upgrade:
-            cls.sh.rm("/root/.cache")
-            cls.sh.run(f"nix flake update --flake {Config.get_nixos_path()}",
-                       capture_output=False)
-        cls.create_secrets()
-        cls.secure(cls.sh.whoami())
+            pipeline.add("verify", lambda: cls.verify(cls.sh.fork(), pipeline.stages["evaluate"].result),
+                         needs=["evaluate"])
+        pipeline.add("build", lambda: cls.build(cls.sh.fork(), pipeline.stages["evaluate"].result, **options),
+                     needs=["evaluate", "verify"])
+        pipeline.add("activate", lambda: cls.activate(pipeline.stages["build"].result, **options),
+                     needs=["build", "permissions"], exclusive=True)
+        pipeline.add("journal", lambda: pipeline.stages["build"].result and cls.home_manager_log(),
+                     needs=["activate"])
+        try: pipeline.run()
+        finally:
+            if report: Utils.print("\n".join(["Update stages:", *pipeline.report()]))
+        if reboot: Utils.reboot()
+        elif pipeline.stages["build"].result: Interactive.ask_to_reboot()
+        return pipeline
+    @classmethod
+    def clean(cls, sh, username):
+        # The last GcPlan.KEEP_LAST generations of every profile survive, as rollback targets.
+        plan = GcPlan(sh, [username], keep_last=GcPlan.KEEP_LAST)
+        Utils.print("\n".join(plan.describe()))
+        plan.apply()
+        sh.rm("/root/.cache")
+    @classmethod
+    def verify(cls, sh, evaluated):
+        # The running and the target system's closures, rather than `nix-store --verify` on the whole store.
+        out_path = evaluated[cls.TOPLEVEL[0]]
+        return StoreVerify.verify(sh, sh.realpath(cls.get_current_system_path()),
+                                  out_path if sh.exists(out_path) else None)
+    @classmethod
+    def upgrade(cls, clear_cache=True):
+        if clear_cache: cls.sh.rm("/root/.cache")
+        cls.sh.run(["nix", "flake", "update", "--flake", Config.get_nixos_path()], capture_output=False)
+    @classmethod
+    def ensure_config(cls, rebuild_file_system):
         if not cls.sh.exists(cls.get_config_path()):
             Utils.print_error(f"'{cls.get_config_path()}' IS MISSING.")
             host_path = Interactive.ask_for_host_path(cls.get_hosts_path())
             cls.reset_config(host_path, Config.get_standard_flake_target())
             rebuild_file_system = True
-        environment = ""
-        if rebuild_file_system: environment = "NIXOS_INSTALL_BOOTLOADER=1"
+        # The build starts before permissions are applied, so the flake is marked safe up front.
+        cls.sh.git_add_safe_directory(cls.get_nixos_path())
+        return {"rebuild_file_system": rebuild_file_system}
+    @classmethod
+    def build(cls, sh, evaluated, rebuild_file_system=False):
+        # What `nixos-rebuild build` does, from the derivation evaluated already;
+        # None when the running system is that toplevel and the bootloader stays.
+        out_path, drv_path = (evaluated[attribute] for attribute in cls.TOPLEVEL)
+        if not rebuild_file_system and out_path == sh.realpath(cls.get_current_system_path()): return None
+        installable = f"{drv_path}^out" if sh.exists(drv_path) else (
+            f"{sh.realpath(cls.get_nixos_path())}#nixosConfigurations."
+            f"{cls.get_host()}-{cls.get_target()}.config.system.build.toplevel")
+        # With --no-link only the store changes, so only memoized store queries go stale.
+        return Shell.stdout(sh.run(["nix", "--extra-experimental-features", "nix-command",
+                                    "--extra-experimental-features", "flakes", "build", "--no-link",
+                                    "--print-out-paths", installable], writes=["/nix/store"])).splitlines()[-1]
+    @classmethod
+    def activate(cls, system, rebuild_file_system=False):
+        # nixos-rebuild finds the closure built already and only switches to it.
         nixos_path = cls.sh.realpath(cls.get_nixos_path())
-        host = cls.get_host()
-        target = cls.get_target()
-        cls.sh.run(f"{environment} nixos-rebuild switch "
-                   f"--flake {nixos_path}#{host}-{target}",
-                   capture_output=False)
-        result = cls.sh.run(
-            "journalctl -u 'home-manager-*.service' "
-            "--no-pager -o cat -q -r 2>/dev/null "
-            "| sed '/^Starting Home Manager activation$/q' "
-            "| tac "
-            "| grep -v '^\\(Starting\\|Stopping\\|Stopped\\|Finished\\|Activating \\)'",
-            check=False, capture_output=True)
-        hm_log = Shell.stdout(result)
-        if hm_log: print(hm_log)
-        if reboot: Utils.reboot()
-        else: Interactive.ask_to_reboot()
+        if system is None: Utils.print("The system is already up to date, nothing to switch.")
+        else: cls.sh.run(["nixos-rebuild", "switch", "--flake", f"{nixos_path}#{cls.get_host()}-{cls.get_target()}"],
+                         env="NIXOS_INSTALL_BOOTLOADER=1" if rebuild_file_system else "", capture_output=False)
+        cls.sh.json_overwrite(cls.get_built_system_path(), {
+            "system": cls.sh.realpath(cls.get_current_system_path()),
+            "fingerprint": EvalCache.fingerprint(cls.sh, nixos_path)})
+    @classmethod
+    def home_manager_log(cls):
+        hm_log = []
+        for line in cls.sh.stream("journalctl -u 'home-manager-*.service' "
+                                  "--no-pager -o cat -q -r 2>/dev/null", check=False):
+            if line == "Starting Home Manager activation": break
+            if not line.startswith(("Starting", "Stopping", "Stopped", "Finished", "Activating ")):
+                hm_log.append(line)
+        if hm_log: print("\n".join(reversed(hm_log)).strip())
+    @classmethod
+    def eval(cls, attribute):
+        return cls.eval_many([attribute])[attribute]
+    @classmethod
+    def eval_many(cls, attributes):
+        # One `nix eval --json` for every attribute not cached yet, so the
+        # module system is evaluated once per call instead of once per setting.
+        keys = {attribute: cls.eval_key(attribute) for attribute in attributes}
+        pending, settings = [], None
+        for attribute, key in keys.items():
+            if key in Shell.evals: continue
+            hit, value = EvalCache.get(cls.cache_path(key))
+            if not hit and attribute.startswith("config.settings."):
+                if settings is None: settings = cls.system_settings()
+                hit, value = cls.lookup(settings, attribute.split(".")[2:])
+            if hit: Shell.evals[key] = value
+            else: pending.append(attribute)
+        if pending:
+            # A hung evaluation fails after EVAL_TIMEOUT instead of blocking the caller.
+            with Deadline.scope(cls.EVAL_TIMEOUT, "evaluation"):
+                values = cls.eval_server(pending) if EvalServer.running() and not cls.sh.chroots else None
+                if values is None: values = json.loads(Shell.stdout(cls.sh.run(cls.eval_command(pending))))
+            for attribute in pending:
+                Shell.evals[keys[attribute]] = values[attribute]
+                EvalCache.put(cls.cache_path(keys[attribute]), values[attribute])
+        return {attribute: Shell.evals[key] for attribute, key in keys.items()}
+    @classmethod
+    def eval_server(cls, attributes):
+        nixos_path = cls.sh.realpath(cls.get_nixos_path())
+        return EvalServer.query(nixos_path, EvalCache.fingerprint(cls.sh, nixos_path),
+                                f"{cls.get_host()}-{cls.get_target()}", cls.selection(attributes))
+    @classmethod
+    def start_eval_server(cls):
+        nixos_path = cls.sh.realpath(cls.get_nixos_path())
+        fingerprint = EvalCache.fingerprint(cls.sh, nixos_path)
+        if fingerprint is None: return False
+        return EvalServer.running() or EvalServer.start(nixos_path, fingerprint)
+    @classmethod
+    def system_settings(cls):
+        # The running system's settings.json, trusted only while the flake is
+        # the one it was built from: same host and target, same fingerprint.
+        built = cls.sh.json_read(cls.get_built_system_path())
+        system, fingerprint = built.get("system"), built.get("fingerprint")
+        if not fingerprint or system != cls.sh.realpath(cls.get_current_system_path()): return {}
+        if fingerprint != EvalCache.fingerprint(cls.sh, cls.sh.realpath(cls.get_nixos_path())): return {}
+        data = cls.sh.json_read(f"{system}/settings.json")
+        if data.get("name") != f"{cls.get_host()}-{cls.get_target()}": return {}
+        return data.get("settings", {})
     @classmethod
-    def eval(cls, attribute) -> "str | bool":
+    def lookup(cls, settings, path):
+        for name in path:
+            if not isinstance(settings, dict) or name not in settings: return False, None
+            settings = settings[name]
+        return True, settings
+    @classmethod
+    def prefetch(cls, *attributes):
+        if not attributes or not cls.exists(): return
+        try: cls.eval_many(attributes)
+        except subprocess.CalledProcessError:
+            Utils.log_error("Failed to prefetch settings, evaluating them one by one")
+    @classmethod
+    def cache_path(cls, key):
+        return EvalCache.path(cls.sh, cls.sh.realpath(cls.get_nixos_path()), key)
+    @classmethod
+    def eval_key(cls, attribute):
+        return ("eval", cls.get_flake_output(), attribute)
+    @classmethod
+    def eval_command(cls, attributes):
+        return ("nix", "--extra-experimental-features", "nix-command",
+                "--extra-experimental-features", "flakes", "eval", "--json",
+                cls.get_flake_output(), "--apply", cls.selection(attributes))
+    @classmethod
+    def selection(cls, attributes):
+        selected = " ".join(f"{json.dumps(attribute)} = system.{attribute};" for attribute in attributes)
+        return f"system: {{ {selected} }}"
+    @classmethod
+    def get_flake_output(cls):
         nixos_path = cls.sh.realpath(cls.get_nixos_path())
-        host = cls.get_host()
-        target = cls.get_target()
-        cmd = (f"nix --extra-experimental-features nix-command "
-               f"--extra-experimental-features flakes eval "
-               f"{nixos_path}#nixosConfigurations.{host}-{target}.{attribute}")
-        if cmd in Shell.evals: return Shell.evals[cmd]
-        output = Shell.stdout(cls.sh.run(cmd)).replace("\"", "")
-        if output == "true": output = True   # type: ignore[assignment]
-        if output == "false": output = False  # type: ignore[assignment]
-        Shell.evals[cmd] = output
-        return output
+        return f"{nixos_path}#nixosConfigurations.{cls.get_host()}-{cls.get_target()}"
     @classmethod
     def metadata(cls, pkg):
         nixos_path = cls.sh.realpath(cls.get_nixos_path())
-        cmd = (f"nix --extra-experimental-features nix-command "
-               f"--extra-experimental-features flakes flake metadata "
-               f"{pkg} --json -I {nixos_path}")
+        cmd = ["nix", "--extra-experimental-features", "nix-command",
+               "--extra-experimental-features", "flakes", "flake", "metadata",
+               pkg, "--json", "-I", nixos_path]
         return json.loads(Shell.stdout(cls.sh.run(cmd)))
     # Readwrite
     @classmethod
@@ -132,7 +347,7 @@ class Config:
         return cls.set("host_path", host_path)
     @classmethod
     def get_host_path(cls):
-        return cls.get("host_path")
+        return cls.model()["host_path"]
     @classmethod
     def get_hosts_path(cls):
         return f"{cls.get_nixos_path()}/modules/hosts"
@@ -141,7 +356,7 @@ class Config:
         return cls.set("target", target)
     @classmethod
     def get_target(cls):
-        return cls.get("target")
+        return cls.model()["target"]
     # Readonly
     @classmethod
     def get_standard_flake_target(cls): return "Standard-Boot"
@@ -159,11 +374,14 @@ class Config:
     def get_tpm_version_path(cls):
         return cls.eval("config.settings.tpm.versionPath")
     @classmethod
+    def get_admin_username(cls):
+        return cls.eval("config.settings.user.admin.username")
+    @classmethod
     def get_host(cls):
-        return cls.sh.basename(cls.get_host_path()).replace(".nix", "")
+        return cls.model()["host"]
     @classmethod
     def get_architecture(cls):
-        return cls.sh.parent_name(cls.sh.dirname(cls.get_host_path()))
+        return cls.model()["architecture"]
     @classmethod
     def get_hashed_password_path(cls):
         return (str(cls.get_secrets_path()) + "/"
@@ -183,3 +401,9 @@ class Config:
     @classmethod
     def get_nixos_path(cls):
         return "/etc/nixos"
+    @classmethod
+    def get_current_system_path(cls):
+        return "/run/current-system"
+    @classmethod
+    def get_built_system_path(cls):
+        return "/var/cache/nixos-scripts/system.json"
@@ -0,0 +1,52 @@
+import contextlib, subprocess, threading, time
+
+class DeadlineExceeded(subprocess.TimeoutExpired):
+    def __init__(self, cmd, elapsed, deadline, output=None, stderr=None):
+        super().__init__(cmd, deadline.seconds, output, stderr)
+        self.elapsed = elapsed
+        self.deadline = deadline
+    def __str__(self):
+        return f"Command '{self.cmd}' ran for {self.elapsed:.1f}s and exceeded the {self.deadline}"
+
+# Deadlines nest: a command runs until the tightest enclosing deadline, so an
+# operation-wide budget also bounds every call made inside it. Each thread has
+# its own stack; Pipeline stages start from the stack of the thread running it.
+class Deadline:
+    local = threading.local()
+    def __init__(self, seconds, name=None):
+        self.seconds = seconds
+        self.name = name or "per-call"
+        self.expires = time.monotonic() + seconds
+    def __str__(self):
+        return f"{self.name} deadline ({self.seconds:g}s)"
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+    @classmethod
+    def stack(cls):
+        if not hasattr(cls.local, "stack"): cls.local.stack = []
+        return cls.local.stack
+    @classmethod
+    @contextlib.contextmanager
+    def inherit(cls, stack):
+        previous, cls.local.stack = cls.stack(), list(stack)
+        try: yield
+        finally: cls.local.stack = previous
+    @classmethod
+    @contextlib.contextmanager
+    def scope(cls, seconds, name=None):
+        # A scope of None seconds adds no deadline, for optional limits.
+        if seconds is None:
+            yield None
+            return
+        deadline = cls(seconds, name)
+        cls.stack().append(deadline)
+        try: yield deadline
+        finally: cls.stack().remove(deadline)
+    @classmethod
+    def current(cls, timeout=None):
+        deadlines = cls.stack() if timeout is None else [*cls.stack(), cls(timeout)]
+        return min(deadlines, key=lambda deadline: deadline.expires, default=None)
+    @classmethod
+    def limit(cls, timeout=None):
+        deadline = cls.current(timeout)
+        return None if deadline is None else deadline.remaining()
@@ -0,0 +1,69 @@
+import contextlib, hashlib, os, shutil
+from .hostcache import HostCache
+from .process import display
+
+# Config.eval results shared across processes. Entries live in one directory
+# per flake fingerprint, so editing the flake or updating its inputs moves
+# lookups to a fresh directory instead of invalidating entries one by one;
+# only the most recent KEEP directories are kept. The fingerprint hashes the
+# commit git has checked out, flake.lock, and the contents of the tracked
+# files `git status` reports changed, so git's own stat cache decides what is
+# read and a clean tree costs one `git status`. Entries are HostCache files
+# under NIXOS_EVAL_CACHE, renamed into place, so concurrent readers see a
+# complete value or none.
+class EvalCache:
+    ENV = "NIXOS_EVAL_CACHE"
+    CACHE = HostCache(ENV, "eval")
+    KEEP = 8
+    @classmethod
+    def path(cls, sh, nixos_path, cmd):
+        directory = cls.CACHE.location()
+        if directory is None: return None
+        fingerprint = cls.fingerprint(sh, nixos_path)
+        if fingerprint is None: return None
+        return os.path.join(directory, fingerprint, hashlib.sha256(display(cmd).encode()).hexdigest())
+    @classmethod
+    def fingerprint(cls, sh, nixos_path):
+        # Any write under the flake, or any command with side effects, drops the memoized fingerprint.
+        key = ("fingerprint", tuple(sh.chroots[-1:]), nixos_path)
+        hit, fingerprint = sh.memo.get(key)
+        if hit: return fingerprint
+        return sh.memo.put(key, cls.digest(sh, nixos_path), (sh.chroot_path(nixos_path),), tree=True)
+    @classmethod
+    def digest(cls, sh, nixos_path):
+        result = sh.run(["git", "--no-optional-locks", "-c", f"safe.directory={nixos_path}", "-C", nixos_path,
+                         "status", "--porcelain=v2", "-z", "--branch", "--untracked-files=no", "--no-renames"],
+                        check=False, read_only=True)
+        if result.returncode != 0: return None
+        digest, changed = hashlib.sha256(), {"flake.lock"}
+        for entry in result.stdout.split("\0"):
+            if entry.startswith("# branch.oid "): digest.update(f"{entry}\0".encode())
+            # Ordinary entries have 8 fields before the path, unmerged ones 10.
+            elif entry.startswith("1 "): changed.add(entry.split(" ", 8)[8])
+            elif entry.startswith("u "): changed.add(entry.split(" ", 10)[10])
+        for name in sorted(changed):
+            path = sh.chroot_path(f"{nixos_path}/{name}")
+            digest.update(f"{name}\0".encode())
+            try:
+                if os.path.islink(path): digest.update(f"link\0{os.readlink(path)}".encode())
+                else:
+                    with open(path, "rb") as f: digest.update(hashlib.file_digest(f, "sha256").digest())
+            except FileNotFoundError: digest.update(b"missing")
+            except IsADirectoryError: digest.update(b"directory")
+            except PermissionError: return None
+        return digest.hexdigest()
+    @classmethod
+    def get(cls, path):
+        return HostCache.read(path)
+    @classmethod
+    def put(cls, path, value):
+        # A new fingerprint directory is the moment to drop the oldest ones.
+        if path is not None and not os.path.isdir(directory := os.path.dirname(path)):
+            with contextlib.suppress(OSError):
+                os.makedirs(directory, mode=0o755)
+                cls.prune(os.path.dirname(directory))
+        HostCache.write(path, value)
+    @classmethod
+    def prune(cls, directory):
+        entries = sorted(os.scandir(directory), key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in entries[cls.KEEP:]: shutil.rmtree(entry.path, ignore_errors=True)
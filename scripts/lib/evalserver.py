@@ -0,0 +1,161 @@
+import contextlib, json, os, re, select, socket, stat, struct, subprocess, sys, time
+from .deadline import Deadline
+from .executor import Executor
+from .replay import Recording
+
+# A `nix repl` that keeps the flake loaded between queries, so only the first
+# evaluation of a configuration pays for the module system. It listens on a
+# unix socket in /run/nixos-eval for root and $XDG_RUNTIME_DIR/nixos-eval for
+# anyone else, answers Config.eval_many requests with the same
+# `system: { ... }` selection `nix eval --apply` would use, and exits when idle
+# for IDLE seconds or when asked about a different flake fingerprint, in which
+# case the client starts a fresh one. Clients only use a server this process
+# started, or one NIXOS_EVAL_SERVER opts into, and only while its directory,
+# its socket and the process answering on it all belong to the current user.
+class EvalServer:
+    ENV = "NIXOS_EVAL_SERVER"
+    RUN = "/run/nixos-eval"
+    IDLE = 1800
+    STARTUP = 10.0
+    ESCAPES = {"n": "\n", "t": "\t", "r": "\r"}
+    PROMPT = "nix-repl> "
+    STRING = re.compile(r'"((?:[^"\\]|\\.)*)"')
+    CREDENTIALS = struct.Struct("3i")
+    started = False
+    def __init__(self, nixos_path, fingerprint):
+        self.fingerprint = fingerprint
+        self.queries = 0
+        self.repl = subprocess.Popen(
+            ["nix", "--extra-experimental-features", "nix-command flakes", "repl"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+            env={**os.environ, "NO_COLOR": "1", "TERM": "dumb"})
+        self.send(f":lf {nixos_path}")
+    @classmethod
+    def socket_path(cls):
+        if os.getuid() == 0: return os.path.join(cls.RUN, "socket")
+        runtime = os.environ.get("XDG_RUNTIME_DIR")
+        return os.path.join(runtime, "nixos-eval", "socket") if runtime else None
+    @classmethod
+    def owned(cls, path, kind, mode):
+        # lstat, so a symlink planted in place of the path is never followed.
+        try: info = os.lstat(path)
+        except OSError: return False
+        return (stat.S_IFMT(info.st_mode) == kind and info.st_uid == os.getuid()
+                and stat.S_IMODE(info.st_mode) == mode)
+    @classmethod
+    def trusted(cls):
+        path = cls.socket_path()
+        return (path is not None and cls.owned(os.path.dirname(path), stat.S_IFDIR, 0o700)
+                and cls.owned(path, stat.S_IFSOCK, 0o600))
+    @classmethod
+    def peer(cls, connection):
+        # The uid of the process on the other end of a unix socket.
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, cls.CREDENTIALS.size)
+        return cls.CREDENTIALS.unpack(credentials)[1]
+    @classmethod
+    def running(cls):
+        if Recording.active() or not (cls.started or os.environ.get(cls.ENV)): return False
+        return cls.trusted()
+    @classmethod
+    def start(cls, nixos_path, fingerprint):
+        if Recording.active() or (path := cls.socket_path()) is None: return False
+        if cls.trusted():
+            cls.started = True
+            return True
+        with contextlib.suppress(FileExistsError): os.mkdir(os.path.dirname(path), 0o700)
+        if not cls.owned(os.path.dirname(path), stat.S_IFDIR, 0o700): return False
+        with contextlib.suppress(FileNotFoundError): os.unlink(path)
+        subprocess.Popen([sys.executable, "-m", "lib.evalserver", path, nixos_path, fingerprint],
+                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+        deadline = time.monotonic() + cls.STARTUP
+        while not cls.owned(path, stat.S_IFSOCK, 0o600):
+            if time.monotonic() > deadline: return False
+            time.sleep(0.05)
+        cls.started = True
+        return True
+    @classmethod
+    def query(cls, nixos_path, fingerprint, name, selection):
+        # None when no server is reachable or it cannot answer; the caller falls back to `nix eval`.
+        if fingerprint is None: return None
+        request = {"fingerprint": fingerprint, "name": name, "selection": selection}
+        reply = cls.request(request)
+        if reply is not None and reply.get("stale") and cls.start(nixos_path, fingerprint):
+            reply = cls.request(request)
+        return None if reply is None else reply.get("values")
+    @classmethod
+    def request(cls, message):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.settimeout(Deadline.limit())
+                connection.connect(cls.socket_path())
+                if cls.peer(connection) != os.getuid(): return None
+                Executor.send(connection, message)
+                return Executor.receive(connection)
+        except OSError: return None
+    def send(self, line):
+        # The marker is evaluated rather than echoed, so a repl that echoes its
+        # input does not end the read early.
+        self.queries += 1
+        marker = f"__NIXOS_EVAL_{self.queries}__"
+        self.repl.stdin.write(f"{line}\n\"{marker[:7]}\" + \"{marker[7:]}\"\n")
+        self.repl.stdin.flush()
+        lines = []
+        for output in self.repl.stdout:
+            output = EvalServer.unprompted(output.rstrip("\n"))
+            if output == f"\"{marker}\"": return lines
+            lines.append(output)
+        raise RuntimeError(f"nix repl exited with {self.repl.wait()}")
+    def evaluate(self, name, selection):
+        return EvalServer.parse(self.send(f"builtins.toJSON (({selection}) nixosConfigurations.{json.dumps(name)})"))
+    @classmethod
+    def unprompted(cls, line):
+        while line.startswith(cls.PROMPT): line = line[len(cls.PROMPT):]
+        return line
+    @classmethod
+    def parse(cls, lines):
+        # The value is the last line that is one whole Nix string literal; anything
+        # else becomes an error, and the client falls back to `nix eval`.
+        errors = [line for line in lines if line.startswith("error:")]
+        strings = [match.group(1) for line in lines if (match := cls.STRING.fullmatch(line))]
+        if errors or not strings: return {"error": "\n".join(errors or lines) or "no output"}
+        literal = re.sub(r"\\(.)", lambda match: cls.ESCAPES.get(match.group(1), match.group(1)), strings[-1])
+        try: return {"values": json.loads(literal)}
+        except ValueError as e: return {"error": f"unparseable reply {strings[-1]!r}: {e}"}
+    def close(self):
+        with contextlib.suppress(BrokenPipeError): self.repl.stdin.close()
+        self.repl.wait()
+
+def serve(path, nixos_path, fingerprint):
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Created 0600 from the start; the directory is 0700 as well.
+    umask = os.umask(0o177)
+    try: listener.bind(path)
+    finally: os.umask(umask)
+    listener.listen(4)
+    inode = os.stat(path).st_ino
+    def release():
+        # Only remove the socket if a newer server has not replaced it.
+        with contextlib.suppress(FileNotFoundError):
+            if os.stat(path).st_ino == inode: os.unlink(path)
+    server = None
+    try:
+        server = EvalServer(nixos_path, fingerprint)
+        while select.select([listener], [], [], EvalServer.IDLE)[0]:
+            connection, _ = listener.accept()
+            with connection:
+                if EvalServer.peer(connection) != os.getuid(): continue
+                if (request := Executor.receive(connection)) is None: continue
+                if request["fingerprint"] != server.fingerprint:
+                    release()
+                    Executor.send(connection, {"stale": True})
+                    break
+                Executor.send(connection, server.evaluate(request["name"], request["selection"]))
+    finally:
+        release()
+        listener.close()
+        if server: server.close()
+
+if __name__ == "__main__":
+    serve(*sys.argv[1:4])
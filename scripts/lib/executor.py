@@ -0,0 +1,110 @@
+import atexit, json, os, select, shutil, socket, struct, subprocess, sys, tempfile, threading
+try: from . import process
+except ImportError: import process
+
+# One privileged helper per CLI invocation. sudo closes inherited fds, so the
+# helper connects back over a unix socket and keeps the terminal as its stdio.
+# Each thread gets a connection of its own, asked for over the first one, so a
+# long command only holds up the thread that runs it.
+class Executor:
+    HEADER = struct.Struct("!I")
+    ENV = "NIXOS_SHELL_EXECUTOR"
+    shared = None
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.connections = []
+        self.directory = tempfile.mkdtemp(prefix="nixos-executor-")
+        path = os.path.join(self.directory, "socket")
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(4)
+        command = [sys.executable, os.path.abspath(__file__), path]
+        if os.geteuid() != 0: command = ["sudo", *command]
+        self.process = subprocess.Popen(command)
+        try: self.control = self.accept()
+        except BaseException:
+            self.close()
+            raise
+        atexit.register(self.close)
+    def accept(self):
+        while not select.select([self.listener], [], [], 0.1)[0]:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Executor exited with {self.process.returncode}")
+        connection, _ = self.listener.accept()
+        self.connections.append(connection)
+        return connection
+    def connection(self):
+        if getattr(self.local, "connection", None) is None:
+            with self.lock:
+                Executor.send(self.control, {"connect": True})
+                self.local.connection = self.accept()
+        return self.local.connection
+    @classmethod
+    def enabled(cls):
+        return cls.shared is not None or bool(os.environ.get(cls.ENV))
+    @classmethod
+    def get(cls):
+        if cls.shared is None: cls.shared = Executor()
+        return cls.shared
+    @classmethod
+    def send(cls, connection, message):
+        payload = json.dumps(message).encode()
+        connection.sendall(cls.HEADER.pack(len(payload)) + payload)
+    @classmethod
+    def receive(cls, connection):
+        header = cls.read_exactly(connection, cls.HEADER.size)
+        if header is None: return None
+        payload = cls.read_exactly(connection, cls.HEADER.unpack(header)[0])
+        return None if payload is None else json.loads(payload)
+    @classmethod
+    def read_exactly(cls, connection, size):
+        buffer = bytearray()
+        while len(buffer) < size:
+            chunk = connection.recv(size - len(buffer))
+            if not chunk: return None
+            buffer += chunk
+        return bytes(buffer)
+    def run(self, cmd, capture_output=True, timeout=None):
+        connection = self.connection()
+        Executor.send(connection, {"cmd": cmd, "capture_output": capture_output, "timeout": timeout})
+        reply = Executor.receive(connection)
+        if reply is None: raise RuntimeError("Executor closed the connection")
+        if reply.get("timed_out"): raise subprocess.TimeoutExpired(cmd, timeout, reply["stdout"], reply["stderr"])
+        result = subprocess.CompletedProcess(cmd, reply["returncode"], reply["stdout"], reply["stderr"])
+        result.rusage = reply["rusage"]
+        return result
+    def close(self):
+        with self.lock:
+            for connection in self.connections: connection.close()
+            self.connections = []
+            self.listener.close()
+            shutil.rmtree(self.directory, ignore_errors=True)
+        self.process.wait()
+        if Executor.shared is self: Executor.shared = None
+
+def connect(path):
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(path)
+    return connection
+
+def serve(path):
+    # The first connection only asks for more; it closing means the client is done.
+    control = connect(path)
+    with control:
+        while Executor.receive(control) is not None:
+            threading.Thread(target=handle, args=(connect(path),)).start()
+
+def handle(connection):
+    with connection:
+        while (request := Executor.receive(connection)) is not None:
+            try: result = process.run(request["cmd"], capture_output=request["capture_output"],
+                                      timeout=request.get("timeout"))
+            except subprocess.TimeoutExpired as e:
+                Executor.send(connection, {"timed_out": True, "stdout": e.stdout, "stderr": e.stderr})
+                continue
+            Executor.send(connection, {"returncode": result.returncode, "stdout": result.stdout,
+                                       "stderr": result.stderr, "rusage": result.rusage})
+
+if __name__ == "__main__":
+    serve(sys.argv[1])
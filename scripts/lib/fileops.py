@@ -0,0 +1,146 @@
+import atexit, errno, fnmatch, functools, grp, os, pwd, re, shutil, stat, sys, threading
+from .replay import Recording
+
+class FileOps:
+    ENV = "NIXOS_SHELL_STATS"
+    TYPES = {stat.S_IFREG: "file", stat.S_IFDIR: "directory", stat.S_IFLNK: "symlink",
+             stat.S_IFBLK: "block", stat.S_IFCHR: "char", stat.S_IFIFO: "fifo", stat.S_IFSOCK: "socket"}
+    DIRECTORY = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+    stats: dict = {}
+    lock = threading.Lock()
+    @classmethod
+    def available(cls):
+        return os.geteuid() == 0 and not Recording.active()
+    @classmethod
+    def record(cls, operation, count, seconds):
+        with cls.lock:
+            calls, paths, total = cls.stats.get(operation, (0, 0, 0.0))
+            cls.stats[operation] = (calls + 1, paths + count, total + seconds)
+    @classmethod
+    def summary(cls):
+        return [f"{operation}: {calls} calls, {paths} paths, {total * 1000:.1f}ms"
+                for operation, (calls, paths, total) in sorted(cls.stats.items())]
+    @classmethod
+    def print_summary(cls):
+        for line in cls.summary(): print(f"\033[90mLOG: {line}\033[0m", file=sys.stderr)
+    # Operations
+    @classmethod
+    def rm(cls, paths):
+        for path in paths:
+            try: info = os.lstat(path)
+            except (FileNotFoundError, NotADirectoryError): continue
+            if stat.S_ISDIR(info.st_mode): shutil.rmtree(path)
+            else: os.unlink(path)
+        return len(paths)
+    @classmethod
+    def mkdir(cls, paths):
+        for path in paths: os.makedirs(path, exist_ok=True)
+        return len(paths)
+    @classmethod
+    def mv(cls, original, final):
+        if os.path.isdir(final): final = os.path.join(final, os.path.basename(original.rstrip("/")))
+        try: os.rename(original, final)
+        except OSError as e:
+            if e.errno != errno.EXDEV: raise
+            shutil.move(original, final)
+        return 1
+    @classmethod
+    def cpdir(cls, source, target):
+        if os.path.islink(source): os.symlink(os.readlink(source), target)
+        elif os.path.isdir(source): shutil.copytree(source, target, symlinks=True, copy_function=shutil.copy)
+        else: shutil.copy(source, target)
+        return 1
+    @classmethod
+    def symlink(cls, source, target):
+        if os.path.isdir(target): target = os.path.join(target, os.path.basename(source.rstrip("/")))
+        os.symlink(source, target)
+        return 1
+    @classmethod
+    def chmod(cls, mode, paths, recursive=True):
+        def apply(name, dir_fd, is_link):
+            if not is_link: os.chmod(name, mode, dir_fd=dir_fd)
+        return cls.recursive(paths, apply, recursive)
+    @classmethod
+    def chown(cls, uid, gid, paths, recursive=True):
+        def apply(name, dir_fd, is_link):
+            os.chown(name, uid, gid, dir_fd=dir_fd, follow_symlinks=not is_link)
+        return cls.recursive(paths, apply, recursive)
+    @classmethod
+    def lchown(cls, uid, gid, paths):
+        for path in paths: os.chown(path, uid, gid, follow_symlinks=False)
+        return len(paths)
+    @classmethod
+    def stat(cls, path, host_path):
+        try: info = os.lstat(host_path)
+        except (FileNotFoundError, NotADirectoryError): return cls.entry(path)
+        kind = cls.TYPES.get(stat.S_IFMT(info.st_mode))
+        return cls.entry(path, kind, stat.S_IMODE(info.st_mode), info.st_uid, info.st_gid, info.st_size,
+                         info.st_mtime, os.readlink(host_path) if kind == "symlink" else None)
+    @classmethod
+    def entry(cls, path, kind=None, mode=None, uid=None, gid=None, size=None, mtime=None, target=None):
+        return {"path": path, "exists": kind is not None, "type": kind, "mode": mode, "uid": uid,
+                "gid": gid, "size": size, "mtime": mtime, "target": target}
+    @classmethod
+    def find(cls, top, include, ignore, prune, kind=None, root=""):
+        info = os.lstat(f"{root}{top}")
+        stack = [(top, stat.S_ISDIR(info.st_mode), stat.S_ISREG(info.st_mode))]
+        while stack:
+            path, is_dir, is_file = stack.pop()
+            ignored = ignore is not None and ignore.match(path)
+            wanted = kind is None or (is_dir if kind == "d" else is_file)
+            if wanted and not ignored and (include is None or include.match(path)): yield path
+            if not is_dir or (ignored and prune is not None and prune.match(path)): continue
+            with os.scandir(f"{root}{path}") as entries:
+                children = [(f"{path.rstrip('/')}/{entry.name}", entry.is_dir(follow_symlinks=False),
+                             entry.is_file(follow_symlinks=False)) for entry in entries]
+            stack.extend(reversed(children))
+    # Helpers
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def patterns(cls, patterns, prunable=False):
+        split = [p for p in (patterns or "").split() if not prunable or p.endswith("*")]
+        if not split: return None
+        return re.compile("|".join(f"(?:{fnmatch.translate(p)})" for p in split))
+    @classmethod
+    def recursive(cls, paths, apply, recursive=True):
+        count = 0
+        for path in paths:
+            apply(path, None, False)
+            count += 1
+            if not recursive or not os.path.isdir(path): continue
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                for dir_fd, entry in cls.walk(fd):
+                    apply(entry.name, dir_fd, entry.is_symlink())
+                    count += 1
+            finally: os.close(fd)
+        return count
+    @classmethod
+    def walk(cls, fd):
+        with os.scandir(fd) as entries:
+            for entry in entries:
+                yield fd, entry
+                if not entry.is_dir(follow_symlinks=False): continue
+                child = os.open(entry.name, cls.DIRECTORY, dir_fd=fd)
+                try: yield from cls.walk(child)
+                finally: os.close(child)
+    @classmethod
+    def mode(cls, mode):
+        return int(str(mode), 8)
+    @classmethod
+    def owner(cls, spec, root=""):
+        user, _, group = str(spec).partition(":")
+        uid = cls.lookup(user, f"{root}/etc/passwd", pwd.getpwnam, root) if user else -1
+        gid = cls.lookup(group, f"{root}/etc/group", grp.getgrnam, root) if group else -1
+        return uid, gid
+    @classmethod
+    def lookup(cls, name, database, fallback, root):
+        if name.isdigit(): return int(name)
+        if not root: return fallback(name)[2]
+        with open(database, encoding="utf-8") as f:
+            for line in f:
+                fields = line.split(":")
+                if len(fields) > 2 and fields[0] == name: return int(fields[2])
+        raise KeyError(name)
+
+if os.environ.get(FileOps.ENV): atexit.register(FileOps.print_summary)
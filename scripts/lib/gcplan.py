@@ -0,0 +1,105 @@
+import collections, datetime, re
+from .shell import Shell
+
+# Chooses which system and home-manager generations to delete before anything
+# is deleted. Each profile's generations are listed with `nix-env
+# --list-generations`, their closures come from one `nix path-info --recursive`
+# per profile (run in parallel, with one more for the other GC roots), and
+# sizes are counted once per store path: a generation's unique size is what
+# only it keeps alive, and a plan's reclaimable size is what no kept
+# generation or other root still needs. The current generation of every
+# profile is always kept; keep_last and keep_days protect more, and free_bytes
+# stops deleting, oldest first, once that much would be reclaimed.
+class GcPlan:
+    KEEP_LAST = 3
+    SYSTEM = "/nix/var/nix/profiles/system"
+    HOME_MANAGER = ["/home/{user}/.local/state/nix/profiles/home-manager",
+                    "/nix/var/nix/profiles/per-user/{user}/home-manager"]
+    GENERATION = re.compile(r"^\s*(\d+)\s+(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\s*(\(current\))?")
+    def __init__(self, sh, users=(), keep_last=None, keep_days=None, free_bytes=None):
+        self.sh = sh
+        self.keep_last, self.keep_days, self.free_bytes = keep_last, keep_days, free_bytes
+        self.profiles = [GcPlan.SYSTEM, *[path for user in users for path in
+                                          (template.format(user=user) for template in GcPlan.HOME_MANAGER)
+                                          if sh.exists(path)]]
+        self.generations = [generation for profile in self.profiles for generation in self.list(profile)]
+        self.infos, self.alive = self.closures()
+        for generation in self.generations: generation["closure"] = self.closure(generation["path"])
+        # How many generations keep each store path alive.
+        self.counts = collections.Counter(path for generation in self.generations
+                                          for path in generation["closure"])
+        for generation in self.generations:
+            generation["unique"] = self.size(path for path in generation["closure"]
+                                             if self.counts[path] == 1 and path not in self.alive)
+        self.choose()
+    def list(self, profile):
+        generations = []
+        for line in Shell.stdout(self.sh.run(["nix-env", "-p", profile, "--list-generations"])).splitlines():
+            if not (match := GcPlan.GENERATION.match(line)): continue
+            number, date, current = match.groups()
+            generations.append({"profile": profile, "number": int(number), "current": current is not None,
+                                "date": datetime.datetime.strptime(date, "%Y-%m-%d %H:%M:%S")})
+        links = self.sh.realpaths(*[f"{profile}-{generation['number']}-link" for generation in generations])
+        for generation, path in zip(generations, links): generation["path"] = path
+        return generations
+    def closures(self):
+        # path-info for every generation and every other GC root, one profile per process.
+        prefixes = tuple(f"{profile}-" for profile in self.profiles)
+        roots = sorted({root.partition(" -> ")[2] for root in Shell.stdout(self.sh.run(
+            ["nix-store", "--gc", "--print-roots"], read_only=True)).splitlines()
+                        if " -> " in root and not root.startswith(prefixes) and "{censored}" not in root})
+        groups = [[generation["path"] for generation in self.generations if generation["profile"] == profile]
+                  for profile in self.profiles]
+        infos = self.sh.path_info(*groups, roots)
+        return infos, self.closure(*roots, infos=infos)
+    def closure(self, *paths, infos=None):
+        infos = self.infos if infos is None else infos
+        seen, stack = set(), [path for path in paths if path in infos]
+        while stack:
+            if (path := stack.pop()) in seen: continue
+            seen.add(path)
+            stack.extend(reference for reference in infos[path].get("references", ()) if reference in infos)
+        return seen
+    def size(self, paths):
+        return sum(self.infos[path].get("narSize", 0) for path in paths)
+    def protected(self, generation):
+        if generation["current"]: return "current"
+        newer = [other for other in self.generations
+                 if other["profile"] == generation["profile"] and other["number"] > generation["number"]]
+        if self.keep_last is not None and len(newer) < self.keep_last: return f"last {self.keep_last}"
+        if self.keep_days is not None and generation["date"] > datetime.datetime.now() - datetime.timedelta(
+                days=self.keep_days): return f"newer than {self.keep_days:g} days"
+        return None
+    def choose(self):
+        kept, self.freed = collections.Counter(self.counts), 0
+        for generation in self.generations:
+            generation["keep"] = self.protected(generation)
+            generation["delete"] = False
+        for generation in sorted((generation for generation in self.generations if not generation["keep"]),
+                                 key=lambda generation: (generation["date"], generation["number"])):
+            if self.free_bytes is not None and self.freed >= self.free_bytes: break
+            generation["delete"] = True
+            for path in generation["closure"]:
+                kept[path] -= 1
+                if kept[path] == 0 and path not in self.alive: self.freed += self.infos[path].get("narSize", 0)
+    def describe(self):
+        lines = [f"{'PROFILE':48} {'GEN':>5}  {'DATE':16} {'UNIQUE':>10}  ACTION"]
+        for generation in self.generations:
+            action = "delete" if generation["delete"] else f"keep ({generation['keep'] or 'enough freed'})"
+            lines.append(f"{generation['profile']:48} {generation['number']:>5}  "
+                         f"{generation['date']:%Y-%m-%d %H:%M} {GcPlan.human(generation['unique']):>10}  {action}")
+        deleted = [generation for generation in self.generations if generation["delete"]]
+        lines.append(f"Deleting {len(deleted)} of {len(self.generations)} generations frees "
+                     f"{GcPlan.human(self.freed)}.")
+        return lines
+    def apply(self):
+        for profile in self.profiles:
+            numbers = [str(generation["number"]) for generation in self.generations
+                       if generation["profile"] == profile and generation["delete"]]
+            if numbers: self.sh.run(["nix-env", "-p", profile, "--delete-generations", *numbers])
+        self.sh.run(["nix-store", "--gc"], capture_output=False)
+    @classmethod
+    def human(cls, size):
+        for unit in ("B", "KiB", "MiB", "GiB"):
+            if size < 1024 or unit == "GiB": return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+            size /= 1024
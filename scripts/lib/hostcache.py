@@ -0,0 +1,31 @@
+import json, os
+from .replay import Recording
+from .shell import Shell
+
+# A JSON cache kept on the host under /var/cache/nixos-scripts. Its
+# environment variable moves it and an empty value disables it, as does a
+# recorded or replayed run, whose commands never ran on this machine. A
+# missing or damaged file reads as a miss; writes are atomic and best effort.
+class HostCache:
+    ROOT = "/var/cache/nixos-scripts"
+    # Not chrootable: the cache is the host's even while a Shell works in a chroot.
+    sh = Shell()
+    def __init__(self, env, name):
+        self.env = env
+        self.default = os.path.join(HostCache.ROOT, name)
+    def location(self):
+        if Recording.active(): return None
+        return os.environ.get(self.env, self.default) or None
+    @classmethod
+    def read(cls, path):
+        if path is None: return False, None
+        try:
+            with open(path, encoding="utf-8") as f: return True, json.load(f)
+        except (OSError, ValueError): return False, None
+    @classmethod
+    def write(cls, path, value):
+        if path is None: return
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+            cls.sh.json_overwrite(path, value, fsync=False, show=False)
+        except OSError: pass
@@ -0,0 +1,73 @@
+import collections, os, shlex, sys, threading
+
+class Memo:
+    ENV = "NIXOS_SHELL_STATS"
+    PURE = {"who", "whoami", "hostname", "id", "uname", "realpath", "readlink",
+            "basename", "dirname", "stat", "test", "["}
+    # Commands known to write at most these paths, so only memoized queries under
+    # them go stale: evaluations may fetch flake inputs into the store.
+    WRITES = {("nix", "eval"): ("/nix/store",), ("nix", "metadata"): ("/nix/store",),
+              ("nix", "path-info"): (), ("journalctl", None): ()}
+    SHELL_SYNTAX = set(";|&<>`$")
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        # Update pipeline stages share one memo across threads.
+        self.lock = threading.RLock()
+        self.hits = self.misses = self.invalidations = 0
+    @classmethod
+    def words(cls, cmd):
+        if not isinstance(cmd, str): return list(cmd)
+        if cls.SHELL_SYNTAX & set(cmd): return None
+        try: return shlex.split(cmd)
+        except ValueError: return None
+    @classmethod
+    def classify(cls, cmd):
+        words = cls.words(cmd)
+        if not words or words[0] not in cls.PURE: return None
+        return tuple(os.path.normpath(word) for word in words[1:] if word.startswith("/"))
+    @classmethod
+    def writes(cls, cmd):
+        # None for commands that may write anywhere.
+        words = cmd.split() if isinstance(cmd, str) else list(cmd)
+        return next((paths for (program, verb), paths in cls.WRITES.items()
+                     if words and program == words[0] and (verb is None or verb in words)), None)
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return True, self.entries[key][0]
+    def put(self, key, value, paths=(), tree=False):
+        # tree: the value depends on everything below paths, not just on the paths themselves.
+        with self.lock:
+            self.entries[key] = (value, tuple(paths), tree)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size: self.entries.popitem(last=False)
+        return value
+    def invalidate(self, *paths):
+        changed = [os.path.normpath(path) for path in paths]
+        def stale(cached, tree):
+            return any(path == other or path.startswith(other.rstrip("/") + "/")
+                       or tree and other.startswith(path.rstrip("/") + "/")
+                       for path in cached for other in changed)
+        self.discard(stale)
+    def invalidate_paths(self):
+        self.drop(bool)
+    def drop(self, predicate):
+        self.discard(lambda paths, tree: predicate(paths))
+    def discard(self, stale):
+        with self.lock:
+            keys = [key for key, (_, paths, tree) in self.entries.items() if stale(paths, tree)]
+            for key in keys: del self.entries[key]
+            self.invalidations += len(keys)
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations,
+                "entries": len(self.entries), "hit_rate": self.hits / lookups if lookups else 0.0}
+    def print_stats(self):
+        stats = self.stats()
+        print(f"\033[90mLOG: memo: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate']:.0%}), {stats['invalidations']} invalidations\033[0m", file=sys.stderr)
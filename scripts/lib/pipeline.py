@@ -0,0 +1,78 @@
+import concurrent.futures, time
+from .deadline import Deadline
+
+class Stage:
+    def __init__(self, name, function, needs=(), exclusive=False, timeout=None):
+        self.name = name
+        self.function = function
+        self.needs = tuple(needs)
+        self.exclusive = exclusive
+        self.timeout = timeout
+        self.result = None
+        self.started = None
+        self.seconds = None
+
+# Named stages with dependencies. A stage starts once every stage it needs has
+# finished, so independent stages overlap on a thread pool; an exclusive stage
+# waits for the pool to drain and runs alone. Needs naming a stage that was
+# never added are ignored, so optional stages can be left out. Shell keeps its
+# plan and chroot stacks per instance, so stages running on the same Shell must
+# be ordered through `needs`; anything else should run on a Shell.fork(). Every
+# stage starts under the deadlines of the thread that called run(), plus a
+# "<name> stage" deadline of its own when it has a timeout, given to add() or
+# by name in `timeouts`.
+class Pipeline:
+    WORKERS = 4
+    def __init__(self, workers=None, timeouts=None):
+        self.workers = workers or Pipeline.WORKERS
+        self.timeouts = timeouts or {}
+        self.stages = {}
+        self.started = None
+        self.seconds = None
+    def add(self, name, function, needs=(), exclusive=False, timeout=None):
+        if name in self.stages: raise ValueError(f"Duplicate stage '{name}'")
+        self.stages[name] = Stage(name, function, needs, exclusive,
+                                  self.timeouts.get(name) if timeout is None else timeout)
+        return self.stages[name]
+    def run(self):
+        pending, running, done, deadlines = dict(self.stages), {}, set(), list(Deadline.stack())
+        self.started = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            try:
+                while pending or running:
+                    for stage in self.ready(pending, running, done):
+                        del pending[stage.name]
+                        running[pool.submit(self.execute, stage, deadlines)] = stage
+                    if not running: raise RuntimeError(f"Stages {', '.join(pending)} wait on each other")
+                    finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        future.result()
+                        done.add(running.pop(future).name)
+            finally:
+                for future in running: future.cancel()
+                self.seconds = time.monotonic() - self.started
+        return {name: stage.result for name, stage in self.stages.items()}
+    def ready(self, pending, running, done):
+        ready = []
+        for stage in pending.values():
+            if any(need in self.stages and need not in done for need in stage.needs): continue
+            if any(other.exclusive for other in [*running.values(), *ready]): break
+            if stage.exclusive and (running or ready): break
+            ready.append(stage)
+        return ready
+    def execute(self, stage, deadlines=()):
+        stage.started = time.monotonic()
+        try:
+            with Deadline.inherit(deadlines), Deadline.scope(stage.timeout, f"{stage.name} stage"):
+                stage.result = stage.function()
+        finally: stage.seconds = time.monotonic() - stage.started
+        return stage.result
+    def report(self):
+        # One line per stage: offset from the start, duration, and name.
+        stages = sorted((stage for stage in self.stages.values() if stage.started is not None),
+                        key=lambda stage: stage.started)
+        busy = sum(stage.seconds or 0 for stage in stages)
+        lines = [f"{'+' + format(stage.started - self.started, '.1f'):>8}s {stage.seconds or 0:8.1f}s  {stage.name}"
+                 for stage in stages]
+        lines.append(f"{self.seconds or 0:18.1f}s  total ({busy:.1f}s of stage time)")
+        return lines
@@ -0,0 +1,141 @@
+import itertools, subprocess
+from .fileops import FileOps
+from .process import display
+
+def lineage(path):
+    path = path.rstrip("/") or "/"
+    while True:
+        yield path
+        if path in ("/", "."): return
+        path = path.rpartition("/")[0] or "/"
+
+class Step:
+    MERGEABLE = {"rm", "mkdir", "chmod", "chown", "lchown"}
+    def __init__(self, kind, paths, argument=None, recursive=True, cmd=None, check=True):
+        self.kind = kind
+        self.paths = None if paths is None else tuple(dict.fromkeys(paths))
+        self.argument = argument
+        self.recursive = recursive
+        self.cmd = cmd
+        self.check = check
+        self.result = None
+        self.footprint = None if paths is None else {path.rstrip("/") or "/" for path in self.paths}
+    def key(self):
+        if self.kind not in Step.MERGEABLE: return None
+        return self.kind, self.argument, self.recursive or self.kind == "rm"
+    def overlaps(self, other):
+        return (any(parent in other.footprint for path in self.paths for parent in lineage(path))
+                or any(parent in self.footprint for path in other.paths for parent in lineage(path)))
+    def conflicts(self, other):
+        if self.paths is None or other.paths is None: return True
+        if self.kind == "chmod" and other.kind in ("chown", "lchown"): return False
+        if other.kind == "chmod" and self.kind in ("chown", "lchown"): return False
+        return self.overlaps(other)
+    def covers(self, other):
+        if self.key() is None or self.key() != other.key(): return False
+        if self.kind == "mkdir":
+            created = {parent for path in self.paths for parent in lineage(path)}
+            return all((path.rstrip("/") or "/") in created for path in other.paths)
+        if self.key()[2]: return all(any(parent in self.footprint for parent in lineage(path)) for path in other.paths)
+        return other.footprint <= self.footprint
+    def pruned(self):
+        # Within one merged step, drop paths already implied by another path.
+        if self.kind == "mkdir":
+            parents = {parent for path in self.paths for parent in itertools.islice(lineage(path), 1, None)}
+            return [path for path in self.paths if (path.rstrip("/") or "/") not in parents]
+        if self.key()[2]:
+            return [path for path in self.paths
+                    if not any(parent in self.footprint for parent in itertools.islice(lineage(path), 1, None))]
+        return list(self.paths)
+    def commands(self, batch_size):
+        if self.kind not in Step.MERGEABLE: return [self.cmd]
+        flag = {"rm": ["-rf"], "mkdir": ["-p"], "lchown": ["-h"]}.get(self.kind, ["-R"] if self.recursive else [])
+        program = "chown" if self.kind == "lchown" else self.kind
+        argument = [] if self.argument is None else [self.argument]
+        return [[program, *flag, *argument, "--", *batch] for batch in itertools.batched(self.pruned(), batch_size)]
+    @classmethod
+    def merge(cls, steps):
+        first = steps[0]
+        return cls(first.kind, [path for step in steps for path in step.paths],
+                   first.argument, first.recursive)
+
+# Operations recorded while a plan is open are not executed. They are
+# deduplicated, ordered by the paths they touch and merged into one command per
+# kind and argument for each stage, and run when the plan closes. Steps within
+# a stage touch disjoint paths and run concurrently. Queries still execute
+# immediately and see the tree as it was before the pending operations.
+class Plan:
+    def __init__(self, shell, dry_run=False):
+        self.shell = shell
+        self.dry_run = dry_run
+        self.steps = []
+    def add(self, kind, paths, argument=None, recursive=True, cmd=None, check=True):
+        step = Step(kind, paths, argument, recursive, cmd, check)
+        if self.dry_run and kind not in Step.MERGEABLE: step.result = subprocess.CompletedProcess(cmd, 0, "", "")
+        self.steps.append(step)
+        return step
+    def command(self, cmd, writes=(), check=True):
+        return self.add("run", writes, cmd=cmd, check=check)
+    def optimized(self):
+        kept = []
+        for step in self.steps:
+            for earlier in reversed(kept):
+                if earlier.covers(step): break
+                if earlier.conflicts(step):
+                    kept.append(step)
+                    break
+            else: kept.append(step)
+        return kept
+    def stages(self):
+        steps = self.optimized()
+        levels = []
+        for index, step in enumerate(steps):
+            levels.append(max((levels[earlier] + 1 for earlier in range(index)
+                               if steps[earlier].conflicts(step)), default=0))
+        stages = [[] for _ in range(max(levels, default=-1) + 1)]
+        for level, step in zip(levels, steps): stages[level].append(step)
+        merged = []
+        for stage in stages:
+            groups = {}
+            for step in stage: groups.setdefault(step.key() or id(step), []).append(step)
+            merged.append([Step.merge(group) if group[0].key() else group[0] for group in groups.values()])
+        return merged
+    def describe(self, stages):
+        before = sum(len(step.commands(self.shell.BATCH_SIZE)) for step in self.steps)
+        after = sum(len(step.commands(self.shell.BATCH_SIZE)) for stage in stages for step in stage)
+        lines = [f"plan: {len(self.steps)} operations, {before} commands -> {after} commands in {len(stages)} stages"]
+        for number, stage in enumerate(stages, 1):
+            lines.extend(f"  [{number}] {display(cmd)}" for step in stage for cmd in step.commands(self.shell.BATCH_SIZE))
+        return lines
+    def flush(self):
+        if not self.steps: return
+        stages = self.stages()
+        for line in self.describe(stages): print(f"\033[90mLOG: {line}\033[0m")
+        self.steps = []
+        if self.dry_run: return
+        previous, self.shell.planning = self.shell.planning, None
+        try:
+            for stage in stages: self.execute(stage)
+        finally: self.shell.planning = previous
+    def execute(self, stage):
+        shell = self.shell
+        if FileOps.available() or (shell.sessions and shell.sessions[-1]):
+            for step in stage: self.apply(step)
+            return
+        steps = [(step, cmd) for step in stage for cmd in step.commands(shell.BATCH_SIZE)]
+        writes = None if any(step.paths is None for step in stage) else [path for step in stage for path in step.paths]
+        results = shell.run_many([cmd for _, cmd in steps], on_error="collect", writes=writes)
+        for (step, _), result in zip(steps, results):
+            if step.kind == "run": step.result = result
+            if result.returncode != 0 and step.check:
+                error = subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+                shell.log_failure(error, None)
+                raise error
+    def apply(self, step):
+        shell = self.shell
+        if step.kind == "run": step.result = shell.run(step.cmd, check=step.check)
+        elif step.kind in ("chmod", "chown"):
+            getattr(shell, step.kind)(step.argument, *step.pruned(), recursive=step.recursive)
+        elif step.kind == "lchown": shell.lchown(step.argument, *step.pruned())
+        elif step.kind in Step.MERGEABLE: getattr(shell, step.kind)(*step.pruned())
+        else: getattr(shell, step.kind)(*step.argument)
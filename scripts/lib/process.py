@@ -0,0 +1,73 @@
+import contextlib, os, shlex, signal, subprocess, threading, time
+
+GRACE = 2.0
+
+# Popen whose child is reaped with os.wait4, so its resource usage is kept.
+class Process(subprocess.Popen):
+    rusage = None
+    def __init__(self, *args, **kwargs):
+        self.reaping = threading.Lock()
+        super().__init__(*args, **kwargs)
+        self.group = kwargs.get("start_new_session", False)
+    def poll(self):
+        return self.reap(blocking=False)
+    def wait(self, timeout=None):
+        if timeout is None: return self.reap()
+        deadline = time.monotonic() + timeout
+        while self.reap(blocking=False) is None:
+            if time.monotonic() >= deadline: raise subprocess.TimeoutExpired(self.args, timeout)
+            time.sleep(0.005)
+        return self.returncode
+    def reap(self, blocking=True):
+        # A poll while another thread waits sees the child as still running.
+        if not self.reaping.acquire(blocking): return self.returncode
+        try:
+            if self.returncode is not None: return self.returncode
+            try: pid, status, rusage = os.wait4(self.pid, 0 if blocking else os.WNOHANG)
+            except ChildProcessError: pid, status, rusage = self.pid, 0, None
+            if pid == 0: return None
+            self.returncode = os.waitstatus_to_exitcode(status)
+            if rusage is not None: self.rusage = usage(rusage)
+            return self.returncode
+        finally: self.reaping.release()
+    def kill(self):
+        # Ctrl-C in the parent cannot reach a child in its own session; take its group with it.
+        if self.group:
+            with contextlib.suppress(ProcessLookupError, PermissionError): os.killpg(self.pid, signal.SIGKILL)
+        super().kill()
+    def stop(self, grace=GRACE):
+        # SIGTERM first: sudo relays it to the root-owned command, which an
+        # unprivileged SIGKILL to the process group cannot reach.
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            with contextlib.suppress(ProcessLookupError, PermissionError):
+                if self.group: os.killpg(self.pid, sig)
+                else: self.send_signal(sig)
+            try: return self.wait(grace)
+            except subprocess.TimeoutExpired: pass
+        return self.returncode
+
+def usage(rusage):
+    return {"user": rusage.ru_utime, "sys": rusage.ru_stime, "maxrss_kb": rusage.ru_maxrss,
+            "inblock": rusage.ru_inblock, "oublock": rusage.ru_oublock}
+
+def display(cmd, env=""):
+    return f"{env} {cmd if isinstance(cmd, str) else shlex.join(cmd)}".strip()
+
+def run(cmd, capture_output=True, timeout=None):
+    # A timed command gets its own session, so expiry can kill its whole group.
+    # Uncaptured commands keep the terminal, for sudo prompts and Ctrl-C.
+    pipe = subprocess.PIPE if capture_output else None
+    with Process(cmd, shell=isinstance(cmd, str), text=True, stdout=pipe, stderr=pipe,
+                 start_new_session=capture_output and timeout is not None) as process:
+        try: stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.stop()
+            try: stdout, stderr = process.communicate(timeout=GRACE)
+            except subprocess.TimeoutExpired: stdout = stderr = None
+            raise subprocess.TimeoutExpired(cmd, timeout, stdout, stderr) from None
+        except BaseException:
+            process.kill()
+            raise
+    result = subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+    result.rusage = process.rusage
+    return result
@@ -0,0 +1,70 @@
+import atexit, collections, gzip, json, os, subprocess, threading, time
+from .process import display
+
+class ReplayMiss(RuntimeError):
+    pass
+
+# NIXOS_SHELL_RECORD=<file> writes every command Shell runs, with its output,
+# exit code and duration, as JSON lines (gzipped for *.gz); argv commands are
+# keyed by their shlex.join. NIXOS_SHELL_REPLAY serves those results back in
+# order without running anything; the last result for a command repeats once
+# its recordings are used up. Set NIXOS_SHELL_REPLAY_LATENCY to also sleep for
+# the recorded durations.
+class Recording:
+    RECORD = "NIXOS_SHELL_RECORD"
+    REPLAY = "NIXOS_SHELL_REPLAY"
+    LATENCY = "NIXOS_SHELL_REPLAY_LATENCY"
+    writer = None
+    entries = None
+    lock = threading.Lock()
+    @classmethod
+    def recording(cls):
+        return bool(os.environ.get(cls.RECORD))
+    @classmethod
+    def replaying(cls):
+        return bool(os.environ.get(cls.REPLAY))
+    @classmethod
+    def active(cls):
+        return cls.recording() or cls.replaying()
+    @classmethod
+    def latency(cls):
+        return bool(os.environ.get(cls.LATENCY))
+    @classmethod
+    def open(cls, path, mode):
+        if path.endswith(".gz"): return gzip.open(path, f"{mode}t", encoding="utf-8")
+        return open(path, mode, encoding="utf-8")
+    @classmethod
+    def record(cls, kind, cmd, returncode, stdout, stderr, seconds):
+        line = json.dumps({"kind": kind, "cmd": display(cmd), "returncode": returncode, "stdout": stdout or "",
+                           "stderr": stderr or "", "seconds": round(seconds, 6)}, separators=(",", ":"))
+        with cls.lock:
+            if cls.writer is None:
+                cls.writer = cls.open(os.environ[cls.RECORD], "w")
+                atexit.register(cls.writer.close)
+            cls.writer.write(f"{line}\n")
+    @classmethod
+    def record_result(cls, kind, result, seconds):
+        cls.record(kind, result.args, result.returncode, result.stdout, result.stderr, seconds)
+    @classmethod
+    def replay(cls, kind, cmd, sleep=True):
+        with cls.lock:
+            if cls.entries is None:
+                cls.entries = collections.defaultdict(collections.deque)
+                with cls.open(os.environ[cls.REPLAY], "r") as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        cls.entries[(entry["kind"], entry["cmd"])].append(entry)
+            queue = cls.entries.get((kind, display(cmd)))
+            if not queue: raise ReplayMiss(f"No recorded {kind} for {cmd!r}")
+            entry = queue.popleft() if len(queue) > 1 else queue[0]
+        if sleep and cls.latency(): time.sleep(entry["seconds"])
+        return entry
+    @classmethod
+    def replay_result(cls, kind, cmd, capture_output=True, sleep=True):
+        entry = cls.replay(kind, cmd, sleep)
+        stdout, stderr = entry["stdout"], entry["stderr"]
+        if not capture_output: stdout = stderr = None
+        result = subprocess.CompletedProcess(cmd, entry["returncode"], stdout, stderr)
+        result.rusage = None
+        result.seconds = entry["seconds"]
+        return result
@@ -0,0 +1,45 @@
+import os, secrets, shlex, subprocess, time
+from .process import GRACE
+
+# One long-lived nixos-enter shell per chroot. Each command runs in its own
+# `bash -c` inside it (argv commands run as a simple command, unparsed), writes
+# its output to files under the chroot's /tmp and reports its exit code on the
+# session's stdout after a per-session marker. Its stdin is /dev/null, so
+# Shell.run only sends captured commands here.
+class ChrootSession:
+    def __init__(self, root):
+        self.root = root
+        self.marker = f"__NIXOS_SHELL_{secrets.token_hex(8)}__"
+        self.directory = f"/tmp/{self.marker}"
+        command = ["nixos-enter", "--root", root, "--command", "exec bash --noprofile --norc"]
+        if os.geteuid() != 0: command = ["sudo", *command]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        text=True, bufsize=1)
+        self.send(f"mkdir -p -m 755 {self.directory}")
+    def run(self, cmd, timeout=None):
+        stdout, stderr = f"{self.directory}/stdout", f"{self.directory}/stderr"
+        limit = "" if timeout is None else f"timeout --kill-after={GRACE:g} {timeout:.3f} "
+        line = f"bash -c {shlex.quote(cmd)}" if isinstance(cmd, str) else shlex.join(cmd)
+        started = time.monotonic()
+        returncode = self.send(f"{limit}{line} </dev/null >{stdout} 2>{stderr}")
+        stdout, stderr = self.read(stdout), self.read(stderr)
+        if timeout is not None and returncode in (124, 137) and time.monotonic() - started >= timeout:
+            raise subprocess.TimeoutExpired(cmd, timeout, stdout, stderr)
+        return subprocess.CompletedProcess(cmd, returncode, stdout, stderr)
+    def send(self, line):
+        if self.process.poll() is not None:
+            raise RuntimeError(f"Chroot session for {self.root} exited with {self.process.returncode}")
+        self.process.stdin.write(f"{line}; echo \"{self.marker} $?\"\n")
+        for output in self.process.stdout:
+            if output.startswith(self.marker): return int(output.split()[1])
+        raise RuntimeError(f"Chroot session for {self.root} closed unexpectedly")
+    def read(self, path):
+        try:
+            with open(f"{self.root}{path}", encoding="utf-8", errors="replace") as f: return f.read()
+        except FileNotFoundError: return ""
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.write(f"rm -rf {self.directory}; exit\n")
+            self.process.stdin.close()
+            self.process.wait()
+        self.process.stdout.close()
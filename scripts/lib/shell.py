@@ -1,15 +1,40 @@
+import asyncio
+import atexit
 import contextlib
+import errno
+import io
 import itertools
 import json
+import os
+import shlex
+import signal
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+from .deadline import Deadline, DeadlineExceeded
+from .executor import Executor
+from .fileops import FileOps
+from .memo import Memo
+from .plan import Plan
+from .replay import Recording
+from .session import ChrootSession
+from .tracing import Tracer
+from . import process
 
 
 class Shell:
     evals = {}
+    memo = Memo()
     BATCH_SIZE = 64
+    FIND_TYPES = {"f": "file", "d": "directory", "l": "symlink", "b": "block",
+                  "c": "char", "p": "fifo", "s": "socket"}
     def __init__(self, root_required=False):
         self.chroots = []
+        self.sessions = []
+        self.planning = None
         if root_required:
             self.require_root()
     @classmethod
@@ -17,17 +42,19 @@ class Shell:
         return completed_process.stdout.strip()
     # User
     def require_root(self):
-        if Shell.stdout(self.run("id -u")) != "0":
+        if Shell.stdout(self.run(["id", "-u"])) != "0":
             print("Please run this script with sudo.", file=sys.stderr)
             sys.exit(1)
     def whoami(self):
-        return Shell.stdout(self.run("who")).split()[0]
+        return Shell.stdout(self.run(["who"])).split()[0]
     def hostname(self):
-        return Shell.stdout(self.run("hostname"))
+        return Shell.stdout(self.run(["hostname"]))
     # Execution
     @contextlib.contextmanager
-    def chroot(self, path):
+    def chroot(self, path, session=False):
         previous_shells = {}
+        if self.planning: self.planning.flush()
+        self.sessions.append(ChrootSession(path) if session and not Recording.active() else None)
         try:
             self.chroots.append(path)
             for cls in chrootable_registry:
@@ -35,126 +62,526 @@ class Shell:
                 cls.sh = self
             yield self
         finally:
+            if self.planning: self.planning.flush()
             for cls, old_sh in previous_shells.items():
                 cls.sh = old_sh
             self.chroots.pop()
+            if (active := self.sessions.pop()) is not None: active.close()
+    def fork(self):
+        # A Shell for another thread: the same chroot, but its own plan and no shared session.
+        shell = Shell()
+        shell.chroots = list(self.chroots)
+        shell.sessions = [None] * len(self.sessions)
+        return shell
+    @contextlib.contextmanager
+    def plan(self, dry_run=False):
+        if self.planning is not None:
+            yield self.planning
+            return
+        self.planning = Plan(self, dry_run)
+        try: yield self.planning
+        except BaseException:
+            self.planning = None
+            raise
+        planning, self.planning = self.planning, None
+        planning.flush()
+    def barrier(self, cmd, env="", read_only=False, sensitive=None):
+        # Commands with side effects run after everything planned before them.
+        if self.planning is None or read_only: return None
+        if not env and (Memo.classify(cmd) is not None or Memo.writes(cmd) is not None): return None
+        if self.planning.dry_run:
+            return self.planning.add("run", None, cmd=self.redact(process.display(cmd, env), sensitive)).result
+        self.planning.flush()
+        return None
     def redact(self, text, sensitive):
         if not sensitive: return text
         for secret in (sensitive if isinstance(sensitive, list) else [sensitive]):
             text = text.replace(secret, "***")
         return text
-    def run(self, cmd, env="", sudo=True, capture_output=True, check=True, sensitive=None):
+    def command(self, cmd, env="", sudo=True):
+        # Strings run through /bin/sh; argv lists are exec'd directly, with the
+        # chroot and sudo wrappers as argv prefixes.
+        if not isinstance(cmd, str): return self.argv(cmd, env, sudo)
         if self.chroots:
             escaped = cmd.replace("'", "'\\''")
             cmd = f"nixos-enter --root {self.chroots[-1]} --command '{escaped}'"
-        if sudo: cmd = f"{env} sudo {cmd}".strip()
-        else: cmd = f"{env} {cmd}".strip()
-        print(f"\033[90mLOG: {self.redact(cmd, sensitive)}\033[0m")
+        command = f"{env} {cmd}".strip()
+        if sudo: return command, f"{env} sudo {cmd}".strip()
+        return command, command
+    def argv(self, cmd, env="", sudo=True):
+        command = [*Shell.assignments(env), *cmd]
+        if self.chroots: command = ["nixos-enter", "--root", self.chroots[-1], "--", *command]
+        return command, ["sudo", *command] if sudo else command
+    @classmethod
+    def assignments(cls, env):
+        return ["env", *shlex.split(env)] if env else []
+    def run(self, cmd, env="", sudo=True, capture_output=True, check=True, sensitive=None, timeout=None,
+            read_only=False, writes=None):
+        # read_only: the command writes nothing; writes: the only paths it may write.
+        key = ("run", tuple(self.chroots[-1:]), sudo, cmd if isinstance(cmd, str) else tuple(cmd))
+        paths = self.pure_paths(cmd, env, () if read_only else writes)
+        if (planned := self.barrier(cmd, env, read_only or writes is not None, sensitive)) is not None: return planned
+        if paths is not None and capture_output:
+            hit, result = Shell.memo.get(key)
+            if hit: return self.checked(result, check, sensitive)
+        # A session has no terminal and prints output only after the command exits, so
+        # uncaptured commands (prompts, nixos-install, long builds) get their own nixos-enter.
+        session = self.sessions[-1] if self.sessions and capture_output else None
+        if session: command = cmd = f"{env} {cmd}".strip() if isinstance(cmd, str) else [*Shell.assignments(env), *cmd]
+        else: command, cmd = self.command(cmd, env, sudo)
+        shown = self.redact(process.display(cmd), sensitive)
+        print(f"\033[90mLOG: {f'[{session.root}] ' if session else ''}{shown}\033[0m")
+        deadline, started = Deadline.current(timeout), time.monotonic()
+        remaining = None if deadline is None else deadline.remaining()
+        with Tracer.span(shown) as span:
+            try:
+                if Recording.replaying(): result = Recording.replay_result("run", cmd, capture_output)
+                elif session: result = session.run(command, timeout=remaining)
+                elif sudo and Executor.enabled():
+                    result = Executor.get().run(command, capture_output=capture_output, timeout=remaining)
+                else: result = process.run(cmd, capture_output=capture_output, timeout=remaining)
+            except subprocess.TimeoutExpired as e:
+                span.update({"deadline": str(deadline)})
+                self.expired(DeadlineExceeded(cmd, time.monotonic() - started, deadline, e.output, e.stderr),
+                             sensitive)
+            span.update(Tracer.describe(result))
+        if Recording.recording(): Recording.record_result("run", result, time.monotonic() - started)
+        if paths is not None and capture_output and result.returncode == 0: Shell.memo.put(key, result, paths)
+        return self.checked(result, check, sensitive)
+    def pure_paths(self, cmd, env="", writes=None):
+        # Memoized queries a command may have made stale are dropped before it runs.
+        paths = None if env else Memo.classify(cmd)
+        if paths is None:
+            if writes is None: writes = Memo.writes(cmd)
+            if writes is None: Shell.memo.invalidate_paths()
+            elif writes: Shell.memo.invalidate(*(self.chroot_path(path) for path in writes))
+        else: paths = tuple(self.chroot_path(path) for path in paths)
+        return paths
+    def checked(self, result, check, sensitive):
         try:
-            return subprocess.run(cmd, shell=True, check=check, capture_output=capture_output, text=True)
+            if check: result.check_returncode()
+            return result
         except subprocess.CalledProcessError as e:
-            if e.stdout: print(f"\033[90mLOG: {self.redact(e.stdout, sensitive)}\033[0m")
-            if e.stderr: print(f"\033[38;5;208mERROR: {self.redact(e.stderr, sensitive)}\033[0m", file=sys.stderr)
+            self.log_failure(e, sensitive)
             raise
+    def stream(self, cmd, env="", sudo=True, check=True, sensitive=None, separator=None, timeout=None):
+        self.pure_paths(cmd, env)
+        if self.barrier(cmd, env, sensitive=sensitive) is not None: return
+        _, cmd = self.command(cmd, env, sudo)
+        shown = self.redact(process.display(cmd), sensitive)
+        print(f"\033[90mLOG: {shown}\033[0m")
+        if Recording.active():
+            yield from self.stream_recorded(cmd, check, sensitive, separator)
+            return
+        deadline, started = Deadline.current(timeout), time.monotonic()
+        with tempfile.TemporaryFile() as stderr, Tracer.span(shown) as span:
+            child = process.Process(cmd, shell=isinstance(cmd, str), stdout=subprocess.PIPE, stderr=stderr,
+                                    start_new_session=deadline is not None)
+            expired = threading.Event()
+            def stop():
+                expired.set()
+                child.stop()
+            timer = None if deadline is None else threading.Timer(deadline.remaining(), stop)
+            if timer: timer.start()
+            drained = False
+            try:
+                if separator is None:
+                    for line in io.TextIOWrapper(child.stdout, encoding="utf-8", errors="replace"):
+                        yield line.rstrip("\n")
+                else:
+                    pending = b""
+                    while chunk := child.stdout.read1(65536):
+                        *records, pending = (pending + chunk).split(separator)
+                        yield from records
+                    if pending: yield pending
+                drained = True
+            finally:
+                # A command may close its output just before it exits; only an abandoned stream kills it.
+                if not drained and child.poll() is None: child.kill()
+                child.stdout.close()
+                returncode = child.wait()
+                if timer: timer.cancel()
+                span.update({"exit": returncode, **(child.rusage or {})})
+            if expired.is_set():
+                stderr.seek(0)
+                self.expired(DeadlineExceeded(cmd, time.monotonic() - started, deadline,
+                                              stderr=stderr.read().decode(errors="replace")), sensitive)
+            if check and returncode != 0:
+                stderr.seek(0)
+                error = subprocess.CalledProcessError(returncode, cmd, stderr=stderr.read().decode(errors="replace"))
+                self.log_failure(error, sensitive)
+                raise error
+    def stream_recorded(self, cmd, check, sensitive, separator):
+        # Recorded streams are captured whole, so the trace replays byte for byte.
+        if Recording.replaying(): result = Recording.replay_result("stream", cmd)
+        else:
+            started = time.monotonic()
+            completed = subprocess.run(cmd, shell=isinstance(cmd, str), capture_output=True, check=False)
+            result = subprocess.CompletedProcess(cmd, completed.returncode,
+                                                 completed.stdout.decode(errors="surrogateescape"),
+                                                 completed.stderr.decode(errors="replace"))
+            Recording.record_result("stream", result, time.monotonic() - started)
+        if separator is None: yield from result.stdout.splitlines()
+        else:
+            records = result.stdout.encode(errors="surrogateescape").split(separator)
+            yield from records[:-1] if records[-1] == b"" else records
+        self.checked(result, check, sensitive)
+    def run_many(self, cmds, concurrency=4, env="", sudo=True, capture_output=True,
+                 on_error="cancel", sensitive=None, timeout=None, writes=None):
+        # writes: the only paths any of the commands may write, as for run.
+        cmds = list(cmds)
+        if self.planning and self.planning.dry_run: return [self.barrier(cmd, env, sensitive=sensitive) for cmd in cmds]
+        for cmd in cmds: self.barrier(cmd, env, writes is not None, sensitive)
+        return asyncio.run(self.run_async(list(cmds), concurrency, env, sudo,
+                                          capture_output, on_error, sensitive, timeout, writes))
+    async def run_async(self, cmds, concurrency, env, sudo, capture_output, on_error, sensitive, timeout=None,
+                        writes=None):
+        for cmd in cmds: self.pure_paths(cmd, env, writes)
+        semaphore = asyncio.Semaphore(concurrency)
+        pipes = {"stdout": subprocess.PIPE, "stderr": subprocess.PIPE, "start_new_session": True}
+        async def execute(cmd):
+            _, cmd = self.command(cmd, env, sudo)
+            shown = self.redact(process.display(cmd), sensitive)
+            async with semaphore:
+                deadline, started = Deadline.current(timeout), time.monotonic()
+                with Tracer.span(shown) as span:
+                    if Recording.replaying():
+                        result = Recording.replay_result("run", cmd, sleep=False)
+                        if Recording.latency(): await asyncio.sleep(result.seconds)
+                    else:
+                        spawn = (asyncio.create_subprocess_shell(cmd, **pipes) if isinstance(cmd, str)
+                                 else asyncio.create_subprocess_exec(*cmd, **pipes))
+                        child = await spawn
+                        try: stdout, stderr = await asyncio.wait_for(
+                            child.communicate(), None if deadline is None else deadline.remaining())
+                        except TimeoutError:
+                            await self.stop_group(child)
+                            span.update({"deadline": str(deadline)})
+                            self.expired(DeadlineExceeded(cmd, time.monotonic() - started, deadline), sensitive)
+                        except asyncio.CancelledError:
+                            with contextlib.suppress(ProcessLookupError): os.killpg(child.pid, signal.SIGKILL)
+                            await child.wait()
+                            raise
+                        result = subprocess.CompletedProcess(cmd, child.returncode, stdout.decode(errors="replace"),
+                                                             stderr.decode(errors="replace"))
+                        if Recording.recording(): Recording.record_result("run", result, time.monotonic() - started)
+            span.update(Tracer.describe(result))
+            print(f"\033[90mLOG: {shown}\033[0m")
+            if not capture_output:
+                if result.stdout: print(result.stdout, end="")
+                if result.stderr: print(result.stderr, end="", file=sys.stderr)
+            if result.returncode == 0 or on_error == "collect": return result
+            error = subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
+            if capture_output: self.log_failure(error, sensitive)
+            raise error
+        tasks = [asyncio.create_task(execute(cmd)) for cmd in cmds]
+        if on_error == "cancel":
+            try: return await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks: task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors: raise errors[0]
+        return results
+    async def stop_group(self, child):
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            with contextlib.suppress(ProcessLookupError, PermissionError): os.killpg(child.pid, sig)
+            try: return await asyncio.wait_for(child.wait(), process.GRACE)
+            except TimeoutError: pass
+        return child.returncode
+    def expired(self, error, sensitive):
+        self.log_failure(error, sensitive)
+        print(f"\033[38;5;208mERROR: {self.redact(str(error), sensitive)}\033[0m", file=sys.stderr)
+        raise error
+    def log_failure(self, error, sensitive):
+        if error.stdout: print(f"\033[90mLOG: {self.redact(error.stdout, sensitive)}\033[0m")
+        if error.stderr: print(f"\033[38;5;208mERROR: {self.redact(error.stderr, sensitive)}\033[0m", file=sys.stderr)
     # File System
     def mv(self, original, final):
         self.mkdir(self.dirname(final))
-        return self.run(f"mv {original} {final}")
+        cmd = ["mv", "--", original, final]
+        if self.planning: return self.planning.add("mv", (original, final), (original, final), cmd=cmd)
+        if self.native(process.display(cmd), (original, final), lambda: FileOps.mv(
+                self.host_path(original, follow=False), self.host_path(final, follow=False))): return None
+        return self.run(cmd)
     def rm(self, *args):
+        if not args: return
+        if self.planning: return self.planning.add("rm", args)
+        if self.native(f"rm -rf {' '.join(args)}", args, lambda: FileOps.rm(
+                [self.host_path(a, follow=False) for a in args])): return
         for batch in itertools.batched(args, Shell.BATCH_SIZE):
-            self.run(f"rm -rf {' '.join(batch)}")
+            self.run(["rm", "-rf", "--", *batch])
     def mkdir(self, *args):
+        if not args: return
+        if self.planning: return self.planning.add("mkdir", args)
+        if self.native(f"mkdir -p {' '.join(args)}", args, lambda: FileOps.mkdir(
+                [self.host_path(a) for a in args])): return
         for batch in itertools.batched(args, Shell.BATCH_SIZE):
-            self.run(f"mkdir -p {' '.join(batch)}")
+            self.run(["mkdir", "-p", "--", *batch])
     def cpdir(self, source, target):
         self.rm(target)
         self.mkdir(self.dirname(target))
-        return self.run(f"cp -r {source} {target}")
+        cmd = ["cp", "-r", "--", source, target]
+        if self.planning: return self.planning.add("cpdir", (source, target), (source, target), cmd=cmd)
+        if self.native(process.display(cmd), (target,), lambda: FileOps.cpdir(
+                self.host_path(source, follow=False), self.host_path(target, follow=False))): return None
+        return self.run(cmd)
     def find(self, path, pattern="*", ignore_pattern=None, ignore_files=False, ignore_directories=False):
+        path = self.realpath(path)
+        kind = "d" if ignore_files else "f" if ignore_directories else None
+        if FileOps.available():
+            return FileOps.find(path, FileOps.patterns(pattern), FileOps.patterns(ignore_pattern),
+                                FileOps.patterns(ignore_pattern, prunable=True), kind,
+                                self.chroots[-1] if self.chroots else "")
         def format_patterns(prefix, patterns):
-            if not patterns: return ""
+            if not patterns: return []
             if " " in patterns:
-                joined = " -o ".join(
-                    f"-path '{p}'" for p in patterns.strip().split())
-                return f"{prefix} \\( {joined} \\)"
-            return f"{prefix} -path '{patterns}'"
-        type_arg = ""
-        if ignore_files: type_arg = "-type d"
-        elif ignore_directories: type_arg = "-type f"
-        pattern_arg = format_patterns("", pattern)
-        ignore_arg = format_patterns("-not", ignore_pattern)
-        path = self.realpath(path)
-        command = f"find '{path}' {pattern_arg} {type_arg} {ignore_arg}"
-        output = Shell.stdout(self.run(command.strip()))
-        return [] if not output else output.split("\n")
+                joined = [*itertools.chain.from_iterable(
+                    ("-o", "-path", p) for p in patterns.strip().split())][1:]
+                return [*prefix, "(", *joined, ")"]
+            return [*prefix, "-path", patterns]
+        type_arg = ["-type", kind] if kind else []
+        pattern_arg = format_patterns([], pattern)
+        ignore_arg = format_patterns(["-not"], ignore_pattern)
+        command = ["find", path, *pattern_arg, *type_arg, *ignore_arg]
+        output = Shell.stdout(self.run(command, read_only=True))
+        return iter([] if not output else output.split("\n"))
     def find_directories(self, path, pattern="*", ignore_pattern=None):
         return self.find(path, pattern=pattern, ignore_pattern=ignore_pattern, ignore_files=True)
     def find_files(self, path, pattern="*", ignore_pattern=None):
         return self.find(path, pattern=pattern, ignore_pattern=ignore_pattern, ignore_directories=True)
     def symlink(self, source, target):
-        return self.run(f"ln -s {source} {target}")
+        cmd = ["ln", "-s", "--", source, target]
+        if self.planning: return self.planning.add("symlink", (target,), (source, target), cmd=cmd)
+        if self.native(process.display(cmd), (target,), lambda: FileOps.symlink(
+                source, self.host_path(target, follow=False))): return None
+        return self.run(cmd)
     def is_symlink(self, path):
-        return self.run(f"[ -L '{path}' ]", check=False).returncode == 0
+        return self.query(
+            lambda: (info := self.lstat(path)) is not None and stat.S_ISLNK(info.st_mode),
+            lambda: self.run(["test", "-L", path], check=False).returncode == 0)
     def realpath(self, path):
-        return Shell.stdout(self.run(f"realpath '{path}'")).splitlines()[0]
+        return self.query(
+            lambda: self.resolve(path),
+            lambda: Shell.stdout(self.run(["realpath", "--", path])).splitlines()[0])
     def realpaths(self, *paths):
+        if not Recording.active():
+            with contextlib.suppress(PermissionError): return [self.resolve(path) for path in paths]
         results = []
         for batch in itertools.batched(paths, Shell.BATCH_SIZE):
-            cmd = "realpath " + " ".join(f"'{p}'" for p in batch)
-            results.extend(Shell.stdout(self.run(cmd)).splitlines())
+            results.extend(Shell.stdout(self.run(["realpath", "--", *batch])).splitlines())
         return results
     def is_dir(self, path):
-        return self.run(f"[ -d '{path}' ]", check=False).returncode == 0
+        return self.query(
+            lambda: (info := self.lstat(path, follow_symlinks=True)) is not None and stat.S_ISDIR(info.st_mode),
+            lambda: self.run(["test", "-d", path], check=False).returncode == 0)
     def exists(self, *args):
+        if not Recording.active():
+            with contextlib.suppress(PermissionError): return all(
+                self.lstat(a, follow_symlinks=True) is not None for a in args)
         for batch in itertools.batched(args, Shell.BATCH_SIZE):
-            cmd = " && ".join(f"[ -e '{a}' ]" for a in batch) + " && true"
-            if self.run(cmd, check=False).returncode != 0: return False
+            # `stat -L` fails if any path (followed through symlinks) is missing.
+            if self.run(["stat", "-L", "--printf=", "--", *batch], check=False, read_only=True).returncode != 0:
+                return False
         return True
+    def stat_many(self, paths):
+        paths = list(paths)
+        if not Recording.active():
+            with contextlib.suppress(PermissionError): return [
+                FileOps.stat(path, self.host_path(path, follow=False)) for path in paths]
+        records = {}
+        for batch in itertools.batched(paths, Shell.BATCH_SIZE * 16):
+            fields = Shell.stdout(self.run(
+                ["find", *batch, "-maxdepth", "0", "-printf", "%p\\0%y\\0%m\\0%U\\0%G\\0%s\\0%T@\\0%l\\0"],
+                check=False, read_only=True)).split("\0")
+            for path, kind, mode, uid, gid, size, mtime, target in itertools.batched(fields[:len(fields) // 8 * 8], 8):
+                records[path] = FileOps.entry(path, Shell.FIND_TYPES.get(kind), int(mode, 8), int(uid), int(gid),
+                                              int(size), float(mtime), target if kind == "l" else None)
+        return [records.get(path) or FileOps.entry(path) for path in paths]
+    def matches(self, path, patterns):
+        regex = FileOps.patterns(patterns)
+        return regex is not None and regex.match(path) is not None
     def basename(self, path):
-        return Shell.stdout(self.run(f"basename '{path}'"))
+        stripped = path.rstrip("/")
+        if not stripped: return "/" if path else ""
+        return os.path.basename(stripped)
     def dirname(self, path):
-        return Shell.stdout(self.run(f"dirname '{path}'"))
+        stripped = path.rstrip("/")
+        if not stripped: return "/" if path else "."
+        return os.path.dirname(stripped).rstrip("/") or ("/" if stripped.startswith("/") else ".")
     def parent_name(self, path):
         return self.basename(self.dirname(path))
+    # Paths
+    def chroot_path(self, path):
+        return f"{self.chroots[-1]}{path}" if self.chroots else path
+    def host_path(self, path, follow=True):
+        if not self.chroots: return path
+        if follow: return self.chroot_path(self.resolve(path))
+        parent = self.resolve(self.dirname(path)).rstrip("/")
+        return self.chroot_path(f"{parent}/{self.basename(path)}")
+    def native(self, command, paths, operation):
+        if not FileOps.available(): return False
+        Shell.memo.invalidate(*map(self.chroot_path, paths))
+        print(f"\033[90mLOG: {command}\033[0m")
+        started = time.monotonic()
+        with Tracer.span(command, category="native") as span:
+            count = operation()
+            span.update({"paths": count})
+        FileOps.record(command.split()[0], count, time.monotonic() - started)
+        return True
+    def query(self, native, fallback):
+        if Recording.active(): return fallback()
+        try: return native()
+        except PermissionError: return fallback()
+    def lstat(self, path, follow_symlinks=False):
+        if follow_symlinks: path = self.resolve(path)
+        path = self.chroot_path(path)
+        hit, info = Shell.memo.get(("lstat", path))
+        if hit: return info
+        try: info = os.lstat(path)
+        except (FileNotFoundError, NotADirectoryError): info = None
+        return Shell.memo.put(("lstat", path), info, (path,))
+    def resolve(self, path):
+        key = ("resolve", tuple(self.chroots[-1:]), path if path.startswith("/") else os.path.abspath(path))
+        hit, resolved = Shell.memo.get(key)
+        if hit: return resolved
+        resolved = self.resolve_links(path)
+        return Shell.memo.put(key, resolved, (self.chroot_path(key[2]), self.chroot_path(resolved)))
+    def resolve_links(self, path):
+        root = self.chroots[-1] if self.chroots else ""
+        pending = list(reversed(os.path.join("/" if root else os.getcwd(), path).split("/")))
+        resolved, hops = "", 0
+        while pending:
+            part = pending.pop()
+            if part in ("", "."): continue
+            if part == "..":
+                resolved = resolved.rpartition("/")[0]
+                continue
+            candidate = f"{resolved}/{part}"
+            try: target = os.readlink(f"{root}{candidate}")
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOENT, errno.ENOTDIR): raise
+                resolved = candidate
+                continue
+            hops += 1
+            if hops > 40: raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), path)
+            if target.startswith("/"): resolved = ""
+            pending.extend(reversed(target.split("/")))
+        return resolved or "/"
     # Security
-    def chmod(self, mode, *args):
-        for batch in itertools.batched(self.realpaths(*args), Shell.BATCH_SIZE):
-            self.run(f"chmod -R {mode} " + " ".join(f"'{p}'" for p in batch))
-    def chown(self, user, *args):
-        for batch in itertools.batched(self.realpaths(*args), Shell.BATCH_SIZE):
-            self.run(f"chown -R {user} " + " ".join(f"'{p}'" for p in batch))
+    def chmod(self, mode, *args, recursive=True):
+        if not args: return
+        if self.planning: return self.planning.add("chmod", args, mode, recursive)
+        flag = "-R " if recursive else ""
+        try: bits = FileOps.mode(mode)
+        except ValueError: bits = None
+        if bits is not None and self.native(f"chmod {flag}{mode} {' '.join(args)}", args, lambda: FileOps.chmod(
+                bits, [self.host_path(a) for a in args], recursive)): return
+        paths = self.realpaths(*args)
+        self.run_many((["chmod", *flag.split(), mode, "--", *batch]
+                       for batch in itertools.batched(paths, Shell.BATCH_SIZE)), writes=paths)
+    def chown(self, user, *args, recursive=True):
+        if not args: return
+        if self.planning: return self.planning.add("chown", args, user, recursive)
+        flag = "-R " if recursive else ""
+        try: owner = FileOps.owner(user, self.chroots[-1] if self.chroots else "")
+        except (KeyError, OSError): owner = None
+        if owner is not None and self.native(f"chown {flag}{user} {' '.join(args)}", args, lambda: FileOps.chown(
+                *owner, [self.host_path(a) for a in args], recursive)): return
+        paths = self.realpaths(*args)
+        self.run_many((["chown", *flag.split(), user, "--", *batch]
+                       for batch in itertools.batched(paths, Shell.BATCH_SIZE)), writes=paths)
+    def lchown(self, user, *args):
+        # Symlinks themselves rather than their targets, as `chown -R` treats the links it meets.
+        if not args: return
+        if self.planning: return self.planning.add("lchown", args, user, recursive=False)
+        try: owner = FileOps.owner(user, self.chroots[-1] if self.chroots else "")
+        except (KeyError, OSError): owner = None
+        if owner is not None and self.native(f"chown -h {user} {' '.join(args)}", args, lambda: FileOps.lchown(
+                *owner, [self.host_path(a, follow=False) for a in args])): return
+        self.run_many((["chown", "-h", user, "--", *batch] for batch in itertools.batched(args, Shell.BATCH_SIZE)),
+                      writes=args)
+    def uid(self, user):
+        if not Recording.active():
+            with contextlib.suppress(KeyError, OSError):
+                return FileOps.owner(user, self.chroots[-1] if self.chroots else "")[0]
+        return int(Shell.stdout(self.run(["id", "-u", user])))
     def ssh_keygen(self, key_type, path, password=""):
         self.mkdir(self.dirname(path))
-        self.run(f"ssh-keygen -t {key_type} -N \"{password}\" -f '{path}'")
+        self.run(["ssh-keygen", "-t", key_type, "-N", password, "-f", path])
     # I/O
-    def file_write(self, path, string, sensitive=None):
-        log_string = self.redact(string, sensitive)
+    def file_write(self, path, string, sensitive=None, fsync=True, show=True):
+        # show=False logs the size instead of the contents, for caches.
+        log_string = self.redact(string, sensitive) if show else f"{len(string)} bytes"
+        if self.planning and self.planning.dry_run: return self.barrier(f"file_write {path} ({log_string})")
+        if self.planning: self.planning.flush()
         print(f"\033[90mLOG: file_write {path} ({log_string})\033[0m")
-        self.rm(path)
-        self.mkdir(self.dirname(path))
-        if self.chroots: path = f"{self.chroots[-1]}{path}"
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(string)
+        if Recording.replaying(): return None
+        host_path = self.host_path(path, follow=False)
+        directory = os.path.dirname(host_path)
+        try: os.makedirs(directory, exist_ok=True)
+        except PermissionError: self.mkdir(self.dirname(path))
+        try: mode = stat.S_IMODE(os.stat(host_path).st_mode)
+        except FileNotFoundError: mode = 0o644
+        fd, temporary = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(host_path)}.")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(string)
+                f.flush()
+                os.fchmod(f.fileno(), mode)
+                if fsync: os.fsync(f.fileno())
+            os.replace(temporary, host_path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError): os.unlink(temporary)
+            raise
+        if fsync:
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try: os.fsync(fd)
+            finally: os.close(fd)
+        Shell.memo.invalidate(host_path)
     def file_read(self, path):
-        if not self.exists(path): return ""
-        if self.chroots: path = f"{self.chroots[-1]}{path}"
-        with open(path, "r", encoding="utf-8") as f:
-            return f.read()
+        if Recording.replaying(): return Recording.replay("file_read", self.chroot_path(path))["stdout"]
+        started = time.monotonic()
+        if not self.exists(path): contents = ""
+        else:
+            with open(self.chroot_path(path), "r", encoding="utf-8") as f: contents = f.read()
+        if Recording.recording():
+            Recording.record("file_read", self.chroot_path(path), 0, contents, "", time.monotonic() - started)
+        return contents
     def json_read(self, path):
         try: return json.loads(self.file_read(path))
         except (json.JSONDecodeError, ValueError): return {}
-    def json_write(self, path, key, value):
+    def json_write(self, path, key, value, fsync=True):
+        return self.json_update(path, {key: value}, fsync=fsync)
+    def json_update(self, path, updates, fsync=True):
         data = self.json_read(path)
-        data[key] = value
-        return self.file_write(path, json.dumps(data))
-    def json_overwrite(self, path, data):
-        self.rm(path)
-        return self.file_write(path, json.dumps(data))
+        data.update(updates)
+        return self.file_write(path, json.dumps(data), fsync=fsync)
+    def json_overwrite(self, path, data, fsync=True, show=True):
+        return self.file_write(path, json.dumps(data), fsync=fsync, show=show)
+    # Nix
+    def path_info(self, *groups):
+        # `nix path-info --json --recursive`, one process per group of paths, merged into path -> info.
+        results = self.run_many([["nix", "--extra-experimental-features", "nix-command", "path-info", "--json",
+                                  "--recursive", *group] for group in groups if group])
+        infos = {}
+        for result in results:
+            data = json.loads(result.stdout or "{}")
+            # Nix before 2.19 prints a list of objects with a "path" field.
+            if isinstance(data, list): data = {entry["path"]: entry for entry in data}
+            infos.update({path: info for path, info in data.items() if info})
+        return infos
     # Git
     def git_add_safe_directory(self, path):
         path = self.realpath(path)
-        self.run(f"git config --global --add safe.directory '{path}'")
+        # Only the global gitconfig changes: root's through sudo, or the caller's own.
+        self.run(["git", "config", "--global", "--add", "safe.directory", path],
+                 writes=[os.path.expanduser("~root/.gitconfig"), os.path.expanduser("~/.gitconfig")])
+
 
+if os.environ.get(Memo.ENV): atexit.register(Shell.memo.print_stats)
 
 chrootable_registry: list = []
 
@@ -5,6 +5,11 @@ from .config import Config
 @chrootable
 class Snapshot:
     sh = Shell()
+    SETTINGS = [
+        "config.settings.disk.subvolumes.snapshots.mountPoint",
+        "config.settings.disk.immutability.persist.snapshots.cleanName",
+        "config.settings.disk.subvolumes.volumes",
+    ]
     @classmethod
     def get_snapshots_path(cls):
         return Config.eval(
@@ -15,10 +20,8 @@ class Snapshot:
             "config.settings.disk.immutability.persist.snapshots.cleanName")
     @classmethod
     def get_subvolumes_to_reset_on_boot(cls):
-        raw = Config.eval(
-            "config.settings.disk.subvolumes."
-            "nameMountPointPairs.resetOnBoot")
-        return [pair.split("=") for pair in str(raw).split()]
+        volumes = Config.eval("config.settings.disk.subvolumes.volumes")
+        return [(volume["name"], volume["mountPoint"]) for volume in volumes if volume["resetOnBoot"]]
     @classmethod
     def get_clean_snapshot_path(cls, subvolume_name):
         return (f"{cls.get_snapshots_path()}"
@@ -26,13 +29,16 @@ class Snapshot:
                 f"/{cls.get_clean_snapshot_name()}")
     @classmethod
     def create_initial_snapshots(cls):
+        Config.eval_many(cls.SETTINGS)
         for name, mount_point in cls.get_subvolumes_to_reset_on_boot():
-            clean_path = cls.get_clean_snapshot_path(name)
+            # One plan per subvolume, so a failure only costs that subvolume its snapshot.
             try:
-                cls.sh.rm(clean_path)
-                cls.sh.mkdir(cls.sh.dirname(clean_path))
-                cls.sh.run(
-                    f"btrfs subvolume snapshot -r {mount_point} {clean_path}")
+                clean_path = cls.get_clean_snapshot_path(name)
+                with cls.sh.plan() as plan:
+                    cls.sh.rm(clean_path)
+                    cls.sh.mkdir(cls.sh.dirname(clean_path))
+                    plan.command(["btrfs", "subvolume", "snapshot", "-r", mount_point, clean_path],
+                                 writes=(clean_path,))
             except Exception as e:
                 Utils.log_error(
                     f"Failed to create a clean snapshot for {name}\n{e}")
@@ -0,0 +1,57 @@
+import itertools, os, re, time
+from .hostcache import HostCache
+from .utils import Utils
+
+# Store verification limited to the closures of the given systems. `nix
+# path-info --recursive` lists each closure path with its hash, size and
+# registration time; paths whose hash was verified at the same registration
+# time are skipped, the rest are re-hashed by `nix-store --verify-path` in
+# batches on every core, and only the paths it reports modified are repaired.
+# The record of verified paths is the HostCache file NIXOS_VERIFY_CACHE names.
+class StoreVerify:
+    ENV = "NIXOS_VERIFY_CACHE"
+    CACHE = HostCache(ENV, "verified.json")
+    BATCH_SIZE = 64
+    MODIFIED = re.compile(r"path '(/nix/store/[^']+)' was modified")
+    @classmethod
+    def verify(cls, sh, *systems):
+        started = time.monotonic()
+        infos = cls.closure(sh, [system for system in systems if system])
+        cache = cls.load()
+        pending = [path for path in sorted(infos) if cache.get(path) != cls.key(infos[path])]
+        # Small enough batches that every core stays busy until the end.
+        workers = os.cpu_count() or 1
+        per_batch = max(1, min(cls.BATCH_SIZE, -(-len(pending) // (workers * 4))))
+        batches = list(itertools.batched(pending, per_batch))
+        # Re-hashing leaves the store as it was; only the database's records may change.
+        results = sh.run_many([["nix-store", "--verify-path", *batch] for batch in batches],
+                              concurrency=workers, on_error="collect", writes=["/nix/var/nix/db"])
+        modified, failed = set(), set()
+        for batch, result in zip(batches, results):
+            if result.returncode == 0: continue
+            found = set(cls.MODIFIED.findall(result.stderr or ""))
+            if not found: Utils.log_error(f"Could not verify {len(batch)} store paths:\n{result.stderr.strip()}")
+            modified |= found
+            failed |= found or set(batch)
+        if modified: sh.run(["nix-store", "--repair-path", *sorted(modified)], capture_output=False)
+        cls.save({path: cls.key(infos[path]) for path in infos if path not in failed})
+        seconds = time.monotonic() - started
+        size = sum(infos[path].get("narSize", 0) for path in pending) / 2**20
+        Utils.print(f"Verified {len(pending)} of {len(infos)} store paths ({size:.0f} MiB) in {seconds:.1f}s, "
+                    f"{size / max(seconds, 1e-6):.0f} MiB/s; {len(infos) - len(pending)} unchanged since their "
+                    "last check.")
+        for path in sorted(modified): Utils.print(f"Repaired {path}")
+        return sorted(modified)
+    @classmethod
+    def closure(cls, sh, systems):
+        return {path: info for path, info in sh.path_info(systems).items() if info.get("valid", True)}
+    @classmethod
+    def key(cls, info):
+        return [info.get("registrationTime"), info.get("narHash")]
+    @classmethod
+    def load(cls):
+        hit, verified = HostCache.read(cls.CACHE.location())
+        return verified if hit and isinstance(verified, dict) else {}
+    @classmethod
+    def save(cls, verified):
+        HostCache.write(cls.CACHE.location(), verified)
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Subprocess budgets for the high-level operations in scripts/.
+
+Every operation runs against FakeHost, a small model of an installed machine
+that answers the commands Shell would spawn, once per mode:
+
+  user  an unprivileged caller: every file operation is a sudo command, served
+        through the replay hook so no in-process fast path hides a command.
+  root  the native path: the machine is written to a temporary directory that
+        every Shell treats as its chroot, FileOps works on it directly
+        (ownership changes are dropped), and only real commands reach FakeHost.
+
+Each run counts the subprocesses spawned, how many went through sudo, how many
+were `nix eval`, and the bytes of output handed back to Python. The counts must
+stay within budgets.json, which has one section per mode.
+
+Usage:
+  python3 -m pytest scripts/lib/test/budget_test.py
+  python3 scripts/lib/test/budget_test.py            # print the current counts
+  python3 scripts/lib/test/budget_test.py --update   # rewrite budgets.json
+"""
+import asyncio, contextlib, fnmatch, importlib, io, json, os, re, shlex, subprocess, sys, tempfile, threading
+from pathlib import Path
+from unittest import mock
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS), str(SCRIPTS / "bin"), str(SCRIPTS / "bin" / "nixos")]
+from lib import Config, Interactive, Shell, Snapshot
+from lib import process
+from lib.evalcache import EvalCache
+from lib.fileops import FileOps
+from lib.memo import Memo
+from lib.pipeline import Pipeline
+from lib.replay import Recording
+
+BUDGETS = Path(__file__).resolve().parent / "budgets.json"
+METRICS = ("spawns", "sudo", "nix_eval", "bytes")
+MODES   = ("user", "root")
+NIXOS   = "/etc/nixos"
+HOST    = f"{NIXOS}/modules/hosts/x86_64/desktop/desktop.nix"
+
+SETTINGS = {
+    "config.settings.secrets.path": f"{NIXOS}/secrets",
+    "config.settings.secrets.hashedPasswordFile": "hashed_password.txt",
+    "config.settings.user.admin.username": "alice",
+    "config.settings.disk.by.partlabel.root": "/dev/disk/by-partlabel/disk-main-root",
+    "config.settings.tpm.device": "/dev/tpmrm0",
+    "config.settings.tpm.versionPath": "/sys/class/tpm/tpm0/tpm_version_major",
+    "config.settings.disk.subvolumes.snapshots.mountPoint": "/.snapshots",
+    "config.settings.disk.immutability.persist.snapshots.cleanName": "CLEAN",
+    "config.settings.disk.subvolumes.volumes": [
+        {"name": "@root", "mountPoint": "/", "resetOnBoot": True},
+        {"name": "@home", "mountPoint": "/home", "resetOnBoot": True},
+        {"name": "@nix", "mountPoint": "/nix", "resetOnBoot": False}],
+    "config.settings.disk.immutability.persist.paths": ["/etc/nixos", "/var/lib/nixos"],
+}
+
+# The closure the flake evaluates to, and the system the host is running.
+TOPLEVEL = {
+    "config.system.build.toplevel.outPath": "/nix/store/00000000000000000000000000000000-nixos-system",
+    "config.system.build.toplevel.drvPath": "/nix/store/00000000000000000000000000000000-nixos-system.drv",
+}
+LINKS = {"/run/current-system": "/nix/store/11111111111111111111111111111111-nixos-system"}
+
+def nested(settings):
+    tree = {}
+    for attribute, value in settings.items():
+        *parents, name = attribute.split(".")[2:]
+        node = tree
+        for parent in parents: node = node.setdefault(parent, {})
+        node[name] = value
+    return tree
+
+# The running system was built from the current flake, so settings come from its settings.json.
+FINGERPRINT = "0" * 64
+FILES = {
+    f"{NIXOS}/config.json": json.dumps({"host_path": HOST, "target": "Standard-Boot"}),
+    "/var/cache/nixos-scripts/system.json": json.dumps({"system": LINKS["/run/current-system"],
+                                                        "fingerprint": FINGERPRINT}),
+    f"{LINKS['/run/current-system']}/settings.json": json.dumps({"name": "desktop-Standard-Boot", "settings": nested(SETTINGS)}),
+    f"{NIXOS}/scripts/bin/.diffignore": "/var/cache/*\n/home/*/.cache/*",
+    "/sys/class/tpm/tpm0/tpm_version_major": "2",
+}
+
+# path -> (find type, mode, uid)
+TREE = {
+    "/": ("d", 0o755, 0), "/etc": ("d", 0o755, 0), NIXOS: ("d", 0o755, 1000),
+    f"{NIXOS}/flake.nix": ("f", 0o644, 1000), f"{NIXOS}/flake.lock": ("f", 0o644, 1000),
+    f"{NIXOS}/config.json": ("f", 0o644, 1000),
+    f"{NIXOS}/modules": ("d", 0o755, 1000), f"{NIXOS}/modules/settings.nix": ("f", 0o644, 1000),
+    f"{NIXOS}/modules/hosts": ("d", 0o755, 1000), f"{NIXOS}/modules/hosts/x86_64": ("d", 0o755, 1000),
+    f"{NIXOS}/modules/hosts/x86_64/desktop": ("d", 0o755, 1000), HOST: ("f", 0o644, 1000),
+    f"{NIXOS}/modules/hosts/x86_64/laptop": ("d", 0o755, 1000),
+    f"{NIXOS}/modules/hosts/x86_64/laptop/laptop.nix": ("f", 0o600, 0),
+    f"{NIXOS}/scripts": ("d", 0o755, 1000), f"{NIXOS}/scripts/bin": ("d", 0o755, 1000),
+    f"{NIXOS}/scripts/bin/diff.py": ("f", 0o644, 1000), f"{NIXOS}/scripts/bin/.diffignore": ("f", 0o644, 1000),
+    f"{NIXOS}/.git": ("d", 0o755, 1000), f"{NIXOS}/.git/HEAD": ("f", 0o644, 1000),
+    f"{NIXOS}/.git/objects": ("d", 0o755, 1000), f"{NIXOS}/.git/objects/ab": ("d", 0o755, 1000),
+    f"{NIXOS}/.git/objects/ab/cdef": ("f", 0o444, 1000),
+    f"{NIXOS}/secrets": ("d", 0o700, 0), f"{NIXOS}/secrets/hashed_password.txt": ("f", 0o644, 0),
+    "/.snapshots": ("d", 0o755, 0), "/.snapshots/@root": ("d", 0o755, 0), "/.snapshots/@home": ("d", 0o755, 0),
+    "/home": ("d", 0o755, 0), "/sys/class/tpm/tpm0/tpm_version_major": ("f", 0o444, 0),
+    "/dev/tpmrm0": ("c", 0o660, 0),
+}
+
+# Accounts the native uid lookups read inside the chroot.
+ACCOUNTS = {"/etc/passwd": "root:x:0:0::/root:/bin/sh\nalice:x:1000:100::/home/alice:/bin/sh\n",
+            "/etc/group": "root:x:0:\nusers:x:100:\n"}
+
+CHANGES = ["var/log/journal/system.journal", "var/cache/nix/binary-cache-v6.sqlite", "etc/nixos/flake.lock",
+           "home/alice/.cache/thumbnails/x.png", "home/alice/Downloads/file.iso", "root/.bash_history"]
+
+class Stop(Exception):
+    pass
+
+# What asyncio.create_subprocess_* and process.Process hand back in root mode.
+class FakeChild:
+    def __init__(self, entry):
+        self.pid, self.returncode, self.rusage = 4242, entry["returncode"], None
+        self.output = entry["stdout"].encode(), entry["stderr"].encode()
+        self.stdout = io.BytesIO(self.output[0])
+    async def communicate(self):
+        return self.output
+
+class FakeProcess(FakeChild):
+    def poll(self):
+        return self.returncode
+    def wait(self, timeout=None):
+        return self.returncode
+    def kill(self):
+        pass
+    stop = kill
+
+class FakeHost:
+    def __init__(self, mode="user"):
+        self.mode = mode
+        self.tree = dict(TREE)
+        self.counts = dict.fromkeys(METRICS, 0)
+        self.commands = []
+    # Hooks
+    def replay(self, kind, cmd, sleep=True):
+        if kind == "file_read": return self.entry(0, FILES.get(cmd, ""))
+        return self.spawn(process.display(cmd))
+    def process_run(self, cmd, capture_output=True, timeout=None):
+        entry = self.spawn(process.display(cmd))
+        result = subprocess.CompletedProcess(cmd, entry["returncode"], entry["stdout"], entry["stderr"])
+        result.rusage = None
+        return result
+    def popen(self, args, *_, **__):
+        self.spawn(process.display(args))
+        return mock.Mock(pid=4242)
+    async def create_subprocess_exec(self, *cmd, **_):
+        return FakeChild(self.spawn(process.display(list(cmd))))
+    async def create_subprocess_shell(self, cmd, **_):
+        return FakeChild(self.spawn(cmd))
+    def process(self, cmd, *_, **__):
+        return FakeProcess(self.spawn(process.display(cmd)))
+    # Commands
+    def spawn(self, cmd):
+        self.commands.append(cmd)
+        self.counts["spawns"] += 1
+        cmd = re.sub(r"^(\w+=\S*\s+)+", "", cmd)
+        if cmd.startswith("sudo "):
+            self.counts["sudo"] += 1
+            cmd = cmd[len("sudo "):]
+        if match := re.fullmatch(r"nixos-enter --root \S+ --command '(.*)'", cmd, re.S):
+            cmd = match.group(1).replace("'\\''", "'")
+        cmd = re.sub(r"^nixos-enter --root \S+ -- ", "", cmd)
+        returncode, stdout = self.respond(re.sub(r"^(env )?(\w+=\S*\s+)+", "", cmd))
+        self.counts["bytes"] += len(stdout)
+        return self.entry(returncode, stdout)
+    def entry(self, returncode, stdout):
+        return {"returncode": returncode, "stdout": stdout, "stderr": "", "seconds": 0.0}
+    def respond(self, cmd):
+        if cmd.startswith("nixos-rebuild") or "switch-to-configuration" in cmd: raise Stop(cmd)
+        if " eval " in cmd and cmd.startswith("nix "):
+            self.counts["nix_eval"] += 1
+            attributes = re.findall(r'"([^"]+)" = system\.', shlex.split(cmd)[-1])
+            values = {**SETTINGS, **TOPLEVEL}
+            return 0, json.dumps({attribute: values.get(attribute, "") for attribute in attributes}) + "\n"
+        if tests := re.findall(r"\[ -([edL]) '([^']*)' \]", cmd):
+            return int(not all(self.test(flag, path) for flag, path in tests)), ""
+        words = shlex.split(cmd)
+        program, args = words[0], [word for word in words[1:] if word != "--"]
+        if program == "test": return int(not self.test(args[0][1], args[1])), ""
+        if program == "stat" and "-L" in args: return int(not all(self.test("e", path) for path in args[2:])), ""
+        if program == "id": return 0, "1000\n" if args[1:] else "0\n"
+        if program == "who": return 0, "alice    tty1         2026-01-01 00:00\n"
+        if program == "hostname": return 0, "desktop\n"
+        if program == "realpath": return 0, "".join(f"{LINKS.get(path, path.rstrip('/') or '/')}\n" for path in args)
+        if program == "find" and "-printf" in args: return 0, self.stat(args[:args.index("-maxdepth")])
+        if program == "find": return 0, self.find(args)
+        if program == "nix" and "build" in args: return 0, TOPLEVEL["config.system.build.toplevel.outPath"] + "\n"
+        if program == "nix" and "path-info" in args:
+            closure = [LINKS["/run/current-system"], "/nix/store/22222222222222222222222222222222-glibc-2.40"]
+            return 0, json.dumps({path: {"narHash": "sha256-0", "narSize": 4096, "registrationTime": 1}
+                                  for path in closure})
+        if program == "nix-env" and "--list-generations" in args:
+            return 0, "".join(f"{number:5}   2026-0{number}-01 10:00:00   {'(current)' if number == 3 else ''}\n"
+                              for number in (1, 2, 3))
+        if program == "nix-store" and "--print-roots" in args:
+            return 0, f"/run/current-system -> {LINKS['/run/current-system']}\n"
+        if program == "nix" and "metadata" in args: return 0, json.dumps({"locked": {"rev": "0" * 40}})
+        if program == "btrfs" and args[:2] == ["subvolume", "find-new"]:
+            if args[3] == "9999999": return 0, "transid marker was 4242\n"
+            mount = "/home" if args[2].startswith("/.snapshots/@home") else "/"
+            prefix = mount.strip("/")
+            lines = [f"inode 257 file offset 0 len 4096 disk start 0 offset 0 gen 4243 flags NONE {path}"
+                     for path in CHANGES if path.startswith(prefix)]
+            return 0, "\n".join(lines) + "\n"
+        if program == "journalctl": return 0, "Finished Home Manager\nactivated\nStarting Home Manager activation\n"
+        if program == "pactl" and args[-2:] == ["list", "sinks"]: return 0, "[]"
+        if program == "pactl": return 0, "alsa_output.pci-0000_00_1f.3.analog-stereo\n"
+        if program == "sbctl": return 0, "{}"
+        if program == "mkpasswd": return 0, "$6$salt$hash\n"
+        return 0, ""
+    def test(self, flag, path):
+        entry = self.tree.get(path.rstrip("/") or "/")
+        if flag == "d": return entry is not None and entry[0] == "d"
+        if flag == "L": return entry is not None and entry[0] == "l"
+        return entry is not None
+    def find(self, args):
+        top, include, ignore, kind, negate = args[0].rstrip("/") or "/", [], [], None, False
+        for index, token in enumerate(args[1:], 1):
+            if token == "-not": negate = True
+            elif token == "-type": kind = args[index + 1]
+            elif token == "-path": (ignore if negate else include).append(args[index + 1])
+        paths = [path for path in sorted(self.tree) if path == top or path.startswith(f"{top.rstrip('/')}/")]
+        return "\n".join(path for path in paths
+                         if (kind is None or self.tree[path][0] == kind)
+                         and any(fnmatch.fnmatchcase(path, pattern) for pattern in include or ["*"])
+                         and not any(fnmatch.fnmatchcase(path, pattern) for pattern in ignore)) + "\n"
+    def stat(self, paths):
+        fields = []
+        for path in paths:
+            if path not in self.tree: continue
+            kind, mode, uid = self.tree[path]
+            fields.extend([path, kind, f"{mode:o}", str(uid), str(uid), "0", "0.0", ""])
+        return "".join(f"{field}\0" for field in fields)
+    def materialize(self, root):
+        # The machine on disk: TREE with its modes, FILES, ACCOUNTS and LINKS.
+        for path, (kind, _, _) in self.tree.items():
+            os.makedirs(f"{root}{path}" if kind == "d" else os.path.dirname(f"{root}{path}"), exist_ok=True)
+        for path, contents in {**dict.fromkeys(p for p, e in self.tree.items() if e[0] != "d"), **FILES,
+                               **ACCOUNTS}.items():
+            os.makedirs(os.path.dirname(f"{root}{path}"), exist_ok=True)
+            with open(f"{root}{path}", "w", encoding="utf-8") as f: f.write(contents or "")
+        for path, target in LINKS.items():
+            os.makedirs(f"{root}{target}", exist_ok=True)
+            os.makedirs(os.path.dirname(f"{root}{path}"), exist_ok=True)
+            os.symlink(target, f"{root}{path}")
+        for path, (_, mode, _) in sorted(self.tree.items(), reverse=True): os.chmod(f"{root}{path}", mode)
+    # Running
+    def replacements(self, stack):
+        if self.mode == "user":
+            return [(Recording, {"replaying": classmethod(lambda cls: True),
+                                 "recording": classmethod(lambda cls: False),
+                                 "replay": classmethod(lambda cls, kind, cmd, sleep=True: self.replay(kind, cmd))})]
+        root = stack.enter_context(tempfile.TemporaryDirectory(prefix="budget-"))
+        self.materialize(root)
+        stack.enter_context(mock.patch.dict(os.environ, {EvalCache.ENV: "", "NIXOS_VERIFY_CACHE": ""}))
+        # Every Shell, including the module-level ones imported earlier, works inside root.
+        stack.enter_context(mock.patch.object(Shell, "chroots", property(lambda shell: [root], lambda shell, value: None),
+                                              create=True))
+        return [(Recording, {"replaying": classmethod(lambda cls: False),
+                             "recording": classmethod(lambda cls: False)}),
+                (FileOps, {"available": classmethod(lambda cls: True)}),
+                (os, {"chown": lambda *_, **__: None}),
+                (asyncio, {"create_subprocess_exec": self.create_subprocess_exec,
+                           "create_subprocess_shell": self.create_subprocess_shell}),
+                (process, {"Process": self.process})]
+    @contextlib.contextmanager
+    def installed(self):
+        answers = iter(["1", "n"] * 4)
+        with contextlib.ExitStack() as stack:
+            for target, replacement in [
+                    *self.replacements(stack),
+                    (process, {"run": self.process_run}),
+                    (subprocess, {"Popen": self.popen}),
+                    (Shell, {"evals": {}, "memo": Memo()}),
+                    (EvalCache, {"fingerprint": classmethod(lambda cls, sh, nixos_path: FINGERPRINT)})]:
+                for name, value in replacement.items(): stack.enter_context(mock.patch.object(target, name, value))
+            stack.enter_context(mock.patch("builtins.input", lambda *_: next(answers)))
+            stack.enter_context(mock.patch("getpass.getpass", lambda *_: "hunter2"))
+            stack.enter_context(mock.patch("sys.argv", ["nixos"]))
+            stack.enter_context(mock.patch("builtins.print"))
+            yield self
+    def measure(self, operation):
+        with mock.patch.dict(LINKS, getattr(operation, "links", {})), self.installed():
+            modules = {name: importlib.import_module(name) for name in ("diff", "cli")}
+            self.counts = dict.fromkeys(METRICS, 0)
+            self.commands = []
+            with contextlib.suppress(Stop, SystemExit): operation(modules)
+        return self.counts
+
+def unchanged(operation):
+    # The running system is already the evaluated toplevel.
+    operation.links = {"/run/current-system": TOPLEVEL["config.system.build.toplevel.outPath"]}
+    return operation
+
+def subcommand(command, *argv):
+    return lambda modules: modules["cli"].dispatch(command, list(argv))
+
+OPERATIONS = {
+    "Config.secure": lambda modules: Config.secure("alice"),
+    "Config.update": lambda modules: Config.update(),
+    "Config.update (no change)": unchanged(lambda modules: Config.update()),
+    "Snapshot.create_initial_snapshots": lambda modules: Snapshot.create_initial_snapshots(),
+    "diff.main": lambda modules: modules["diff"].main(),
+    "Interactive.ask_for_host_path": lambda modules: Interactive.ask_for_host_path(Config.get_hosts_path()),
+    "nixos update": subcommand("update"),
+    "nixos upgrade": subcommand("upgrade"),
+    "nixos gc --dry-run": subcommand("gc", "--keep-last", "1", "--dry-run"),
+    "nixos tpm2 status": subcommand("tpm2", "status"),
+    "nixos secure-boot status": subcommand("secure-boot", "status"),
+    "nixos change-password": subcommand("change-password", "--full-disk-encryption-only"),
+    "nixos displays list": subcommand("displays", "list"),
+    "nixos audio list": subcommand("audio", "list"),
+    "nixos caffeine status": subcommand("caffeine", "status"),
+    "nixos system update": subcommand("system", "update"),
+}
+
+def measure_all(mode):
+    return {name: FakeHost(mode).measure(operation) for name, operation in OPERATIONS.items()}
+
+def load_budgets():
+    return json.loads(BUDGETS.read_text()) if BUDGETS.exists() else {}
+
+def test_budgets_cover_every_operation():
+    budgets = load_budgets()
+    assert sorted(budgets) == sorted(MODES)
+    for mode in MODES: assert sorted(budgets[mode]) == sorted(OPERATIONS)
+
+def test_operations_stay_within_budget():
+    budgets = load_budgets()
+    exceeded = [f"{mode} {name}: {metric} {counts[metric]} > {budgets[mode][name][metric]}"
+                for mode in MODES for name, counts in measure_all(mode).items() if name in budgets[mode]
+                for metric in METRICS if counts[metric] > budgets[mode][name][metric]]
+    assert not exceeded, "Subprocess budget exceeded:\n" + "\n".join(exceeded)
+
+def test_measurements_are_deterministic():
+    for mode in MODES: assert measure_all(mode) == measure_all(mode), mode
+
+def test_update_stages_keep_their_order_on_the_pool():
+    execute, lock = Pipeline.execute, threading.Lock()
+    def recorded(pipeline, stage, deadlines=()):
+        with lock: events.append(("start", stage.name, pipeline))
+        try: return execute(pipeline, stage, deadlines)
+        finally:
+            with lock: events.append(("finish", stage.name, pipeline))
+    for mode in MODES:
+        for name in ("Config.update", "nixos upgrade"):
+            events = []
+            with mock.patch.object(Pipeline, "execute", recorded): FakeHost(mode).measure(OPERATIONS[name])
+            pipeline = events[0][2]
+            started = {stage: index for index, (event, stage, _) in enumerate(events) if event == "start"}
+            finished = {stage: index for index, (event, stage, _) in enumerate(events) if event == "finish"}
+            assert pipeline.workers > 1 and "activate" in started, (mode, name)
+            for stage, index in started.items():
+                for need in pipeline.stages[stage].needs:
+                    if need in pipeline.stages: assert finished[need] < index, (mode, name, stage, need)
+            # Only --upgrade cleans the caches first.
+            assert ("clean" in pipeline.stages) == (name == "nixos upgrade"), (mode, name)
+            if "clean" in pipeline.stages: assert finished["clean"] < started["upgrade"], (mode, name)
+            alone = range(started["activate"], finished["activate"] + 1)
+            assert all(stage == "activate" for _, stage, _ in events[alone.start:alone.stop]), (mode, name)
+
+def main():
+    measured = {mode: measure_all(mode) for mode in MODES}
+    if "--update" in sys.argv[1:]:
+        BUDGETS.write_text(json.dumps(measured, indent=2) + "\n")
+    budgets = load_budgets()
+    for mode in MODES:
+        for name, counts in measured[mode].items():
+            budget = budgets.get(mode, {}).get(name, {})
+            print(f"{mode:5} {name:36} " + "  ".join(f"{metric}={counts[metric]}/{budget.get(metric, '-')}"
+                                                     for metric in METRICS))
+
+if __name__ == "__main__":
+    main()
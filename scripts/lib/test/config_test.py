@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Config.model and Config.transaction: config.json is parsed again only when its
+inode, size or mtime changes, and a transaction writes it once on success and
+not at all when its body raises.
+
+Usage:
+  python3 -m pytest scripts/lib/test/config_test.py
+"""
+import json, os, sys
+from pathlib import Path
+import pytest
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib import Shell
+from lib.config import Config
+
+HOST = "/etc/nixos/modules/hosts/x86_64/FRACTAL-NORTH/FRACTAL-NORTH.nix"
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    path = tmp_path / "config.json"
+    path.write_text(json.dumps({"host_path": HOST, "target": "Standard-Boot"}))
+    monkeypatch.setattr(Config, "get_nixos_path", classmethod(lambda cls: str(tmp_path)))
+    monkeypatch.setattr(Config, "models", {})
+    monkeypatch.setattr(Config, "staged", None)
+    reads, writes = [], []
+    json_read, json_overwrite = Shell.json_read, Shell.json_overwrite
+    monkeypatch.setattr(Shell, "json_read", lambda self, *a, **k: reads.append(a) or json_read(self, *a, **k))
+    monkeypatch.setattr(Shell, "json_overwrite",
+                        lambda self, *a, **k: writes.append(a) or json_overwrite(self, *a, **k))
+    return path, reads, writes
+
+def test_model_is_parsed_once_while_the_file_is_unchanged(config):
+    path, reads, _ = config
+    assert Config.get_host_path() == HOST
+    assert (Config.get_target(), Config.model()["host"], Config.model()["architecture"]) == \
+        ("Standard-Boot", "FRACTAL-NORTH", "x86_64")
+    assert len(reads) == 1
+
+def test_model_reloads_when_the_file_changes(config):
+    path, reads, _ = config
+    assert Config.get_target() == "Standard-Boot"
+    path.write_text(json.dumps({"host_path": HOST, "target": "Secure-Boot"}))
+    assert Config.get_target() == "Secure-Boot"
+    # Same size and inode: only the mtime tells the edit apart.
+    stat = path.stat()
+    path.write_text(json.dumps({"host_path": HOST, "target": "Secure-Bool"}))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert Config.get_target() == "Secure-Bool"
+    assert len(reads) == 3
+
+def test_own_writes_do_not_reload(config):
+    _, reads, writes = config
+    Config.set_target("Secure-Boot")
+    assert Config.get_target() == "Secure-Boot"
+    Config.set_target("Secure-Boot")
+    assert (len(reads), len(writes)) == (1, 1)
+
+def test_transaction_writes_once_when_it_ends(config):
+    path, _, writes = config
+    with Config.transaction():
+        Config.set_target("Secure-Boot")
+        with Config.transaction(): Config.set_host_path("/etc/nixos/modules/hosts/aarch64/LAPTOP/LAPTOP.nix")
+        assert Config.model()["host"] == "LAPTOP"
+        assert json.loads(path.read_text())["target"] == "Standard-Boot"
+    assert json.loads(path.read_text()) == {"host_path": "/etc/nixos/modules/hosts/aarch64/LAPTOP/LAPTOP.nix",
+                                            "target": "Secure-Boot"}
+    assert len(writes) == 1
+
+def test_transaction_rolls_back_on_exception(config):
+    path, _, writes = config
+    before = path.read_text()
+    with pytest.raises(KeyboardInterrupt), Config.transaction():
+        Config.set_target("Secure-Boot")
+        raise KeyboardInterrupt
+    assert Config.staged is None
+    assert path.read_text() == before
+    assert Config.get_target() == "Standard-Boot"
+    assert writes == []
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Deadlines: scopes nest and the tightest one bounds every command run inside
+them, an expired command reports the deadline that fired and how long it ran,
+and its whole process group is killed, not only the direct child.
+
+Usage:
+  python3 -m pytest scripts/lib/test/deadline_test.py
+"""
+import json, os, signal, subprocess, sys, threading, time
+from pathlib import Path
+import pytest
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib import Config, Shell
+from lib.deadline import Deadline, DeadlineExceeded
+from lib.evalcache import EvalCache
+from lib.pipeline import Pipeline
+
+def alive(pid):
+    try: state = Path(f"/proc/{pid}/stat").read_text().rpartition(")")[2].split()[0]
+    except FileNotFoundError: return False
+    return state != "Z"
+
+def test_scopes_nest_and_the_tightest_deadline_wins():
+    assert Deadline.current() is None
+    with Deadline.scope(60, "update") as update:
+        with Deadline.scope(None, "optional") as optional:
+            assert optional is None and Deadline.current() is update
+        with Deadline.scope(5, "evaluation") as evaluation:
+            assert Deadline.current() is evaluation
+            assert Deadline.current(timeout=1).name == "per-call"
+            with Deadline.scope(600, "build stage"): assert Deadline.current() is evaluation
+        assert Deadline.current() is update
+        assert 59 < Deadline.limit() <= 60
+    assert Deadline.stack() == []
+
+def test_expired_command_names_the_deadline_that_fired():
+    started = time.monotonic()
+    with Deadline.scope(30, "update"), Deadline.scope(0.3, "evaluation"), pytest.raises(DeadlineExceeded) as error:
+        Shell().run(["sleep", "10"], sudo=False, timeout=20)
+    assert time.monotonic() - started < 5
+    assert error.value.deadline.name == "evaluation"
+    assert 0.3 <= error.value.elapsed < 5
+    assert str(error.value).startswith("Command '['sleep', '10']' ran for ")
+    assert str(error.value).endswith("s and exceeded the evaluation deadline (0.3s)")
+
+def test_expired_command_kills_its_process_group(tmp_path):
+    pid_file = tmp_path / "pid"
+    for run in (lambda cmd: Shell().run(cmd, sudo=False, timeout=0.5),
+                lambda cmd: list(Shell().stream(cmd, sudo=False, timeout=0.5)),
+                lambda cmd: Shell().run_many([cmd], sudo=False, timeout=0.5)):
+        pid_file.unlink(missing_ok=True)
+        with pytest.raises(DeadlineExceeded):
+            run(["sh", "-c", f"sleep 30 & echo $! > {pid_file}; wait"])
+        pid = int(pid_file.read_text())
+        deadline = time.monotonic() + 5
+        while alive(pid) and time.monotonic() < deadline: time.sleep(0.05)
+        assert not alive(pid)
+
+def test_pipeline_stages_run_under_their_own_and_inherited_deadlines():
+    seen = {}
+    pipeline = Pipeline(timeouts={"build": 600})
+    pipeline.add("build", lambda: seen.setdefault("build", Deadline.current().name))
+    pipeline.add("verify", lambda: seen.setdefault("verify", Deadline.current().name), timeout=0.5)
+    pipeline.add("secrets", lambda: seen.setdefault("secrets", Deadline.current().name))
+    pipeline.add("hang", lambda: Shell().run(["sleep", "10"], sudo=False), needs=["build"], timeout=0.3)
+    with Deadline.scope(60, "update"), pytest.raises(DeadlineExceeded) as error: pipeline.run()
+    assert seen == {"build": "update", "verify": "verify stage", "secrets": "update"}
+    assert error.value.deadline.name == "hang stage"
+
+def test_eval_many_runs_under_the_evaluation_deadline(monkeypatch):
+    deadlines = []
+    def run(cmd, **kwargs):
+        deadlines.append(Deadline.current())
+        return subprocess.CompletedProcess(cmd, 0, json.dumps({"config.networking.hostName": "desktop"}), "")
+    monkeypatch.setattr(Shell, "evals", {})
+    monkeypatch.setattr(Config, "eval_key", classmethod(lambda cls, attribute: ("eval", attribute)))
+    monkeypatch.setattr(Config, "eval_command", classmethod(lambda cls, attributes: ["nix", "eval"]))
+    monkeypatch.setattr(Config, "cache_path", classmethod(lambda cls, key: None))
+    monkeypatch.setattr(EvalCache, "get", classmethod(lambda cls, path: (False, None)))
+    monkeypatch.setattr(EvalCache, "put", classmethod(lambda cls, path, value: None))
+    monkeypatch.setattr(Config.sh, "run", run)
+    assert Config.eval("config.networking.hostName") == "desktop"
+    assert [(deadline.name, deadline.seconds) for deadline in deadlines] == [("evaluation", Config.EVAL_TIMEOUT)]
+
+def test_only_captured_commands_leave_the_terminal_session(capfd):
+    session = [sys.executable, "-c", "import os; print(os.getsid(0))"]
+    assert int(Shell.stdout(Shell().run(session, sudo=False, timeout=10))) != os.getsid(0)
+    Shell().run(session, sudo=False, capture_output=False, timeout=10)
+    assert int(capfd.readouterr().out.strip().splitlines()[-1]) == os.getsid(0)
+
+def test_interrupt_kills_the_process_group(tmp_path):
+    pid_file = tmp_path / "pid"
+    main = threading.get_ident()
+    def interrupt():
+        while not pid_file.exists() or not pid_file.read_text(): time.sleep(0.02)
+        signal.pthread_kill(main, signal.SIGINT)
+    threading.Thread(target=interrupt, daemon=True).start()
+    with pytest.raises(KeyboardInterrupt):
+        Shell().run(["sh", "-c", f"sleep 30 & echo $! > {pid_file}; wait"], sudo=False, timeout=20)
+    pid = int(pid_file.read_text())
+    deadline = time.monotonic() + 5
+    while alive(pid) and time.monotonic() < deadline: time.sleep(0.05)
+    assert not alive(pid)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+EvalCache fingerprints against a real git checkout: unchanged trees hit the
+same cache directory, and editing a tracked file or flake.lock moves lookups
+to a new one, while untracked files do not.
+
+Usage:
+  python3 -m pytest scripts/lib/test/evalcache_test.py
+"""
+import subprocess, sys
+from pathlib import Path
+import pytest
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib import Shell
+from lib.evalcache import EvalCache
+from lib.memo import Memo
+from lib.replay import Recording
+
+# Runs git as the current user, the way root runs it on the machine.
+class UserShell(Shell):
+    def run(self, cmd, **kwargs):
+        return super().run(cmd, **{**kwargs, "sudo": False})
+
+def git(flake, *args):
+    subprocess.run(["git", "-C", str(flake), "-c", "user.name=t", "-c", "user.email=t@t", *args],
+                   check=True, capture_output=True)
+
+@pytest.fixture
+def flake(tmp_path, monkeypatch):
+    monkeypatch.setattr(Shell, "memo", Memo())
+    monkeypatch.setenv(EvalCache.ENV, str(tmp_path / "cache"))
+    monkeypatch.delenv(Recording.RECORD, raising=False)
+    monkeypatch.delenv(Recording.REPLAY, raising=False)
+    flake = tmp_path / "nixos"
+    (flake / "modules").mkdir(parents=True)
+    for name, contents in {"flake.nix": "{ }", "flake.lock": "{\"version\": 7}",
+                           "modules/settings.nix": "{ a = 1; }", "modules/with space.nix": "{ }"}.items():
+        (flake / name).write_text(contents)
+    git(flake, "init", "-q")
+    git(flake, "add", "-A")
+    git(flake, "commit", "-q", "-m", "init")
+    return flake
+
+def fingerprint(flake):
+    return EvalCache.digest(UserShell(), str(flake))
+
+def test_unchanged_tree_hits_the_same_entry(flake):
+    sh = UserShell()
+    path = EvalCache.path(sh, str(flake), ["nix", "eval", "hostName"])
+    EvalCache.put(path, "desktop")
+    assert EvalCache.get(EvalCache.path(sh, str(flake), ["nix", "eval", "hostName"])) == (True, "desktop")
+    assert EvalCache.get(EvalCache.path(sh, str(flake), ["nix", "eval", "other"])) == (False, None)
+    (flake / "result").write_text("untracked")
+    assert fingerprint(flake) == EvalCache.fingerprint(sh, str(flake))
+
+def test_editing_a_tracked_file_misses(flake):
+    before = fingerprint(flake)
+    (flake / "modules" / "with space.nix").write_text("{ b = 2; }")
+    edited = fingerprint(flake)
+    assert edited != before
+    (flake / "modules" / "with space.nix").write_text("{ }")
+    assert fingerprint(flake) == before
+    (flake / "modules" / "settings.nix").unlink()
+    assert fingerprint(flake) not in (before, edited)
+    git(flake, "checkout", "--", ".")
+    (flake / "modules" / "new.nix").write_text("{ }")
+    git(flake, "add", "modules/new.nix")
+    assert fingerprint(flake) != before
+
+def test_changing_flake_lock_misses(flake):
+    before = fingerprint(flake)
+    (flake / "flake.lock").write_text("{\"version\": 7, \"nodes\": {}}")
+    changed = fingerprint(flake)
+    assert changed != before
+    git(flake, "commit", "-q", "-am", "update inputs")
+    assert fingerprint(flake) not in (before, changed)
+
+def test_untracked_flake_lock_still_counts(flake):
+    git(flake, "rm", "-q", "--cached", "flake.lock")
+    git(flake, "commit", "-q", "-m", "untrack")
+    before = fingerprint(flake)
+    (flake / "flake.lock").write_text("{\"version\": 8}")
+    assert fingerprint(flake) != before
+
+def test_writes_through_shell_drop_the_memoized_fingerprint(flake):
+    sh = UserShell()
+    before = EvalCache.fingerprint(sh, str(flake))
+    sh.file_write(str(flake / "modules" / "settings.nix"), "{ a = 2; }", fsync=False)
+    assert EvalCache.fingerprint(sh, str(flake)) != before
+
+def test_outside_a_git_checkout_there_is_no_fingerprint(tmp_path):
+    assert fingerprint(tmp_path) is None
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+EvalServer replies from canned `nix repl` transcripts: plain and escaped
+values, prompts echoed in front of the output, evaluation errors and
+unparseable replies, which must come back as errors so Config.eval_many
+falls back to `nix eval` instead of using a wrong value.
+
+Usage:
+  python3 -m pytest scripts/lib/test/evalserver_test.py
+"""
+import io, json, sys
+from pathlib import Path
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib.evalserver import EvalServer
+
+VALUE = {"config.settings.user.admin.username": "alice",
+         "config.settings.motd": "line one\n\tline \"two\" with \\ and ${HOME} and é",
+         "config.settings.disk.subvolumes.volumes": [{"name": "@root", "resetOnBoot": True}]}
+
+def nix_string(text):
+    # How `nix repl` prints a string value.
+    escaped = (text.replace("\\", "\\\\").replace("\"", "\\\"").replace("${", "\\${")
+               .replace("\n", "\\n").replace("\t", "\\t").replace("\r", "\\r"))
+    return f"\"{escaped}\""
+
+# A repl that answers every query with the next canned transcript.
+class FakeRepl:
+    def __init__(self, *transcripts):
+        self.stdin = io.StringIO()
+        self.stdout = iter(f"{line}\n" for transcript in transcripts for line in transcript)
+    def wait(self):
+        return 1
+
+def server(*transcripts):
+    server = EvalServer.__new__(EvalServer)
+    server.queries, server.fingerprint, server.repl = 0, "f", FakeRepl(*transcripts)
+    return server
+
+def test_plain_value():
+    transcript = [nix_string(json.dumps({"a": 1})), "", "\"__NIXOS_EVAL_1__\""]
+    assert server(transcript).evaluate("desktop-Standard-Boot", "system: { }") == {"values": {"a": 1}}
+
+def test_escaped_value_behind_echoed_prompts():
+    transcript = ["nix-repl> builtins.toJSON ((system: { }) nixosConfigurations.\"desktop-Standard-Boot\")",
+                  f"nix-repl> {nix_string(json.dumps(VALUE))}", "",
+                  "nix-repl> \"__NIXOS\" + \"_EVAL_1__\"", "nix-repl> \"__NIXOS_EVAL_1__\"", "nix-repl> "]
+    assert server(transcript).evaluate("desktop-Standard-Boot", "system: { }") == {"values": VALUE}
+
+def test_queries_read_up_to_their_own_marker():
+    evaluator = server([":lf /etc/nixos", "Added 3 variables.", "\"__NIXOS_EVAL_1__\""],
+                       [nix_string("\"first\""), "\"__NIXOS_EVAL_2__\""],
+                       [nix_string("\"second\""), "\"__NIXOS_EVAL_3__\""])
+    evaluator.send(":lf /etc/nixos")
+    assert evaluator.evaluate("a", "system: 1") == {"values": "first"}
+    assert evaluator.evaluate("b", "system: 2") == {"values": "second"}
+    assert evaluator.repl.stdin.getvalue().count("\"__NIXOS\" + \"_EVAL_") == 3
+
+def test_evaluation_errors_are_reported():
+    transcript = ["error:", "       … while evaluating the attribute 'config.settings.missing'",
+                  "       error: attribute 'missing' missing", "\"__NIXOS_EVAL_1__\""]
+    reply = server(transcript).evaluate("desktop-Standard-Boot", "system: { }")
+    assert set(reply) == {"error"} and reply["error"].startswith("error:")
+
+def test_unparseable_replies_are_errors():
+    for transcript in ([nix_string("{\"a\": "), "\"__NIXOS_EVAL_1__\""],
+                       ["{ a = 1; }", "\"__NIXOS_EVAL_1__\""],
+                       ["\"half a string", "\"__NIXOS_EVAL_1__\""],
+                       ["\"__NIXOS_EVAL_1__\""]):
+        assert set(server(transcript).evaluate("x", "system: { }")) == {"error"}, transcript
+
+def test_errors_make_the_client_fall_back(monkeypatch):
+    monkeypatch.setattr(EvalServer, "request", classmethod(lambda cls, message: {"error": "error: boom"}))
+    assert EvalServer.query("/etc/nixos", "f", "desktop-Standard-Boot", "system: { }") is None
+    monkeypatch.setattr(EvalServer, "request", classmethod(lambda cls, message: {"values": {"a": 1}}))
+    assert EvalServer.query("/etc/nixos", "f", "desktop-Standard-Boot", "system: { }") == {"a": 1}
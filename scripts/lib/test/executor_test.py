@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Executor protocol: the helper answers framed requests with the exit code,
+output and resource usage of each command, reports timeouts, and serves every
+client thread on its own connection so one long command does not hold up the
+others.
+
+Usage:
+  python3 -m pytest scripts/lib/test/executor_test.py
+"""
+import os, socket, subprocess, sys, threading, time
+from pathlib import Path
+from unittest import mock
+import pytest
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib import executor
+from lib.executor import Executor
+
+@pytest.fixture
+def helper():
+    client, server = socket.socketpair()
+    thread = threading.Thread(target=executor.handle, args=(server,))
+    thread.start()
+    def request(cmd, capture_output=True, timeout=None):
+        Executor.send(client, {"cmd": cmd, "capture_output": capture_output, "timeout": timeout})
+        return Executor.receive(client)
+    yield request
+    client.close()
+    thread.join(5)
+    assert not thread.is_alive()
+
+def test_helper_returns_output_exit_code_and_usage(helper):
+    reply = helper(["sh", "-c", "echo out; echo err >&2; exit 3"])
+    assert (reply["returncode"], reply["stdout"], reply["stderr"]) == (3, "out\n", "err\n")
+    assert set(reply["rusage"]) == {"user", "sys", "maxrss_kb", "inblock", "oublock"}
+    assert helper("echo a; echo b")["stdout"] == "a\nb\n"
+    assert helper(["printf", "%s|", "a b", "c;d"])["stdout"] == "a b|c;d|"
+
+def test_helper_reports_timeouts(helper):
+    started = time.monotonic()
+    reply = helper(["sh", "-c", "echo partial; sleep 10"], timeout=0.3)
+    assert reply["timed_out"] and time.monotonic() - started < 5
+    assert helper(["true"])["returncode"] == 0
+
+def test_helper_stops_when_the_client_disconnects():
+    client, server = socket.socketpair()
+    thread = threading.Thread(target=executor.handle, args=(server,))
+    thread.start()
+    client.close()
+    thread.join(5)
+    assert not thread.is_alive()
+
+def test_threads_do_not_wait_for_each_other():
+    # Without sudo: the helper runs as the current user.
+    with mock.patch("os.geteuid", return_value=0): shared = Executor()
+    try:
+        slow = threading.Thread(target=shared.run, args=(["sleep", "2"],))
+        slow.start()
+        time.sleep(0.2)
+        started = time.monotonic()
+        result = shared.run(["echo", "fast"])
+        assert (result.returncode, result.stdout) == (0, "fast\n")
+        assert time.monotonic() - started < 1
+        slow.join()
+        with pytest.raises(subprocess.TimeoutExpired): shared.run(["sleep", "10"], timeout=0.3)
+        assert len(shared.connections) == 3
+    finally: shared.close()
+    assert shared.process.returncode == 0
+    assert not os.path.exists(shared.directory)
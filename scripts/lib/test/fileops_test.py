@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+FileOps against the commands it replaces: native find must list what GNU find
+lists for the arguments Shell.find would pass it, and Shell.file_write must
+replace a file whole or not at all.
+
+Usage:
+  python3 -m pytest scripts/lib/test/fileops_test.py
+"""
+import os, subprocess, sys
+from pathlib import Path
+from unittest import mock
+import pytest
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib import Shell
+from lib.fileops import FileOps
+
+TREE = ["flake.nix", "config.json", "modules/settings.nix", "modules/hosts/x86_64/desktop.nix",
+        "scripts/bin/diff.py", "scripts/lib/shell.py", ".git/HEAD", ".git/objects/ab/cdef",
+        "secrets/hashed_password.txt", ".direnv/flake-profile", "result/bin/switch"]
+LINKS = {"current": "modules/hosts", "dangling": "missing", "scripts/bin/python": "/usr/bin/python3"}
+
+# (pattern, ignore_pattern, kind) as Shell.find receives them.
+QUERIES = [
+    ("*", None, None),
+    ("*", None, "f"),
+    ("*", None, "d"),
+    ("*/scripts/* */bin/*", None, None),
+    ("*", "*/secrets* */.venv* */.direnv* */.git*", "f"),
+    ("*", "*/secrets* */.venv* */.direnv* */.git*", "d"),
+    ("*.nix", "*/hosts/*", None),
+    ("*/bin/*", "*/result/*", "f"),
+]
+
+def build(root):
+    for name in TREE:
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(name)
+    for name, target in LINKS.items(): (root / name).symlink_to(target)
+
+def gnu_find(top, pattern, ignore_pattern, kind):
+    def patterns(prefix, value):
+        if not value: return []
+        if " " not in value: return [*prefix, "-path", value]
+        joined = [word for p in value.split() for word in ("-o", "-path", p)][1:]
+        return [*prefix, "(", *joined, ")"]
+    command = ["find", top, *patterns([], pattern), *(["-type", kind] if kind else []),
+               *patterns(["-not"], ignore_pattern)]
+    return sorted(subprocess.run(command, capture_output=True, text=True, check=True).stdout.splitlines())
+
+def native_find(top, pattern, ignore_pattern, kind):
+    return sorted(FileOps.find(top, FileOps.patterns(pattern), FileOps.patterns(ignore_pattern),
+                               FileOps.patterns(ignore_pattern, prunable=True), kind))
+
+def test_native_find_matches_gnu_find(tmp_path):
+    build(tmp_path)
+    for query in QUERIES:
+        assert native_find(str(tmp_path), *query) == gnu_find(str(tmp_path), *query), query
+
+def test_native_find_inside_a_root(tmp_path):
+    build(tmp_path / "etc" / "nixos")
+    found = sorted(FileOps.find("/etc/nixos", FileOps.patterns("*.nix"), None, None, "f", root=str(tmp_path)))
+    assert found == ["/etc/nixos/flake.nix", "/etc/nixos/modules/hosts/x86_64/desktop.nix",
+                     "/etc/nixos/modules/settings.nix"]
+
+def test_file_write_replaces_the_file_and_keeps_its_mode(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text("old")
+    path.chmod(0o600)
+    Shell().file_write(str(path), "new")
+    assert path.read_text() == "new"
+    assert path.stat().st_mode & 0o777 == 0o600
+    assert os.listdir(tmp_path) == ["config.json"]
+
+def test_file_write_creates_missing_directories(tmp_path):
+    path = tmp_path / "cache" / "nixos" / "system.json"
+    Shell().file_write(str(path), "{}", fsync=False)
+    assert path.read_text() == "{}"
+    assert path.stat().st_mode & 0o777 == 0o644
+
+def test_failed_file_write_leaves_the_old_file(tmp_path):
+    path = tmp_path / "config.json"
+    path.write_text("old")
+    with mock.patch("os.replace", side_effect=OSError("disk full")), pytest.raises(OSError):
+        Shell().file_write(str(path), "new")
+    assert path.read_text() == "old"
+    assert os.listdir(tmp_path) == ["config.json"]
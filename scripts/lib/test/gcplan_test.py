@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+GcPlan selection: which generations keep_last, keep_days and free_bytes
+delete, that the current generation of every profile survives all of them,
+and that both JSON shapes of `nix path-info` give the same plan.
+
+Usage:
+  python3 -m pytest scripts/lib/test/gcplan_test.py
+"""
+import datetime, json, subprocess, sys
+from pathlib import Path
+import pytest
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib import Shell
+from lib.gcplan import GcPlan
+
+MIB = 2**20
+SYSTEM = GcPlan.SYSTEM
+HOME = "/home/alice/.local/state/nix/profiles/home-manager"
+GLIBC = "/nix/store/glibc"
+# profile -> (generation, days old, current, store paths only it references with their sizes in MiB)
+GENERATIONS = {
+    SYSTEM: [(1, 30, False, {"kernel-1": 100}), (2, 20, False, {"kernel-2": 200}),
+             (3, 10, False, {"kernel-3": 300}), (4, 2, False, {"kernel-4": 400}), (5, 1, True, {"kernel-5": 500})],
+    HOME: [(1, 40, False, {"firefox-1": 50}), (2, 5, True, {"firefox-2": 60})],
+}
+ROOTS = ["/home/alice/project/result -> /nix/store/devshell",
+         f"{SYSTEM}-5-link -> /nix/store/system-5", "{censored} -> /nix/store/secret"]
+
+# A Shell whose commands answer from GENERATIONS, so Shell.path_info parses
+# `nix path-info` output in either the list shape (Nix before 2.19) or the dict shape.
+class FakeShell(Shell):
+    def __init__(self, shape):
+        super().__init__()
+        self.shape = shape
+        now = datetime.datetime.now().replace(microsecond=0)
+        self.infos = {GLIBC: {"narSize": 10 * MIB, "references": []},
+                      "/nix/store/devshell": {"narSize": MIB, "references": [GLIBC]}}
+        self.listings, self.links = {}, {}
+        for profile, generations in GENERATIONS.items():
+            lines = []
+            for number, days, current, unique in generations:
+                date = now - datetime.timedelta(days=days)
+                lines.append(f"   {number}   {date:%Y-%m-%d %H:%M:%S}   {'(current)' if current else ''}")
+                path = f"/nix/store/{profile.rpartition('/')[2]}-{number}"
+                self.links[f"{profile}-{number}-link"] = path
+                self.infos[path] = {"narSize": MIB, "references": [GLIBC, *(f"/nix/store/{name}" for name in unique)]}
+                self.infos.update({f"/nix/store/{name}": {"narSize": size * MIB, "references": []}
+                                   for name, size in unique.items()})
+            self.listings[profile] = "\n".join(lines)
+    def exists(self, *paths):
+        return all(path in GENERATIONS for path in paths)
+    def realpaths(self, *paths):
+        return [self.links[path] for path in paths]
+    def run(self, cmd, capture_output=True, read_only=False):
+        if cmd[:2] == ["nix-store", "--gc"]: output = "\n".join(ROOTS)
+        else: output = self.listings[cmd[2]]
+        return subprocess.CompletedProcess(cmd, 0, output, "")
+    def run_many(self, cmds):
+        return [subprocess.CompletedProcess(cmd, 0, self.path_info_json(cmd[6:]), "") for cmd in cmds]
+    def path_info_json(self, paths):
+        closure, stack = {}, list(paths)
+        while stack:
+            if (path := stack.pop()) in closure: continue
+            closure[path] = self.infos[path]
+            stack.extend(closure[path]["references"])
+        if self.shape == "dict": return json.dumps(closure)
+        return json.dumps([{"path": path, **info} for path, info in closure.items()])
+
+def plan(shape="dict", **limits):
+    return GcPlan(FakeShell(shape), ["alice", "bob"], **limits)
+
+def deleted(plan):
+    return [(generation["profile"], generation["number"]) for generation in plan.generations if generation["delete"]]
+
+def test_both_path_info_shapes_give_the_same_plan():
+    by_list, by_dict = plan("list"), plan("dict")
+    # The list shape keeps each entry's "path" field.
+    assert {path: {**info, "path": path} for path, info in by_dict.infos.items()} == by_list.infos
+    assert by_list.describe() == by_dict.describe()
+
+def test_without_limits_everything_but_the_current_generations_goes():
+    gc = plan()
+    assert gc.profiles == [SYSTEM, HOME]
+    assert deleted(gc) == [(SYSTEM, 1), (SYSTEM, 2), (SYSTEM, 3), (SYSTEM, 4), (HOME, 1)]
+    # glibc stays alive through the current generations and the devshell root.
+    assert gc.freed == (101 + 201 + 301 + 401 + 51) * MIB
+    assert [generation["unique"] for generation in gc.generations] == \
+        [size * MIB for size in (101, 201, 301, 401, 501, 51, 61)]
+
+def test_keep_last_protects_the_newest_generations_of_each_profile():
+    gc = plan(keep_last=2)
+    assert deleted(gc) == [(SYSTEM, 1), (SYSTEM, 2), (SYSTEM, 3)]
+    assert [generation["keep"] for generation in gc.generations] == \
+        [None, None, None, "last 2", "current", "last 2", "current"]
+
+def test_keep_days_protects_recent_generations():
+    gc = plan(keep_days=15)
+    assert deleted(gc) == [(SYSTEM, 1), (SYSTEM, 2), (HOME, 1)]
+    assert gc.generations[2]["keep"] == gc.generations[3]["keep"] == "newer than 15 days"
+
+def test_free_bytes_deletes_oldest_first_until_enough_is_freed():
+    gc = plan(free_bytes=200 * MIB)
+    assert deleted(gc) == [(SYSTEM, 1), (SYSTEM, 2), (HOME, 1)]
+    assert gc.freed == (51 + 101 + 201) * MIB
+    assert "keep (enough freed)" in gc.describe()[3]
+
+@pytest.mark.parametrize("limits", [{"keep_last": 0}, {"keep_days": 0}, {"free_bytes": 10**15},
+                                    {"keep_last": 0, "keep_days": 0, "free_bytes": 10**15}])
+def test_current_generations_are_never_deleted(limits):
+    gc = plan(**limits)
+    current = [generation for generation in gc.generations if generation["current"]]
+    assert [(generation["number"], generation["keep"], generation["delete"]) for generation in current] == \
+        [(5, "current", False), (2, "current", False)]
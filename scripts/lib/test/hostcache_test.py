@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+HostCache, shared by the evaluation and store verification caches: where the
+file lives, when caching is off, and that damaged files read as misses.
+
+Usage:
+  python3 -m pytest scripts/lib/test/hostcache_test.py
+"""
+import sys
+from pathlib import Path
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib.hostcache import HostCache
+from lib.replay import Recording
+
+def test_location_follows_the_environment(tmp_path, monkeypatch):
+    cache = HostCache("NIXOS_TEST_CACHE", "test.json")
+    monkeypatch.delenv(Recording.RECORD, raising=False)
+    monkeypatch.delenv(Recording.REPLAY, raising=False)
+    monkeypatch.delenv("NIXOS_TEST_CACHE", raising=False)
+    assert cache.location() == "/var/cache/nixos-scripts/test.json"
+    monkeypatch.setenv("NIXOS_TEST_CACHE", str(tmp_path / "test.json"))
+    assert cache.location() == str(tmp_path / "test.json")
+    monkeypatch.setenv(Recording.REPLAY, str(tmp_path / "trace.jsonl"))
+    assert cache.location() is None
+    monkeypatch.delenv(Recording.REPLAY)
+    monkeypatch.setenv("NIXOS_TEST_CACHE", "")
+    assert cache.location() is None
+
+def test_round_trip_and_misses(tmp_path):
+    path = str(tmp_path / "nested" / "test.json")
+    assert HostCache.read(path) == (False, None)
+    HostCache.write(path, {"a": [1, 2]})
+    assert HostCache.read(path) == (True, {"a": [1, 2]})
+    Path(path).write_text("{\"a\": ")
+    assert HostCache.read(path) == (False, None)
+    assert HostCache.read(None) == (False, None)
+    HostCache.write(None, {"a": 1})
+    HostCache.write(str(tmp_path / "nested" / "test.json" / "below-a-file"), {})
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Memo bookkeeping: the least recently used entry is the one evicted, and
+invalidation drops exactly the entries whose paths overlap the change.
+
+Usage:
+  python3 -m pytest scripts/lib/test/memo_test.py
+"""
+import sys
+from pathlib import Path
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib import Shell
+from lib.memo import Memo
+
+def test_put_evicts_the_least_recently_used_entry():
+    memo = Memo(size=2)
+    memo.put("a", 1)
+    memo.put("b", 2)
+    assert memo.get("a") == (True, 1)
+    memo.put("c", 3)
+    assert memo.get("b") == (False, None)
+    assert memo.get("a") == (True, 1)
+    assert memo.get("c") == (True, 3)
+    assert memo.stats()["entries"] == 2
+
+def test_put_refreshes_an_existing_entry():
+    memo = Memo(size=2)
+    memo.put("a", 1)
+    memo.put("b", 2)
+    memo.put("a", 10)
+    memo.put("c", 3)
+    assert memo.get("a") == (True, 10)
+    assert memo.get("b") == (False, None)
+
+def test_invalidate_drops_overlapping_paths_only():
+    memo = Memo()
+    memo.put("nixos", 1, ["/etc/nixos"], tree=True)
+    memo.put("settings", 2, ["/etc/nixos/modules/settings.nix"])
+    memo.put("sibling", 3, ["/etc/nixos-old"])
+    memo.put("pure", 4)
+    memo.put("realpath", 5, ["/etc/nixos"])
+    memo.invalidate("/etc/nixos/modules")
+    assert memo.get("nixos") == (False, None)
+    assert memo.get("settings") == (False, None)
+    assert memo.get("sibling") == (True, 3)
+    assert memo.get("pure") == (True, 4)
+    # Only entries covering the tree go stale when something below their path changes.
+    assert memo.get("realpath") == (True, 5)
+    assert memo.stats()["invalidations"] == 2
+
+def test_invalidate_paths_keeps_entries_without_paths():
+    memo = Memo()
+    memo.put("stat", 1, ["/etc/hostname"])
+    memo.put("whoami", 2)
+    memo.invalidate_paths()
+    assert memo.get("stat") == (False, None)
+    assert memo.get("whoami") == (True, 2)
+
+def test_drop_takes_a_predicate_over_paths():
+    memo = Memo()
+    memo.put("one", 1, ["/a"])
+    memo.put("two", 2, ["/a", "/b"])
+    memo.drop(lambda paths: len(paths) > 1)
+    assert memo.get("one") == (True, 1)
+    assert memo.get("two") == (False, None)
+    assert memo.stats() == {"hits": 1, "misses": 1, "invalidations": 1, "entries": 1, "hit_rate": 0.5}
+
+def test_classify_and_writes():
+    assert Memo.classify("stat -c %U /etc/nixos/") == ("/etc/nixos",)
+    assert Memo.classify("stat /etc/nixos | head") is None
+    assert Memo.classify(["rm", "-rf", "/etc/nixos"]) is None
+    assert Memo.writes(["nix", "path-info", "--json", "/nix/store/abc"]) == ()
+    assert Memo.writes(["nix", "eval", "--json", "/etc/nixos#nixosConfigurations.desktop"]) == ("/nix/store",)
+    assert Memo.writes(["nix-store", "--verify-path", "/nix/store/abc"]) is None
+    assert Memo.writes("nix build .#nixosConfigurations.desktop") is None
+
+def test_shell_queries_see_what_commands_wrote(tmp_path, monkeypatch):
+    monkeypatch.setattr(Shell, "memo", Memo())
+    sh, store, other = Shell(), tmp_path / "store", tmp_path / "other"
+    store.mkdir()
+    assert not sh.exists(str(store / "built")) and not sh.exists(str(other))
+    sh.run(["touch", str(store / "built")], sudo=False, writes=[str(store)])
+    assert sh.exists(str(store / "built"))
+    other.write_text("")
+    assert not sh.exists(str(other))
+    sh.run(["true"], sudo=False)
+    assert sh.exists(str(other))
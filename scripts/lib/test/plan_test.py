@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Ordering of deferred work: Plan stages keep every operation after the ones it
+depends on while merging independent ones, and Pipeline starts a stage only
+after the stages it needs, rejecting needs that wait on each other.
+
+Usage:
+  python3 -m pytest scripts/lib/test/plan_test.py
+"""
+import sys, threading
+from pathlib import Path
+import pytest
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib import Shell
+from lib.pipeline import Pipeline
+from lib.plan import Plan
+
+def commands(plan):
+    return [[cmd for step in stage for cmd in step.commands(Shell.BATCH_SIZE)] for stage in plan.stages()]
+
+def test_independent_operations_merge_into_one_stage():
+    plan = Plan(Shell())
+    plan.add("mkdir", ["/etc/nixos/modules"])
+    plan.add("mkdir", ["/etc/nixos/secrets"])
+    plan.add("chmod", ["/etc/nixos/secrets"], "700")
+    assert commands(plan) == [[["mkdir", "-p", "--", "/etc/nixos/modules", "/etc/nixos/secrets"]],
+                              [["chmod", "-R", "700", "--", "/etc/nixos/secrets"]]]
+
+def test_dependent_operations_keep_their_order():
+    plan = Plan(Shell())
+    plan.add("rm", ["/etc/nixos/result"])
+    plan.add("mkdir", ["/etc/nixos/result/bin"])
+    plan.add("chown", ["/etc/nixos/result"], "alice:users")
+    plan.add("chmod", ["/etc/nixos/result"], "755")
+    assert commands(plan) == [[["rm", "-rf", "--", "/etc/nixos/result"]],
+                              [["mkdir", "-p", "--", "/etc/nixos/result/bin"]],
+                              [["chown", "-R", "alice:users", "--", "/etc/nixos/result"],
+                               ["chmod", "-R", "755", "--", "/etc/nixos/result"]]]
+
+def test_covered_operations_are_dropped():
+    plan = Plan(Shell())
+    plan.add("rm", ["/etc/nixos/.direnv"])
+    plan.add("rm", ["/etc/nixos/.direnv/flake-profile"])
+    plan.add("rm", ["/etc/nixos/result"])
+    plan.add("mkdir", ["/etc/nixos/a/b"])
+    plan.add("mkdir", ["/etc/nixos/a"])
+    assert commands(plan) == [[["rm", "-rf", "--", "/etc/nixos/.direnv", "/etc/nixos/result"],
+                               ["mkdir", "-p", "--", "/etc/nixos/a/b"]]]
+
+def test_partly_covered_operations_run_after_the_covering_one():
+    plan = Plan(Shell())
+    plan.add("rm", ["/etc/nixos/.direnv"])
+    plan.add("rm", ["/etc/nixos/.direnv/flake-profile", "/etc/nixos/result"])
+    assert commands(plan) == [[["rm", "-rf", "--", "/etc/nixos/.direnv"]],
+                              [["rm", "-rf", "--", "/etc/nixos/.direnv/flake-profile", "/etc/nixos/result"]]]
+
+def test_commands_without_paths_are_barriers():
+    plan = Plan(Shell())
+    plan.add("mkdir", ["/etc/nixos/a"])
+    plan.command(["git", "add", "-A"], writes=None)
+    plan.add("mkdir", ["/etc/nixos/b"])
+    assert commands(plan) == [[["mkdir", "-p", "--", "/etc/nixos/a"]], [["git", "add", "-A"]],
+                              [["mkdir", "-p", "--", "/etc/nixos/b"]]]
+
+def test_pipeline_runs_stages_after_their_needs():
+    order, lock = [], threading.Lock()
+    def stage(name):
+        def run():
+            with lock: order.append(name)
+            return name
+        return run
+    pipeline = Pipeline()
+    pipeline.add("upgrade", stage("upgrade"), needs=["config", "clean"])
+    pipeline.add("clean", stage("clean"), needs=["missing"])
+    pipeline.add("config", stage("config"))
+    pipeline.add("switch", stage("switch"), needs=["upgrade"], exclusive=True)
+    assert pipeline.run() == {"upgrade": "upgrade", "clean": "clean", "config": "config", "switch": "switch"}
+    assert order.index("upgrade") > max(order.index("config"), order.index("clean"))
+    assert order[-1] == "switch"
+
+def test_pipeline_rejects_stages_that_wait_on_each_other():
+    pipeline = Pipeline()
+    pipeline.add("config", lambda: None)
+    pipeline.add("build", lambda: None, needs=["switch", "config"])
+    pipeline.add("switch", lambda: None, needs=["build"])
+    with pytest.raises(RuntimeError, match="Stages build, switch wait on each other"): pipeline.run()
+
+def test_pipeline_rejects_duplicate_stages():
+    pipeline = Pipeline()
+    pipeline.add("config", lambda: None)
+    with pytest.raises(ValueError): pipeline.add("config", lambda: None)
+
+def test_dry_run_redacts_sensitive_commands(capsys):
+    sh = Shell()
+    with sh.plan(dry_run=True):
+        sh.run(["mkpasswd", "-m", "sha-512", "hunter2"], sensitive="hunter2")
+        list(sh.stream(["chpasswd", "--password", "hunter2"], sensitive=["hunter2"]))
+        sh.run_many([["echo", "hunter2"]], sensitive="hunter2")
+    printed = capsys.readouterr().out
+    assert "hunter2" not in printed
+    assert "mkpasswd -m sha-512 ***" in printed
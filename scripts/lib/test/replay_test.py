@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Recording round trip: commands run under NIXOS_SHELL_RECORD replay under
+NIXOS_SHELL_REPLAY with the same output and exit codes, without running.
+
+Usage:
+  python3 -m pytest scripts/lib/test/replay_test.py
+"""
+import sys
+from pathlib import Path
+import pytest
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib import Shell
+from lib.memo import Memo
+from lib.replay import Recording, ReplayMiss
+
+@pytest.fixture
+def recording(tmp_path, monkeypatch):
+    monkeypatch.setattr(Recording, "writer", None)
+    monkeypatch.setattr(Recording, "entries", None)
+    monkeypatch.setattr(Shell, "memo", Memo())
+    monkeypatch.delenv(Recording.REPLAY, raising=False)
+    monkeypatch.delenv(Recording.LATENCY, raising=False)
+    def record(name):
+        monkeypatch.setenv(Recording.RECORD, str(tmp_path / name))
+    def replay(name):
+        Recording.writer.close()
+        monkeypatch.delenv(Recording.RECORD)
+        monkeypatch.setenv(Recording.REPLAY, str(tmp_path / name))
+        monkeypatch.setattr(Shell, "memo", Memo())
+    return record, replay
+
+def session(sh, counter):
+    # Output that changes on every run, so a replay cannot pass by rerunning.
+    return [Shell.stdout(sh.run(f"echo $(( $(cat {counter}) + 1 )) | tee {counter}.next && mv {counter}.next {counter}",
+                                sudo=False)),
+            sh.run(["sh", "-c", "echo failed >&2; exit 3"], sudo=False, check=False).returncode,
+            [result.stdout for result in sh.run_many([["cat", str(counter)], ["echo", "many"]], sudo=False)],
+            list(sh.stream(["printf", "a\\nb\\n"], sudo=False))]
+
+@pytest.mark.parametrize("name", ["trace.jsonl", "trace.jsonl.gz"])
+def test_replay_returns_what_was_recorded(tmp_path, recording, name):
+    record, replay = recording
+    counter = tmp_path / "counter"
+    counter.write_text("1")
+    record(name)
+    recorded = session(Shell(), counter)
+    assert recorded == ["2", 3, ["2\n", "many\n"], ["a", "b"]]
+    replay(name)
+    assert session(Shell(), counter) == recorded
+    assert counter.read_text() == "2\n"
+
+def test_replay_serves_results_in_order_then_repeats_the_last(tmp_path, recording):
+    record, replay = recording
+    counter = tmp_path / "counter"
+    counter.write_text("0")
+    bump = f"echo $(( $(cat {counter}) + 1 )) > {counter}.next && mv {counter}.next {counter} && cat {counter}"
+    record("trace.jsonl")
+    sh = Shell()
+    assert [Shell.stdout(sh.run(bump, sudo=False)) for _ in range(2)] == ["1", "2"]
+    replay("trace.jsonl")
+    assert [Shell.stdout(sh.run(bump, sudo=False)) for _ in range(3)] == ["1", "2", "2"]
+    with pytest.raises(ReplayMiss): sh.run(["echo", "unrecorded"], sudo=False)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+ChrootSession framing against a real bash session standing in for
+nixos-enter, with the host as the chroot: each command's exit code, stdout
+and stderr come back separately, argv commands reach the program unparsed,
+and a failing, timed-out or marker-printing command leaves the session usable.
+
+Usage:
+  python3 -m pytest scripts/lib/test/session_test.py
+"""
+import os, subprocess, sys, time
+from pathlib import Path
+import pytest
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib import Shell, session
+from lib.memo import Memo
+from lib.replay import Recording
+from lib.session import ChrootSession
+
+POPEN = subprocess.Popen
+
+@pytest.fixture(autouse=True)
+def enter(monkeypatch):
+    def popen(command, **kwargs):
+        assert command[command.index("nixos-enter"):][:3] == ["nixos-enter", "--root", ""]
+        return POPEN(["bash", "--noprofile", "--norc"], **kwargs)
+    monkeypatch.setattr(session.subprocess, "Popen", popen)
+    monkeypatch.setattr(Shell, "memo", Memo())
+    monkeypatch.delenv(Recording.RECORD, raising=False)
+    monkeypatch.delenv(Recording.REPLAY, raising=False)
+
+@pytest.fixture
+def chroot():
+    chroot = ChrootSession("")
+    yield chroot
+    chroot.close()
+
+def test_commands_report_exit_code_stdout_and_stderr(chroot):
+    result = chroot.run("echo out; echo err >&2; exit 3")
+    assert (result.returncode, result.stdout, result.stderr) == (3, "out\n", "err\n")
+    result = chroot.run(["true"])
+    assert (result.returncode, result.stdout, result.stderr) == (0, "", "")
+
+def test_argv_commands_are_not_reparsed(chroot):
+    assert chroot.run(["printf", "%s|", "a b", "c;d", "$HOME", "'q'"]).stdout == "a b|c;d|$HOME|'q'|"
+
+def test_output_resembling_the_marker_is_only_output(chroot):
+    result = chroot.run(["echo", f"{chroot.marker} 7"])
+    assert (result.returncode, result.stdout) == (0, f"{chroot.marker} 7\n")
+    assert chroot.run("exit 4").returncode == 4
+
+def test_timed_out_commands_raise_and_keep_the_session(chroot):
+    started = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        chroot.run(["sleep", "30"], timeout=0.2)
+    assert time.monotonic() - started < 10
+    assert chroot.run(["echo", "still here"]).stdout == "still here\n"
+
+def test_exited_session_raises(chroot):
+    chroot.process.kill()
+    chroot.process.wait()
+    with pytest.raises(RuntimeError, match="exited"):
+        chroot.run(["true"])
+
+def test_close_removes_the_output_directory():
+    chroot = ChrootSession("")
+    assert os.path.isdir(chroot.directory)
+    chroot.close()
+    assert not os.path.exists(chroot.directory)
+
+def test_shell_runs_captured_commands_in_the_session(capsys):
+    sh = Shell()
+    with sh.chroot("", session=True):
+        active = sh.sessions[-1]
+        assert sh.run(["printf", "%s", "a b;c"]).stdout == "a b;c"
+        with pytest.raises(subprocess.CalledProcessError) as error:
+            sh.run("echo no >&2; exit 5")
+        assert (error.value.returncode, error.value.stderr) == (5, "no\n")
+    assert active.process.poll() is not None
+    assert "LOG: [] printf %s 'a b;c'" in capsys.readouterr().out
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Shell against the real filesystem and real commands: path queries resolve in
+process inside a chroot, falling back to a command only when the answer is
+not readable from here.
+
+Usage:
+  python3 -m pytest scripts/lib/test/shell_test.py
+"""
+import os, subprocess, sys, time
+from pathlib import Path
+import pytest
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib import Shell
+from lib.memo import Memo
+from lib.replay import Recording
+
+# Runs every command as the current user and keeps the argv of each one.
+class UserShell(Shell):
+    def __init__(self):
+        super().__init__()
+        self.commands = []
+    def run(self, cmd, **kwargs):
+        self.commands.append(cmd)
+        return super().run(cmd, **{**kwargs, "sudo": False})
+    def stream(self, cmd, **kwargs):
+        self.commands.append(cmd)
+        return super().stream(cmd, **{**kwargs, "sudo": False})
+    def run_many(self, cmds, **kwargs):
+        cmds = list(cmds)
+        self.commands.extend(cmds)
+        return super().run_many(cmds, **{**kwargs, "sudo": False})
+
+@pytest.fixture
+def sh(monkeypatch):
+    monkeypatch.setattr(Shell, "memo", Memo())
+    monkeypatch.delenv(Recording.RECORD, raising=False)
+    monkeypatch.delenv(Recording.REPLAY, raising=False)
+    return UserShell()
+
+@pytest.fixture
+def root(tmp_path):
+    (tmp_path / "etc/nixos/modules").mkdir(parents=True)
+    (tmp_path / "etc/nixos/flake.nix").write_text("{ }")
+    (tmp_path / "etc/current").symlink_to("/etc/nixos")
+    (tmp_path / "etc/modules").symlink_to("nixos/modules")
+    (tmp_path / "etc/escape").symlink_to("/../..")
+    return tmp_path
+
+def test_path_names_match_coreutils(sh):
+    assert [sh.basename(path) for path in ("/etc/nixos/", "/etc/nixos", "nixos", "/", "")] == \
+        ["nixos", "nixos", "nixos", "/", ""]
+    assert [sh.dirname(path) for path in ("/etc/nixos/", "/etc", "nixos", "/", "")] == \
+        ["/etc", "/", ".", "/", "."]
+    assert sh.parent_name("/etc/nixos/modules/hosts/x86_64/desktop/desktop.nix") == "desktop"
+    assert sh.commands == []
+
+def test_queries_resolve_links_inside_the_chroot(sh, root):
+    with sh.chroot(str(root)):
+        assert sh.realpath("/etc/current") == "/etc/nixos"
+        assert sh.realpaths("/etc/modules", "/etc/current/flake.nix") == ["/etc/nixos/modules", "/etc/nixos/flake.nix"]
+        # Absolute targets and `..` stay below the chroot's root.
+        assert sh.realpath("/etc/escape/etc/current") == "/etc/nixos"
+        assert sh.is_symlink("/etc/current") and not sh.is_symlink("/etc/nixos")
+        assert sh.is_dir("/etc/current") and not sh.is_dir("/etc/nixos/flake.nix")
+        assert sh.exists("/etc/current/flake.nix", "/etc/modules")
+        assert not sh.exists("/etc/current/flake.nix", "/etc/nixos/missing")
+    assert sh.commands == []
+
+def test_unreadable_paths_fall_back_to_commands(sh, root, monkeypatch):
+    def denied(path, *args, **kwargs): raise PermissionError(13, "Permission denied", path)
+    monkeypatch.setattr(os, "lstat", denied)
+    monkeypatch.setattr(os, "readlink", denied)
+    target = str(root / "etc/modules")
+    assert sh.realpath(target) == str(root / "etc/nixos/modules")
+    assert sh.is_dir(target) and sh.is_symlink(target)
+    assert sh.commands == [["realpath", "--", target], ["test", "-d", target], ["test", "-L", target]]
+
+def test_stream_yields_lines_while_the_command_runs(sh):
+    lines, started = sh.stream(["sh", "-c", "echo first; sleep 30; echo second"]), time.monotonic()
+    assert next(lines) == "first"
+    # Closing the stream early kills the command.
+    lines.close()
+    assert time.monotonic() - started < 10
+
+def test_stream_splits_records_on_a_separator(sh):
+    assert list(sh.stream(["printf", "a\\0b c\\0d"], separator=b"\0")) == [b"a", b"b c", b"d"]
+
+def test_stream_fails_after_its_output(sh, capsys):
+    lines = []
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        for line in sh.stream("echo out; echo hunter2 >&2; exit 4", sensitive="hunter2"): lines.append(line)
+    assert lines == ["out"]
+    assert (error.value.returncode, error.value.stderr) == (4, "hunter2\n")
+    assert "hunter2" not in capsys.readouterr().err
+    assert list(sh.stream("echo out; exit 4", check=False)) == ["out"]
+
+def test_run_many_returns_results_in_input_order(sh):
+    results = sh.run_many([["sh", "-c", "sleep 0.3; echo 0"], ["sh", "-c", "sleep 0.1; echo 1"], ["echo", "2"]])
+    assert [result.stdout for result in results] == ["0\n", "1\n", "2\n"]
+
+def test_run_many_bounds_concurrency(sh):
+    started = time.monotonic()
+    sh.run_many([["sleep", "0.2"]] * 4, concurrency=2)
+    assert time.monotonic() - started >= 0.4
+
+def test_run_many_failure_cancels_the_rest(sh):
+    started = time.monotonic()
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        sh.run_many([["sh", "-c", "echo bad >&2; exit 3"], ["sleep", "30"]])
+    assert (error.value.returncode, error.value.stderr) == (3, "bad\n")
+    assert time.monotonic() - started < 10
+
+def test_run_many_collects_failures_in_place(sh):
+    results = sh.run_many([["true"], ["sh", "-c", "exit 3"], ["echo", "ok"]], on_error="collect")
+    assert [(result.returncode, result.stdout) for result in results] == [(0, ""), (3, ""), (0, "ok\n")]
+
+ARGUMENTS = ["a b", "c;d", "$HOME", "'q'", "*", ""]
+
+def test_argv_commands_are_not_split_by_a_shell(sh):
+    printf = ["printf", "%s|", *ARGUMENTS]
+    expected = "a b|c;d|$HOME|'q'|*||"
+    assert sh.run(printf).stdout == expected
+    assert [result.stdout for result in sh.run_many([printf, printf])] == [expected, expected]
+    assert list(sh.stream(["printf", "%s\\n", *ARGUMENTS])) == ARGUMENTS
+    # Strings still go through /bin/sh for callers that want its syntax.
+    assert sh.run("echo a; echo b").stdout == "a\nb\n"
+
+def test_wrappers_are_argv_prefixes():
+    assert Shell().command(["ls", "a b"], env="LANG=C") == (
+        ["env", "LANG=C", "ls", "a b"], ["sudo", "env", "LANG=C", "ls", "a b"])
+    chrooted = Shell()
+    chrooted.chroots.append("/mnt")
+    assert chrooted.command(["ls", "a b"], sudo=False) == (["nixos-enter", "--root", "/mnt", "--", "ls", "a b"],) * 2
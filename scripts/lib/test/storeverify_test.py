@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+StoreVerify cache: closure paths verified at the same registration time and
+hash are skipped, anything new, re-registered or re-hashed is checked again,
+and paths that failed verification are never recorded as verified.
+
+Usage:
+  python3 -m pytest scripts/lib/test/storeverify_test.py
+"""
+import json, subprocess, sys
+from pathlib import Path
+import pytest
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib.replay import Recording
+from lib.storeverify import StoreVerify
+
+SYSTEM = "/nix/store/aaaa-nixos-system"
+GLIBC = "/nix/store/bbbb-glibc"
+BASH = "/nix/store/cccc-bash"
+
+# Stands in for the Shell StoreVerify.verify is given: a closure to report and
+# nix-store results keyed by path, recording every path it was asked about.
+class FakeShell:
+    def __init__(self, infos):
+        self.infos = infos
+        self.failures = {}
+        self.verified = []
+        self.repaired = []
+    def path_info(self, *groups):
+        assert groups == ([SYSTEM],)
+        return self.infos
+    def run_many(self, cmds, concurrency=4, on_error="cancel", writes=None):
+        assert writes == ["/nix/var/nix/db"]
+        results = []
+        for cmd in cmds:
+            paths = cmd[2:]
+            self.verified.extend(paths)
+            errors = [self.failures[path] for path in paths if path in self.failures]
+            results.append(subprocess.CompletedProcess(cmd, 1 if errors else 0, "", "\n".join(errors)))
+        return results
+    def run(self, cmd, capture_output=True):
+        assert cmd[:2] == ["nix-store", "--repair-path"]
+        self.repaired.extend(cmd[2:])
+
+def info(time, digest, size=1024, valid=True):
+    return {"registrationTime": time, "narHash": f"sha256-{digest}", "narSize": size, "valid": valid}
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    path = tmp_path / "cache" / "verified.json"
+    monkeypatch.setenv(StoreVerify.ENV, str(path))
+    monkeypatch.delenv(Recording.RECORD, raising=False)
+    monkeypatch.delenv(Recording.REPLAY, raising=False)
+    return path
+
+def closure():
+    return {SYSTEM: info(100, "system"), GLIBC: info(50, "glibc"), BASH: info(60, "bash")}
+
+def test_second_run_only_verifies_what_changed(cache):
+    sh = FakeShell(closure())
+    assert StoreVerify.verify(sh, SYSTEM, None) == []
+    assert sorted(sh.verified) == [SYSTEM, GLIBC, BASH]
+    assert json.loads(cache.read_text())[GLIBC] == [50, "sha256-glibc"]
+    sh.verified = []
+    StoreVerify.verify(sh, SYSTEM)
+    assert sh.verified == []
+    sh.infos = {**closure(), GLIBC: info(70, "glibc"), BASH: info(60, "bash2"),
+                "/nix/store/dddd-zlib": info(80, "zlib")}
+    StoreVerify.verify(sh, SYSTEM)
+    assert sorted(sh.verified) == [GLIBC, BASH, "/nix/store/dddd-zlib"]
+
+def test_invalid_paths_are_not_verified(cache):
+    sh = FakeShell({**closure(), "/nix/store/eeee-gone": info(90, "gone", valid=False)})
+    StoreVerify.verify(sh, SYSTEM)
+    assert "/nix/store/eeee-gone" not in sh.verified
+    assert "/nix/store/eeee-gone" not in json.loads(cache.read_text())
+
+def test_modified_paths_are_repaired_and_checked_again(cache):
+    sh = FakeShell(closure())
+    sh.failures[BASH] = f"error: path '{BASH}' was modified! expected hash 'sha256-bash'"
+    assert StoreVerify.verify(sh, SYSTEM) == [BASH]
+    assert sh.repaired == [BASH]
+    assert sorted(json.loads(cache.read_text())) == [SYSTEM, GLIBC]
+    sh.failures, sh.verified = {}, []
+    StoreVerify.verify(sh, SYSTEM)
+    assert sh.verified == [BASH]
+
+def test_unexplained_failures_are_not_cached(cache):
+    sh = FakeShell(closure())
+    sh.failures[GLIBC] = "error: opening file: Input/output error"
+    assert StoreVerify.verify(sh, SYSTEM) == []
+    assert sh.repaired == []
+    assert GLIBC not in json.loads(cache.read_text())
+
+def test_empty_cache_path_disables_the_cache(cache, monkeypatch):
+    monkeypatch.setenv(StoreVerify.ENV, "")
+    sh = FakeShell(closure())
+    for _ in range(2): StoreVerify.verify(sh, SYSTEM)
+    assert len(sh.verified) == 6
+    assert not cache.exists()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Command tracing: with NIXOS_SHELL_TRACE set, every command Shell runs leaves a
+span with its exit code, output size and resource usage, named with secrets
+redacted, and the trace is written as Chrome trace events with a summary of
+the slowest commands.
+
+Usage:
+  python3 -m pytest scripts/lib/test/tracing_test.py
+"""
+import json, sys
+from pathlib import Path
+import pytest
+
+SCRIPTS = Path(__file__).resolve().parents[2]
+sys.path[:0] = [str(SCRIPTS)]
+from lib import Shell
+from lib.memo import Memo
+from lib.replay import Recording
+from lib.tracing import Tracer
+
+class UserShell(Shell):
+    def run(self, cmd, **kwargs):
+        return super().run(cmd, **{**kwargs, "sudo": False})
+    def run_many(self, cmds, **kwargs):
+        return super().run_many(cmds, **{**kwargs, "sudo": False})
+
+@pytest.fixture
+def trace(tmp_path, monkeypatch):
+    monkeypatch.setattr(Shell, "memo", Memo())
+    monkeypatch.delenv(Recording.RECORD, raising=False)
+    monkeypatch.delenv(Recording.REPLAY, raising=False)
+    monkeypatch.setenv(Tracer.ENV, str(tmp_path / "trace.json"))
+    monkeypatch.setattr(Tracer, "spans", [])
+    monkeypatch.setattr(Tracer, "lanes", set())
+    return tmp_path / "trace.json"
+
+def test_spans_carry_exit_code_output_and_rusage(trace):
+    UserShell().run(["sh", "-c", "echo hunter2; exit 2"], check=False, sensitive="hunter2")
+    [span] = Tracer.spans
+    assert span["name"] == "sh -c 'echo ***; exit 2'"
+    assert (span["ph"], span["cat"]) == ("X", "shell")
+    assert span["args"]["exit"] == 2 and span["args"]["bytes"] == len("hunter2\n")
+    assert {"user", "sys", "maxrss_kb", "inblock", "oublock"} <= set(span["args"])
+
+def test_concurrent_commands_get_their_own_lanes(trace):
+    UserShell().run_many([["sleep", "0.2"], ["sleep", "0.2"], ["false"]], on_error="collect")
+    assert sorted(span["tid"] for span in Tracer.spans) == [0, 1, 2]
+    assert sorted(span["args"]["exit"] for span in Tracer.spans) == [0, 0, 1]
+
+def test_write_exports_chrome_trace_and_slowest_commands(trace, monkeypatch, capsys):
+    monkeypatch.setattr(Tracer, "TOP", 1)
+    sh = UserShell()
+    sh.run(["sleep", "0.2"])
+    sh.run(["true"])
+    Tracer.write()
+    exported = json.loads(trace.read_text())
+    assert exported["displayTimeUnit"] == "ms"
+    assert [event["name"] for event in exported["traceEvents"]] == ["sleep 0.2", "true"]
+    summary = capsys.readouterr().err.splitlines()
+    assert summary[0].startswith("\033[90mLOG: trace: 2 spans") and len(summary) == 2
+    assert "exit=0 user=" in summary[1] and summary[1].endswith(" sleep 0.2\033[0m")
+
+def test_disabled_tracing_records_nothing(trace, monkeypatch):
+    monkeypatch.delenv(Tracer.ENV)
+    UserShell().run(["true"])
+    assert Tracer.spans == []
@@ -0,0 +1,49 @@
+import atexit, contextlib, json, os, sys, threading, time
+
+class Tracer:
+    ENV = "NIXOS_SHELL_TRACE"
+    TOP = int(os.environ.get("NIXOS_SHELL_TRACE_TOP", "10"))
+    spans: list = []
+    lanes: set = set()
+    lock = threading.Lock()
+    @classmethod
+    def enabled(cls):
+        return bool(os.environ.get(cls.ENV))
+    @classmethod
+    @contextlib.contextmanager
+    def span(cls, name, category="shell"):
+        if not cls.enabled():
+            yield {}
+            return
+        with cls.lock:
+            lane = min(set(range(len(cls.lanes) + 1)) - cls.lanes)
+            cls.lanes.add(lane)
+        args, started, clock = {}, time.time(), time.monotonic()
+        try: yield args
+        finally:
+            with cls.lock: cls.lanes.discard(lane)
+            cls.spans.append({"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": lane,
+                              "ts": int(started * 1e6), "dur": int((time.monotonic() - clock) * 1e6),
+                              "args": args})
+    @classmethod
+    def describe(cls, result):
+        output = sum(len(stream.encode()) for stream in (result.stdout, result.stderr) if stream)
+        return {"exit": result.returncode, "bytes": output, **(getattr(result, "rusage", None) or {})}
+    @classmethod
+    def write(cls):
+        if not cls.spans: return
+        with open(os.environ[cls.ENV], "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": cls.spans, "displayTimeUnit": "ms"}, f)
+        for line in cls.summary(): print(f"\033[90mLOG: {line}\033[0m", file=sys.stderr)
+    @classmethod
+    def summary(cls):
+        total = sum(span["dur"] for span in cls.spans) / 1000
+        lines = [f"trace: {len(cls.spans)} spans, {total:.1f}ms -> {os.environ[cls.ENV]}"]
+        for span in sorted(cls.spans, key=lambda span: span["dur"], reverse=True)[:cls.TOP]:
+            args = span["args"]
+            usage = (f" user={args['user']:.2f}s sys={args['sys']:.2f}s rss={args['maxrss_kb'] // 1024}MB"
+                     if "user" in args else "")
+            lines.append(f"{span['dur'] / 1000:10.1f}ms exit={args.get('exit', '-')}{usage} {span['name']}")
+        return lines
+
+if Tracer.enabled(): atexit.register(Tracer.write)
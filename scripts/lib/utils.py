@@ -1,5 +1,7 @@
-import argparse, sys
+import argparse, subprocess, sys
+from .deadline import Deadline
 from .shell import Shell, chrootable
+from . import process
 
 @chrootable
 class Utils:
@@ -35,6 +37,15 @@ class Utils:
     def reboot(cls):
         return cls.sh.run("shutdown -r now")
     @classmethod
+    def run_bounded(cls, cmd, timeout, capture_output=True):
+        # Unprivileged and unlogged, for the desktop helpers: a command still running after
+        # `timeout` (or a tighter enclosing deadline) is stopped, reported, and exits with 124.
+        try: return process.run(cmd, capture_output=capture_output, timeout=Deadline.limit(timeout))
+        except subprocess.TimeoutExpired as e:
+            cls.log_error(f"{process.display(cmd)} timed out after {e.timeout:.1f}s")
+            output = "" if capture_output else None
+            return subprocess.CompletedProcess(cmd, 124, output, output)
+    @classmethod
     def log(cls, message):
         if cls.LOG_INFO: print(f"{cls.GRAY}LOG: {message}{cls.RESET}")
     @classmethod